@@ -0,0 +1,137 @@
+"""Cost of building and serving the addon catalogue with many addons.
+
+Inserts ``-n`` synthetic addons, then times a full build of the feed, a
+refresh with nothing changed, a refresh after a few addons changed and
+the requests of game clients: a gzip snapshot, the streamed document and
+a revalidation answered with 304.
+
+Needs a migrated database; the synthetic addons are removed again. Run
+from the repository root:
+
+    python -m benchmarks.catalogue_feed stk_bench -n 10000
+
+The server is chosen by the usual PG* variables.
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import psycopg2
+
+from stkaddons import database
+from stkaddons.api.catalogue import Catalogue
+from stkaddons.app import create_app
+
+PREFIX = "bench-addon-"
+
+
+def timed(fn, repeat: int = 1) -> tuple[float, object]:
+    """Median seconds of ``repeat`` calls and the result of the last one"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("database", help="name of a migrated database")
+    parser.add_argument("-n", type=int, default=10000, help="synthetic addons")
+    parser.add_argument("--changed", type=int, default=10, help="addons to update")
+    args = parser.parse_args()
+
+    config = {
+        "DB_NAME": args.database,
+        "DB_HOST": os.environ.get("PGHOST"),
+        "DB_PORT": os.environ.get("PGPORT"),
+        "DB_USER": os.environ.get("PGUSER"),
+        "DB_PASS": os.environ.get("PGPASSWORD"),
+        "MAIL_OUTBOX_THREAD": False,
+        "SWEEPER_INTERVAL": 0,
+        "CATALOGUE_REFRESH_INTERVAL": 3600.0,
+    }
+    conn = psycopg2.connect(**database.connect_kwargs(config))
+    cur = conn.cursor()
+    cur.execute(
+        """
+        INSERT INTO addons (id, type, name, designer, description, file, size,
+                            format, license, rating, updated)
+        SELECT %(prefix)s || i, (ARRAY['kart', 'track', 'arena'])[i %% 3 + 1],
+               'Addon ' || i, 'Designer ' || i, repeat('A description. ', 8),
+               %(prefix)s || i || '.zip', 1000000 + i, 6, 'CC-BY-SA 4.0',
+               (i %% 30) / 10.0, now() - i * interval '1 second'
+        FROM generate_series(1, %(n)s) i
+        """,
+        {"prefix": PREFIX, "n": args.n},
+    )
+    conn.commit()
+
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            feed = Catalogue(directory)
+
+            seconds, _ = timed(lambda: feed.refresh(conn.cursor()))
+            conn.commit()
+            snapshot = feed.snapshot
+            print(
+                f"full build       {seconds * 1000:8.1f} ms  "
+                f"{feed.rendered} entries, {snapshot.size / 1e6:.1f} MB, "
+                f"gzip {os.path.getsize(snapshot.gzip_path) / 1e6:.2f} MB"
+            )
+
+            seconds, _ = timed(lambda: feed.refresh(conn.cursor()), 20)
+            conn.commit()
+            print(f"unchanged        {seconds * 1000:8.1f} ms")
+
+            rendered = feed.rendered
+            cur.execute(
+                """
+                UPDATE addons SET revision = revision + 1, updated = now()
+                WHERE id IN (SELECT id FROM addons WHERE id LIKE %s LIMIT %s)
+                """,
+                (PREFIX + "%", args.changed),
+            )
+            conn.commit()
+            seconds, _ = timed(lambda: feed.refresh(conn.cursor()))
+            conn.commit()
+            print(
+                f"{args.changed} changed       {seconds * 1000:8.1f} ms  "
+                f"{feed.rendered - rendered} entries rendered"
+            )
+
+        with tempfile.TemporaryDirectory() as directory:
+            app = create_app({**config, "CATALOGUE_DIR": directory})
+            client = app.test_client()
+            client.get("/api/v2/assets/")
+
+            def get(**headers):
+                response = client.get("/api/v2/assets/", headers=headers)
+                response.get_data()
+                return response
+
+            seconds, response = timed(lambda: get(**{"Accept-Encoding": "gzip"}), 20)
+            print(f"gzip snapshot    {seconds * 1000:8.1f} ms")
+            etag = response.headers["ETag"]
+
+            seconds, _ = timed(lambda: get(), 20)
+            print(f"streamed         {seconds * 1000:8.1f} ms")
+
+            seconds, response = timed(
+                lambda: get(**{"Accept-Encoding": "gzip", "If-None-Match": etag}),
+                20,
+            )
+            assert response.status_code == 304
+            print(f"not modified     {seconds * 1000:8.1f} ms")
+    finally:
+        cur.execute("DELETE FROM addons WHERE id LIKE %s", (PREFIX + "%",))
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
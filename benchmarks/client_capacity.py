@@ -0,0 +1,191 @@
+"""Concurrent game clients served per CPU core by a running API server.
+
+Every simulated client logs in once, then polls /api/v2/user/poll/ over a
+keep-alive connection for ``--duration`` seconds. For each number of
+clients the script reports the throughput, the latencies and, with
+``--pid``, the CPU time the server spent, so the Flask and the ASGI
+servers can be compared per core:
+
+    gunicorn -w 1 --threads 64 -b 127.0.0.1:8000 stkaddons:app
+    uvicorn --workers 1 --port 8001 stkaddons.asgi:app
+
+    python -m benchmarks.client_capacity http://127.0.0.1:8000 \\
+        --username player --password secret --pid <server pid>
+
+All clients log in as the same, existing account; each gets its own
+session. CPU time is read from /proc for the given processes and their
+children, so it only works on Linux.
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import statistics
+import time
+from urllib.parse import urlencode, urlsplit
+
+TOKEN_RE = re.compile(rb'token="([^"]+)"')
+USERID_RE = re.compile(rb'userid="(\d+)"')
+
+
+class Client:
+    """One game client on one keep-alive HTTP/1.1 connection"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def post(self, path: str, form: dict) -> tuple[int, bytes]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+
+        body = urlencode(form).encode()
+        self.writer.write(
+            f"POST {path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            "Content-Type: application/x-www-form-urlencoded\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await self.writer.drain()
+
+        version, status, _ = (await self.reader.readline()).split(b" ", 2)
+        headers = {}
+        while (line := await self.reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip().lower()
+
+        if headers.get("transfer-encoding") == "chunked":
+            data = b""
+            while size := int(await self.reader.readline(), 16):
+                data += await self.reader.readexactly(size + 2)
+            await self.reader.readline()
+        else:
+            data = await self.reader.readexactly(int(headers["content-length"]))
+
+        if version == b"HTTP/1.0" or headers.get("connection") == "close":
+            await self.close()
+
+        return int(status), data
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def cpu_seconds(pids: list[int]) -> float:
+    """CPU time used so far by ``pids`` and all their descendants"""
+    ticks = os.sysconf("SC_CLK_TCK")
+    stats = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            # ppid, utime and stime, counting from the state field
+            stats[int(entry)] = (int(fields[1]), int(fields[11]) + int(fields[12]))
+
+    wanted = set(pids)
+    while True:
+        children = {pid for pid, (ppid, _) in stats.items() if ppid in wanted}
+        if children <= wanted:
+            break
+        wanted |= children
+
+    return sum(stats[pid][1] for pid in wanted if pid in stats) / ticks
+
+
+async def run(args, count: int) -> None:
+    url = urlsplit(args.url)
+    clients = [Client(url.hostname, url.port or 80) for _ in range(count)]
+    logins = asyncio.Semaphore(args.login_concurrency)
+
+    async def login(client: Client) -> dict:
+        async with logins:
+            _, data = await client.post(
+                "/api/v2/user/connect/",
+                {"username": args.username, "password": args.password},
+            )
+        return {
+            "userid": USERID_RE.search(data).group(1).decode(),
+            "token": TOKEN_RE.search(data).group(1).decode(),
+        }
+
+    credentials = await asyncio.gather(*(login(c) for c in clients))
+
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + args.duration
+
+    async def poll(client: Client, form: dict) -> None:
+        nonlocal errors
+        while (start := time.perf_counter()) < deadline:
+            try:
+                status, data = await client.post("/api/v2/user/poll/", form)
+            except (OSError, ValueError, asyncio.IncompleteReadError):
+                errors += 1
+                await client.close()
+                continue
+            if status != 200 or b'success="yes"' not in data:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    cpu = cpu_seconds(args.pid) if args.pid else None
+    begin = time.perf_counter()
+    await asyncio.gather(*(poll(c, f) for c, f in zip(clients, credentials)))
+    elapsed = time.perf_counter() - begin
+
+    for client in clients:
+        await client.close()
+
+    rate = len(latencies) / elapsed
+    latencies.sort()
+    line = (
+        f"{count:7}  {rate:9.0f}  "
+        f"{statistics.median(latencies) * 1000:8.1f}  "
+        f"{latencies[int(len(latencies) * 0.99)] * 1000:8.1f}  {errors:6}"
+    )
+    if cpu is not None:
+        cores = (cpu_seconds(args.pid) - cpu) / elapsed
+        line += f"  {cores:5.2f}  {rate / max(cores, 0.01):10.0f}"
+    print(line, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("url", help="base URL of the server")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--clients", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument(
+        "--login-concurrency",
+        type=int,
+        default=8,
+        help="logins at a time, they are slow on purpose",
+    )
+    parser.add_argument(
+        "--pid", type=int, action="append", help="server process to measure"
+    )
+    args = parser.parse_args()
+
+    header = (
+        f"{'clients':>7}  {'req/s':>9}  {'p50 ms':>8}  {'p99 ms':>8}  {'errors':>6}"
+    )
+    if args.pid:
+        header += f"  {'cores':>5}  {'req/s/core':>10}"
+    print(header)
+
+    for count in args.clients:
+        asyncio.run(run(args, count))
+
+
+if __name__ == "__main__":
+    main()
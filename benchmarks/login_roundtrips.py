@@ -0,0 +1,151 @@
+"""Statements and time per /api/v2/user/connect/ login.
+
+Compares the current login path with the five statements the endpoint
+used to run (user by LIKE, session INSERT, date_login UPDATE, COMMIT and
+a separate achievements query). Both sets of statements are timed on a
+bare connection; the endpoint itself is timed through the test client, so
+its times also include Flask's request handling, and its statements are
+counted by sql_stats.
+
+Needs a migrated database; a throwaway user is created and removed again.
+Run from the repository root:
+
+    python -m benchmarks.login_roundtrips stk_bench -n 500
+
+The server is chosen by the usual PG* variables.
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+import psycopg2
+from werkzeug.security import generate_password_hash
+
+from stkaddons import database, sql_stats, util
+from stkaddons.app import create_app
+
+USERNAME = "bench-login"
+PASSWORD = "bench-password"
+
+
+def legacy_login(conn, user_agent: str) -> None:
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM users WHERE username LIKE %s", (USERNAME,))
+    userid = cur.fetchone()[0]
+    cur.execute(
+        "INSERT INTO sessions (id, token_hash, user_agent) VALUES (%s, %s, %s)",
+        (userid, util.hash_token(util.random_string()), user_agent),
+    )
+    cur.execute("UPDATE users SET date_login = now() WHERE id = %s", (userid,))
+    conn.commit()
+    cur.execute("SELECT achievements FROM users WHERE id = %s", (userid,))
+    cur.fetchone()
+    conn.commit()
+
+
+def current_login(conn, user_agent: str) -> None:
+    """The statements of ClientSession.create, in autocommit mode"""
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM users WHERE lower(username) = lower(%s)", (USERNAME,))
+    userid = cur.fetchone()[0]
+    cur.execute(
+        """
+        WITH s AS (
+            INSERT INTO sessions (id, token_hash, user_agent)
+            VALUES (%(id)s, %(token_hash)s, %(ua)s)
+        )
+        UPDATE users SET date_login = now(), password = COALESCE(NULL, password)
+        WHERE id = %(id)s
+        """,
+        {
+            "id": userid,
+            "token_hash": util.hash_token(util.random_string()),
+            "ua": user_agent,
+        },
+    )
+
+
+def time_login(fn, conn, n: int) -> list[float]:
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn(conn, "bench")
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name: str, statements: float, times: list[float]) -> None:
+    times.sort()
+    print(
+        f"{name:8} {statements:4.1f} statements  "
+        f"median {statistics.median(times) * 1000:6.2f} ms  "
+        f"p95 {times[int(len(times) * 0.95)] * 1000:6.2f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("database", help="name of a migrated database")
+    parser.add_argument("-n", type=int, default=200, help="logins per path")
+    args = parser.parse_args()
+
+    config = {
+        "DB_NAME": args.database,
+        "DB_HOST": os.environ.get("PGHOST"),
+        "DB_PORT": os.environ.get("PGPORT"),
+        "DB_USER": os.environ.get("PGUSER"),
+        "DB_PASS": os.environ.get("PGPASSWORD"),
+        # Cheap hashing, so the database round trips dominate
+        "PASSWORD_HASH_METHOD": "pbkdf2:sha256:1",
+        "PASSWORD_HASH_WORKERS": 0,
+        "RATE_LIMIT_BACKEND": "local",
+        "RATE_LIMITS": {},
+        "MAIL_OUTBOX_THREAD": False,
+        "SWEEPER_INTERVAL": 0,
+    }
+    conn = psycopg2.connect(**database.connect_kwargs(config))
+    cur = conn.cursor()
+    cur.execute(
+        """
+        INSERT INTO users (username, password, email, activated)
+        VALUES (%s, %s, %s, true)
+        RETURNING id
+        """,
+        (
+            USERNAME,
+            generate_password_hash(PASSWORD, config["PASSWORD_HASH_METHOD"]),
+            f"{USERNAME}@example.com",
+        ),
+    )
+    userid = cur.fetchone()[0]
+    conn.commit()
+
+    try:
+        app = create_app(config)
+        client = app.test_client()
+        form = {"username": USERNAME, "password": PASSWORD}
+        client.post("/api/v2/user/connect/", data=form)
+
+        times = []
+        with sql_stats.record_queries(app) as recorded:
+            for _ in range(args.n):
+                start = time.perf_counter()
+                client.post("/api/v2/user/connect/", data=form)
+                times.append(time.perf_counter() - start)
+        statements = sum(s.count for s in recorded) / max(len(recorded), 1)
+        report("endpoint", statements, times)
+
+        report("legacy", 5, time_login(legacy_login, conn, args.n))
+        conn.autocommit = True
+        report("current", 2, time_login(current_login, conn, args.n))
+        conn.autocommit = False
+    finally:
+        cur.execute("DELETE FROM users WHERE id = %s", (userid,))
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
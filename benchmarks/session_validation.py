@@ -0,0 +1,109 @@
+"""Time of validating a client session for users with many sessions.
+
+Compares the token-keyed lookup of ClientSession.get with the old way of
+fetching every session row of the user and scanning it in Python. Both are
+timed on a bare connection with the session cache out of the picture.
+
+Needs a migrated database; throwaway users are created and removed again.
+Run from the repository root:
+
+    python -m benchmarks.session_validation stk_bench --sessions 10 100 1000
+
+The server is chosen by the usual PG* variables.
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from stkaddons import database, util
+
+
+def current_lookup(cur, userid: int, token: str) -> bool:
+    cur.execute(
+        """
+        SELECT u.* FROM sessions s JOIN users u ON u.id = s.id
+        WHERE s.token_hash = %s AND s.id = %s
+        """,
+        (util.hash_token(token), userid),
+    )
+    return cur.fetchone() is not None
+
+
+def legacy_lookup(cur, userid: int, token: str) -> bool:
+    cur.execute("SELECT token_hash FROM sessions WHERE id = %s", (userid,))
+    token_hash = util.hash_token(token)
+    found = any(bytes(row[0]) == token_hash for row in cur.fetchall())
+    cur.execute("SELECT * FROM users WHERE id = %s", (userid,))
+    return found and cur.fetchone() is not None
+
+
+def time_lookup(fn, cur, userid: int, token: str, n: int) -> list[float]:
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        assert fn(cur, userid, token)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("database", help="name of a migrated database")
+    parser.add_argument("-n", type=int, default=500, help="lookups per case")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 100, 500, 2000])
+    args = parser.parse_args()
+
+    config = {
+        "DB_NAME": args.database,
+        "DB_HOST": os.environ.get("PGHOST"),
+        "DB_PORT": os.environ.get("PGPORT"),
+        "DB_USER": os.environ.get("PGUSER"),
+        "DB_PASS": os.environ.get("PGPASSWORD"),
+    }
+    conn = psycopg2.connect(**database.connect_kwargs(config))
+    conn.autocommit = True
+    cur = conn.cursor()
+    created = []
+
+    try:
+        print(f"{'sessions':>8}  {'current':>16}  {'legacy':>16}  (median ms)")
+        for count in args.sessions:
+            cur.execute(
+                """
+                INSERT INTO users (username, password, email, activated)
+                VALUES (%s, '', %s, true)
+                RETURNING id
+                """,
+                (f"bench-sessions-{count}", f"bench-sessions-{count}@example.com"),
+            )
+            userid = cur.fetchone()[0]
+            created.append(userid)
+
+            tokens = [util.random_string() for _ in range(count)]
+            execute_values(
+                cur,
+                "INSERT INTO sessions (id, token_hash) VALUES %s",
+                [(userid, util.hash_token(t)) for t in tokens],
+            )
+            cur.execute("ANALYZE sessions")
+            # The last device to log in, the worst case of the old scan
+            token = tokens[-1]
+
+            current = time_lookup(current_lookup, cur, userid, token, args.n)
+            legacy = time_lookup(legacy_lookup, cur, userid, token, args.n)
+            print(
+                f"{count:8}  {statistics.median(current) * 1000:16.3f}  "
+                f"{statistics.median(legacy) * 1000:16.3f}"
+            )
+    finally:
+        cur.execute("DELETE FROM users WHERE id = ANY(%s)", (created,))
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
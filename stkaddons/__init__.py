@@ -1,3 +1,15 @@
 from .app import create_app
 
-app = create_app()
+# ``stkaddons.app`` is the app of ``flask --app stkaddons`` and the WSGI
+# servers. It is built on first access, so processes that only import a
+# module of the package, such as the password hashing workers, do not
+# create an app of their own.
+del app
+
+
+def __getattr__(name: str):
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    app = globals()["app"] = create_app()
+    return app
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+from flask import current_app
+import datetime
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING
+from psycopg2 import Error as PgError
+from psycopg2.extras import execute_values
+
+from .background import Flusher
+from . import database
+from .errors import DatabaseError
+
+if TYPE_CHECKING:
+    from flask import Flask
+
+log = logging.getLogger("stkaddons.activity")
+
+
+class ActivityBuffer:
+    """Write-behind buffer for ``sessions.last_activity``.
+
+    Polls only record the time in memory. A background thread writes the
+    latest time of every dirty session in one batched UPDATE each
+    ``interval`` seconds. A session whose activity was written less than
+    ``max_staleness`` seconds ago is not written again, so a client polling
+    every few seconds costs one row update per ``max_staleness``.
+    """
+
+    def __init__(self, app: Flask, interval: float = 5.0, max_staleness: float = 60.0):
+        self.app = app
+        self.interval = interval
+        self.max_staleness = max_staleness
+
+        self._lock = threading.Lock()
+        self._pending: dict[bytes, datetime.datetime] = {}
+        # token hash -> monotonic time of the last write that included it
+        self._written: dict[bytes, float] = {}
+        self._thread = Flusher(
+            "activity-flush",
+            self.flush,
+            interval,
+            "Unable to flush session activity",
+            self._forget_inherited,
+        )
+
+        self.flushes = 0
+        self.rows_written = 0
+
+    def _forget_inherited(self) -> None:
+        # Anything inherited over a fork belongs to the parent
+        with self._lock:
+            self._pending.clear()
+            self._written.clear()
+
+    def record(self, token: bytes) -> None:
+        """Record activity for the session with the given token hash"""
+        self._thread.ensure_started()
+
+        with self._lock:
+            written = self._written.get(token)
+            if (
+                token not in self._pending
+                and written is not None
+                and time.monotonic() - written < self.max_staleness
+            ):
+                return
+
+            self._pending[token] = datetime.datetime.now()
+
+    def forget(self, token: bytes) -> None:
+        """Drop pending activity of a session that no longer exists"""
+        with self._lock:
+            self._pending.pop(token, None)
+            self._written.pop(token, None)
+
+    def flush(self) -> int:
+        """Write all pending activity and return the number of rows sent"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+
+        pool = database.get_pool(self.app)
+        conn = None
+        try:
+            conn = pool.getconn()
+            with conn.cursor() as cur:
+                execute_values(
+                    cur,
+                    """
+                    UPDATE sessions AS s SET last_activity = v.ts
+                    FROM (VALUES %s) AS v (token_hash, ts)
+                    WHERE s.token_hash = v.token_hash
+                    """,
+                    list(batch.items()),
+                    page_size=1000,
+                )
+            conn.commit()
+        except (PgError, DatabaseError):
+            # Put the batch back unless a newer poll superseded it
+            with self._lock:
+                for token, ts in batch.items():
+                    self._pending.setdefault(token, ts)
+            raise
+        finally:
+            if conn is not None:
+                pool.putconn(conn)
+
+        now = time.monotonic()
+        with self._lock:
+            for token in batch:
+                self._written[token] = now
+
+            cutoff = now - self.max_staleness
+            for token in [t for t, w in self._written.items() if w < cutoff]:
+                del self._written[token]
+
+            self.flushes += 1
+            self.rows_written += len(batch)
+
+        return len(batch)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "flushes": self.flushes,
+                "rows_written": self.rows_written,
+            }
+
+
+def get_activity_buffer() -> ActivityBuffer:
+    return current_app.extensions["stkaddons_activity"]
+
+
+def init_app(app: Flask):
+    app.extensions["stkaddons_activity"] = ActivityBuffer(
+        app,
+        app.config["ACTIVITY_FLUSH_INTERVAL"],
+        app.config["ACTIVITY_MAX_STALENESS"],
+    )
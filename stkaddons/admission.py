@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from flask import current_app, request
+from functools import wraps
+import logging
+import os
+import struct
+import threading
+import time
+from typing import TYPE_CHECKING, Callable
+
+from .errors import RateLimited
+from .shm import SharedTable
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from typing import Optional
+    from .metrics import Metrics
+
+log = logging.getLogger("stkaddons.admission")
+
+# tokens left, time of the last refill
+_BUCKET = struct.Struct("<dd")
+# worker pid, requests it has in progress
+_WORKER = struct.Struct("<II")
+# Entries are rewritten on every request, this only bounds how long the
+# counter of an idle endpoint lingers
+_CONCURRENCY_TTL = 24 * 3600.0
+# Every slot of the shared table has room for a counter per worker, so
+# this bounds the size of the file (RATE_LIMIT_SLOTS * 8 bytes per worker)
+MAX_WORKERS = 256
+
+
+class LocalTable:
+    """In-process table with the ``update`` interface of SharedTable"""
+
+    def __init__(self, max_size: int = 65536):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: dict[str, tuple[float, bytes]] = {}
+
+    def update(
+        self,
+        key: str,
+        fn: Callable[[Optional[bytes]], tuple[bytes, float]],
+    ) -> bytes:
+        with self._lock:
+            now = time.time()
+            entry = self._entries.get(key)
+            value, ttl = fn(entry[1] if entry and entry[0] > now else None)
+            self._entries[key] = (now + ttl, value)
+
+            if len(self._entries) > self.max_size:
+                self._entries = {k: e for k, e in self._entries.items() if e[0] > now}
+                while len(self._entries) > self.max_size:
+                    del self._entries[next(iter(self._entries))]
+
+        return value
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _unpack_workers(data: Optional[bytes]) -> dict[int, int]:
+    if not data:
+        return {}
+
+    return dict(_WORKER.iter_unpack(data))
+
+
+def _pack_workers(workers: dict[int, int]) -> bytes:
+    return b"".join(_WORKER.pack(pid, n) for pid, n in workers.items() if n > 0)
+
+
+class Limiter:
+    """Admission control for expensive endpoints.
+
+    ``rules`` maps a rule name to a dict with any of:
+
+    * ``concurrency``: requests allowed in progress at once on the host
+    * ``ip``: ``(requests, seconds)`` token bucket per client address
+    * ``username``: ``(requests, seconds)`` token bucket per username
+
+    The counters live in the table returned by ``make_table``, a
+    SharedTable to share them between the workers of a host or a LocalTable
+    to keep them per process. It is created on first use. ``max_workers``
+    is the number of processes a concurrency counter has room for.
+    """
+
+    def __init__(
+        self,
+        make_table: Callable[[], SharedTable | LocalTable],
+        rules: dict,
+        max_workers: int = None,
+    ):
+        self.rules = rules
+        self.max_workers = max_workers
+
+        self._make_table = make_table
+        self._table: Optional[SharedTable | LocalTable] = None
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[str, int]] = {}
+        # set by init_app
+        self.metrics: Optional[Metrics] = None
+
+    @property
+    def table(self) -> SharedTable | LocalTable:
+        if self._table is None:
+            with self._lock:
+                if self._table is None:
+                    self._table = self._make_table()
+
+        return self._table
+
+    def _count(self, name: str, outcome: str) -> None:
+        with self._lock:
+            counters = self._counters.setdefault(name, {})
+            counters[outcome] = counters.get(outcome, 0) + 1
+
+        if self.metrics:
+            self.metrics.inc("admission_total", (("rule", name), ("outcome", outcome)))
+
+    def _reject(self, name: str, reason: str):
+        self._count(name, f"rejected_{reason}")
+        log.info("Rejected a request to %s (%s limit)", name, reason)
+        raise RateLimited
+
+    def _take(self, key: str, capacity: int, period: float) -> bool:
+        """Take a token from a bucket that refills ``capacity`` per ``period``"""
+        rate = capacity / period
+        taken = False
+
+        def fn(old: Optional[bytes]):
+            nonlocal taken
+            now = time.time()
+
+            if old is None:
+                tokens = capacity
+            else:
+                tokens, last = _BUCKET.unpack(old)
+                tokens = min(capacity, tokens + (now - last) * rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                taken = True
+
+            # An untouched bucket is full again after one period
+            return _BUCKET.pack(tokens, now), period
+
+        self.table.update(key, fn)
+        return taken
+
+    def _enter(self, key: str, limit: int) -> bool:
+        pid = os.getpid()
+        entered = False
+
+        def fn(old: Optional[bytes]):
+            nonlocal entered
+            workers = _unpack_workers(old)
+
+            if sum(workers.values()) >= limit:
+                # Forget the requests of workers that died while serving them
+                workers = {p: n for p, n in workers.items() if p == pid or _alive(p)}
+
+            if sum(workers.values()) < limit:
+                if pid not in workers and len(workers) == self.max_workers:
+                    workers = {p: n for p, n in workers.items() if _alive(p)}
+                    if len(workers) == self.max_workers:
+                        raise RuntimeError(
+                            f"More than RATE_LIMIT_WORKERS={self.max_workers} "
+                            "processes share the rate limit table"
+                        )
+
+                workers[pid] = workers.get(pid, 0) + 1
+                entered = True
+
+            return _pack_workers(workers), _CONCURRENCY_TTL
+
+        self.table.update(key, fn)
+        return entered
+
+    def _leave(self, key: str) -> None:
+        pid = os.getpid()
+
+        def fn(old: Optional[bytes]):
+            workers = _unpack_workers(old)
+            workers[pid] = workers.get(pid, 0) - 1
+            return _pack_workers(workers), _CONCURRENCY_TTL
+
+        self.table.update(key, fn)
+
+    @contextmanager
+    def admit(self, name: str, ip: str = None, username: str = None):
+        """Run the block if the rules of ``name`` allow, else raise RateLimited"""
+        rule = self.rules.get(name)
+
+        if not rule:
+            yield
+            return
+
+        if ip and "ip" in rule:
+            if not self._take(f"{name}:ip:{ip}", *rule["ip"]):
+                self._reject(name, "ip")
+
+        if username and "username" in rule:
+            if not self._take(f"{name}:user:{username.lower()}", *rule["username"]):
+                self._reject(name, "username")
+
+        limit = rule.get("concurrency")
+        if not limit:
+            self._count(name, "admitted")
+            yield
+            return
+
+        key = f"{name}:running"
+        if not self._enter(key, limit):
+            self._reject(name, "concurrency")
+
+        self._count(name, "admitted")
+        try:
+            yield
+        finally:
+            self._leave(key)
+
+    def stats(self) -> dict:
+        """Return the admitted and rejected counts of this worker per rule"""
+        with self._lock:
+            return {name: dict(c) for name, c in self._counters.items()}
+
+
+def get_limiter() -> Limiter:
+    return current_app.extensions["stkaddons_admission"]
+
+
+def limited(name: str, username_field: str = "username"):
+    """Apply the admission rule ``name`` to the POST requests of a view"""
+
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if request.method != "POST":
+                return f(*args, **kwargs)
+
+            with get_limiter().admit(
+                name, request.remote_addr, request.form.get(username_field)
+            ):
+                return f(*args, **kwargs)
+
+        return wrapped
+
+    return decorator
+
+
+def init_app(app: Flask):
+    c = app.config
+    max_workers = None
+
+    if c["RATE_LIMIT_BACKEND"] == "shared":
+        max_workers = c["RATE_LIMIT_WORKERS"]
+        if not 1 <= max_workers <= MAX_WORKERS:
+            raise ValueError(
+                f"RATE_LIMIT_WORKERS must be between 1 and {MAX_WORKERS}, "
+                f"not {max_workers}"
+            )
+
+        def make_table():
+            return SharedTable(
+                c["RATE_LIMIT_PATH"]
+                or os.path.join(app.instance_path, "rate_limits.shm"),
+                c["RATE_LIMIT_SLOTS"],
+                # room for the concurrency counters of every worker
+                max_workers * _WORKER.size,
+            )
+
+    elif c["RATE_LIMIT_BACKEND"] == "local":
+
+        def make_table():
+            return LocalTable(c["RATE_LIMIT_SLOTS"])
+
+    else:
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND {c['RATE_LIMIT_BACKEND']}")
+
+    limiter = Limiter(make_table, c["RATE_LIMITS"], max_workers)
+    limiter.metrics = app.extensions["stkaddons_metrics"]
+    app.extensions["stkaddons_admission"] = limiter
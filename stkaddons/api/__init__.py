@@ -1,22 +1,33 @@
 from flask import Blueprint, Response, current_app
 import logging
-from xml.etree import ElementTree as et
 
-from ..errors import UserException
+from ..metrics import get_metrics
+from ..errors import RateLimited, ServerBusy, UserException
+from .catalogue import bp as catalogue
 from .users import bp as users
 from ..util import generic_response
+from .. import xml_response
 
 bp = Blueprint("api", __name__, url_prefix="/api/v2")
 log = logging.getLogger("stkaddons.api")
 
 bp.register_blueprint(users)
+bp.register_blueprint(catalogue)
 
 
 @bp.errorhandler(Exception)
 def handle_exception(e: Exception):
+    get_metrics().inc("api_errors_total", (("type", type(e).__name__),))
+
     if isinstance(e, UserException):
         return generic_response(success=False, info=str(e))
 
+    if isinstance(e, RateLimited):
+        return generic_response(success=False, info=str(e)), 429
+
+    if isinstance(e, ServerBusy):
+        return generic_response(success=False, info=str(e)), 503
+
     log.exception("Unhandled exception in request")
     return generic_response(success=False, info=f"Exception Error: {str(e)}")
 
@@ -29,7 +40,7 @@ def set_appropriate_headers(r: Response):
 
 @bp.route("/version/", methods=("GET", "POST"))
 def version():
-    e = et.Element(
-        "api", {"success": "yes", "version": current_app.config["VERSION"], "info": ""}
+    return xml_response.constant(
+        "api",
+        (("success", "yes"), ("version", current_app.config["VERSION"]), ("info", "")),
     )
-    return et.tostring(e)
@@ -0,0 +1,346 @@
+from __future__ import annotations
+
+import datetime
+from flask import Blueprint, Response, current_app, request, send_file
+import glob
+import gzip
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Iterable, NamedTuple
+
+from .. import database
+from .. import xml_response
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from psycopg2._psycopg import cursor as Cursor
+    from typing import Optional
+
+bp = Blueprint("api_catalogue", __name__)
+log = logging.getLogger("stkaddons.api.catalogue")
+
+HEADER = b'<?xml version="1.0" encoding="us-ascii"?>\n<assets>\n'
+FOOTER = b"</assets>\n"
+TYPE_ORDER = {"kart": 0, "track": 1, "arena": 2}
+CHUNK_SIZE = 64 * 1024
+# Snapshots kept in any case, newest first
+KEEP_SNAPSHOTS = 3
+
+_QUERY = """
+    SELECT a.id, a.type, a.name, u.username, a.designer, a.description,
+           a.revision, a.file, a.size, a.status, a.format, a.image, a.icon,
+           a.min_include_version, a.max_include_version, a.license, a.rating,
+           a.date, a.updated
+    FROM addons a LEFT JOIN users u ON u.id = a.uploader
+"""
+
+# What a refresh could have missed, cheaply: the number of addons, the
+# newest `updated` and a checksum of every (id, updated) in the lookback
+# window below it. A late-committed row or a change that leaves the newest
+# `updated` alone still shows up in the window.
+_CHECK_QUERY = """
+    WITH top AS (SELECT max(updated) AS updated FROM addons),
+    recent AS (
+        SELECT id, updated FROM addons
+        WHERE updated >= (SELECT updated FROM top) - %s * interval '1 second'
+    )
+    SELECT (SELECT count(*) FROM addons), (SELECT updated FROM top), count(*),
+           md5(string_agg(id || ':' || updated, ',' ORDER BY id))
+    FROM recent
+"""
+
+_catalogue_lock = threading.Lock()
+
+
+class Snapshot(NamedTuple):
+    """One state of the feed"""
+
+    fragments: tuple[bytes, ...]
+    size: int
+    etag: str
+    last_modified: datetime.datetime
+    gzip_path: str
+
+
+def _timestamp(value: datetime.datetime) -> str:
+    return str(int(value.replace(tzinfo=datetime.timezone.utc).timestamp()))
+
+
+def render(row: tuple, file_url: str) -> bytes:
+    """Render the feed entry of one addon"""
+    (
+        id,
+        type,
+        name,
+        uploader,
+        designer,
+        description,
+        revision,
+        file,
+        size,
+        status,
+        format,
+        image,
+        icon,
+        min_version,
+        max_version,
+        license,
+        rating,
+        date,
+        _,
+    ) = row
+
+    return (
+        b"  "
+        + xml_response.element(
+            type,
+            {
+                "id": id,
+                "name": name,
+                "file": file_url.format(file=file),
+                "date": _timestamp(date),
+                "uploader": uploader or "",
+                "designer": designer or "",
+                "description": description or "",
+                "image": image or "",
+                "icon": icon or "",
+                "format": str(format),
+                "revision": str(revision),
+                "status": str(status),
+                "size": str(size),
+                "min-include-version": min_version or "",
+                "max-include-version": max_version or "",
+                "license": license or "",
+                "rating": f"{rating:.6f}",
+            },
+        )
+        + b"\n"
+    )
+
+
+def stream(fragments: Iterable[bytes]):
+    """Yield the document in chunks of about CHUNK_SIZE bytes"""
+    yield HEADER
+
+    chunk = []
+    size = 0
+    for fragment in fragments:
+        chunk.append(fragment)
+        size += len(fragment)
+        if size >= CHUNK_SIZE:
+            yield b"".join(chunk)
+            chunk = []
+            size = 0
+
+    chunk.append(FOOTER)
+    yield b"".join(chunk)
+
+
+class Catalogue:
+    """The addon feed of the game, kept as one rendered fragment per addon.
+
+    A refresh only renders the addons whose ``updated`` moved since the
+    previous one and drops deleted ones. Each state is also written once
+    as a gzip snapshot, shared by the workers through ``directory``.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        file_url: str = "/dl/{file}",
+        refresh_interval: float = 30.0,
+        lookback: float = 60.0,
+    ):
+        self.directory = directory
+        self.file_url = file_url
+        self.refresh_interval = refresh_interval
+        # Rows committed late can carry an `updated` older than the newest
+        # row already seen, so every refresh looks back a little
+        self.lookback = datetime.timedelta(seconds=lookback)
+
+        self._lock = threading.Lock()
+        # id -> (sort key, fragment)
+        self._entries: dict[str, tuple[tuple, bytes]] = {}
+        self._seen = None
+        self._checked = 0.0
+        self.snapshot: Optional[Snapshot] = None
+
+        self.refreshes = 0
+        self.rendered = 0
+
+    def current(self) -> Snapshot:
+        """Return the current snapshot, refreshing it if it is due"""
+        if time.monotonic() - self._checked >= self.refresh_interval:
+            # Requests wait until there is a first snapshot; later ones
+            # serve the previous snapshot while one thread refreshes
+            if self._lock.acquire(blocking=self.snapshot is None):
+                try:
+                    if time.monotonic() - self._checked >= self.refresh_interval:
+                        self._refresh_or_keep()
+                finally:
+                    self._lock.release()
+
+        return self.snapshot
+
+    def _refresh_or_keep(self) -> None:
+        try:
+            self.refresh(database.get_database(readonly=True).cursor())
+        except Exception:
+            if self.snapshot is None:
+                raise
+            # Retried by the next request
+            log.exception("Unable to refresh the catalogue, serving the last one")
+
+    def refresh(self, cur: Cursor) -> bool:
+        """Bring the feed up to date; returns whether it changed"""
+        checked = time.monotonic()
+
+        cur.execute(_CHECK_QUERY, (self.lookback.total_seconds(),))
+        seen = cur.fetchone()
+        if seen == self._seen and self.snapshot is not None:
+            self._keep(self.snapshot)
+            self._checked = checked
+            return False
+
+        if self._seen is None or self._seen[1] is None:
+            cur.execute(_QUERY)
+        else:
+            cur.execute(
+                _QUERY + " WHERE a.updated >= %s", (self._seen[1] - self.lookback,)
+            )
+
+        for row in cur:
+            self._entries[row[0]] = (
+                (TYPE_ORDER[row[1]], row[0]),
+                render(row, self.file_url),
+            )
+            self.rendered += 1
+
+        # Rows were deleted, possibly alongside an insert
+        if len(self._entries) != seen[0]:
+            cur.execute("SELECT id FROM addons")
+            ids = {row[0] for row in cur}
+            for id in self._entries.keys() - ids:
+                del self._entries[id]
+
+        self._seen = seen
+        self.refreshes += 1
+        self.snapshot = self._snapshot(seen[1])
+        self._checked = checked
+        return True
+
+    def _snapshot(self, last_modified: Optional[datetime.datetime]) -> Snapshot:
+        fragments = tuple(f for _, f in sorted(self._entries.values()))
+
+        digest = hashlib.sha256()
+        for fragment in fragments:
+            digest.update(fragment)
+        etag = digest.hexdigest()[:32]
+
+        snapshot = Snapshot(
+            fragments,
+            len(HEADER) + sum(map(len, fragments)) + len(FOOTER),
+            etag,
+            (last_modified or datetime.datetime(1970, 1, 1)).replace(
+                tzinfo=datetime.timezone.utc
+            ),
+            os.path.join(self.directory, f"assets-{etag}.xml.gz"),
+        )
+        self._keep(snapshot)
+        self._prune(snapshot.gzip_path)
+        return snapshot
+
+    def _keep(self, snapshot: Snapshot) -> None:
+        """Mark the gzip file of a snapshot as in use, writing it if needed.
+
+        Every worker touches the file it serves on each refresh, so a file
+        older than a couple of refresh intervals is served by none.
+        """
+        try:
+            os.utime(snapshot.gzip_path)
+        except FileNotFoundError:
+            self.write(snapshot)
+
+    def write(self, snapshot: Snapshot) -> None:
+        """(Re)write the gzip file of a snapshot"""
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f"{snapshot.gzip_path}.{os.getpid()}.tmp"
+        with gzip.open(tmp, "wb", 9) as f:
+            for chunk in stream(snapshot.fragments):
+                f.write(chunk)
+        os.replace(tmp, snapshot.gzip_path)
+
+    def _prune(self, current: str) -> None:
+        def mtime(path: str) -> float:
+            try:
+                return os.path.getmtime(path)
+            except FileNotFoundError:
+                # Pruned by another worker meanwhile
+                return 0.0
+
+        unused = time.time() - 2 * self.refresh_interval
+        snapshots = sorted(
+            (
+                (mtime(path), path)
+                for path in glob.glob(os.path.join(self.directory, "assets-*.xml.gz"))
+            ),
+            reverse=True,
+        )
+        for modified, path in snapshots[KEEP_SNAPSHOTS:]:
+            if path != current and modified < unused:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+
+def get_catalogue() -> Catalogue:
+    app: Flask = current_app._get_current_object()
+
+    if (catalogue := app.extensions.get("stkaddons_catalogue")) is None:
+        with _catalogue_lock:
+            if (catalogue := app.extensions.get("stkaddons_catalogue")) is None:
+                c = app.config
+                catalogue = app.extensions["stkaddons_catalogue"] = Catalogue(
+                    c["CATALOGUE_DIR"] or os.path.join(app.instance_path, "catalogue"),
+                    c["CATALOGUE_FILE_URL"],
+                    c["CATALOGUE_REFRESH_INTERVAL"],
+                )
+
+    return catalogue
+
+
+def _send_gzip(snapshot: Snapshot) -> Response:
+    return send_file(
+        snapshot.gzip_path,
+        mimetype="application/xml",
+        etag=f"{snapshot.etag}-gz",
+        last_modified=snapshot.last_modified,
+    )
+
+
+@bp.get("/assets/")
+def assets():
+    catalogue = get_catalogue()
+    snapshot = catalogue.current()
+
+    if request.accept_encodings["gzip"]:
+        try:
+            response = _send_gzip(snapshot)
+        except FileNotFoundError:
+            # Deleted while this worker did not refresh, e.g. when stopped
+            catalogue.write(snapshot)
+            response = _send_gzip(snapshot)
+        response.content_encoding = "gzip"
+    else:
+        response = Response(stream(snapshot.fragments), mimetype="application/xml")
+        response.content_length = snapshot.size
+        response.set_etag(snapshot.etag)
+        response.last_modified = snapshot.last_modified
+
+    response.cache_control.no_cache = True
+    response.vary.add("Accept-Encoding")
+    return response.make_conditional(request)
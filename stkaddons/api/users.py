@@ -2,12 +2,14 @@ from __future__ import annotations
 
 from flask import Blueprint, current_app, request
 import logging
-from typing import TYPE_CHECKING
-from xml.etree import ElementTree as et
+from typing import TYPE_CHECKING, Optional
 
+from ..admission import limited
+from ..errors import InvalidAchievement
 from ..users import User
 from ..client_session import ClientSession
 from ..util import generic_response, need_client_session
+from .. import xml_response
 
 if TYPE_CHECKING:
     from werkzeug.datastructures import ImmutableMultiDict
@@ -15,21 +17,21 @@ if TYPE_CHECKING:
 bp = Blueprint("api_users", __name__, url_prefix="/user")
 log = logging.getLogger("stkaddons.api.user")
 
+# Achievements the game may report in one request
+MAX_ACHIEVEMENTS = 256
+_ACHIEVEMENT_SEPARATORS = str.maketrans(",", " ")
 
-@bp.post("/register/")
-def register():
-    f: ImmutableMultiDict = request.form
-    scope = "registration"
 
-    if current_app.config.get("DISABLE_REGISTRATION_FROM_STK") == True:
+def check_registration(config, f) -> Optional[tuple[str, int]]:
+    """Validate a registration form from the game client.
+
+    Returns the error message and status code, or None if the form is valid.
+    """
+    if config.get("DISABLE_REGISTRATION_FROM_STK") == True:
         return (
-            generic_response(
-                scope,
-                False,
-                (
-                    "Registration from the game client has been "
-                    "disabled. Please use the website instead."
-                ),
+            (
+                "Registration from the game client has been "
+                "disabled. Please use the website instead."
             ),
             403,
         )
@@ -37,50 +39,72 @@ def register():
     username = f.get("username")
     password = f.get("password")
     password_confirm = f.get("password_confirm")
-    realname = f.get("realname")
     email = f.get("email")
     terms = f.get("terms") == "on"
 
     if not username:
-        return generic_response(scope, False, "Username required"), 400
+        return "Username required", 400
 
     if not password:
-        return generic_response(scope, False, "Password required"), 400
+        return "Password required", 400
 
     try:
         User.check_username(username)
         User.check_password(password)
     except Exception as e:
         log.exception("Validation error")
-        return generic_response(scope, False, str(e)), 400
+        return str(e), 400
 
     if not password_confirm or password != password_confirm:
-        return generic_response(scope, False, "Passwords don't match"), 400
+        return "Passwords don't match", 400
 
     if not email:
-        return generic_response(scope, False, "Email required"), 400
+        return "Email required", 400
 
     try:
         User.check_email(email)
     except Exception as e:
-        return generic_response(scope, False, str(e)), 400
+        return str(e), 400
 
     if not terms:
-        return (
-            generic_response(scope, False, "You must agree to the terms to register"),
-            400,
-        )
+        return "You must agree to the terms to register", 400
+
+    return None
+
+
+def parse_achievements(value: Optional[str]) -> list[int]:
+    """Parse a list of achievement ids separated by spaces or commas"""
+    try:
+        ids = [int(x) for x in (value or "").translate(_ACHIEVEMENT_SEPARATORS).split()]
+    except ValueError:
+        raise InvalidAchievement
+
+    if not ids or len(ids) > MAX_ACHIEVEMENTS or min(ids) < 0 or max(ids) >= 2**31:
+        raise InvalidAchievement
 
-    User.register(username, password, email, realname)
+    return ids
+
+
+@bp.post("/register/")
+@limited("api_register")
+def register():
+    f: ImmutableMultiDict = request.form
+    scope = "registration"
+
+    if error := check_registration(current_app.config, f):
+        return generic_response(scope, False, error[0]), error[1]
+
+    User.register(f["username"], f["password"], f["email"], f.get("realname"))
 
     return generic_response(scope)
 
 
 @bp.post("/connect/")
+@limited("connect")
 def login():
     f: ImmutableMultiDict = request.form
     session = ClientSession.create(f.get("username"), f.get("password"))
-    e = et.Element(
+    return xml_response.element(
         "connect",
         {
             "success": "yes",
@@ -88,16 +112,15 @@ def login():
             "username": session.user.username,
             "realname": session.user.realname,
             "userid": str(session.user.id),
-            "achieved": " ".join(session.user.achievements),
+            "achieved": session.user.achieved,
         },
     )
-    return et.tostring(e)
 
 
 @bp.post("/saved-session/")
 @need_client_session
 def saved_session(session: ClientSession):
-    e = et.Element(
+    return xml_response.element(
         "saved-session",
         {
             "success": "yes",
@@ -105,10 +128,17 @@ def saved_session(session: ClientSession):
             "username": session.user.username,
             "realname": session.user.realname,
             "userid": str(session.user.id),
-            "achieved": " ".join(session.user.achievements),
+            "achieved": session.user.achieved,
         },
     )
-    return et.tostring(e)
+
+
+@bp.post("/achieving/")
+@need_client_session
+def achieving(session: ClientSession):
+    """Record one or more achievements unlocked in the game"""
+    session.user.add_achievements(parse_achievements(request.form.get("achievementid")))
+    return generic_response("achieving")
 
 
 @bp.post("/poll/")
@@ -3,10 +3,25 @@ from flask_mail import Mail
 import logging
 import os
 
+from . import activity
+from . import admission
+from . import assets
+from . import captcha
 from . import database as db_handler
+from . import downloads
+from . import importer
+from . import mailer
+from . import metrics
+from . import migrations
+from . import page_cache
+from . import passwords
+from . import profiling
+from . import session_cache
+from . import sweeper
+from . import users
 
 
-def create_app():
+def create_app(test_config: dict = None):
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         SECRET_KEY="Umamusume",
@@ -16,9 +31,88 @@ def create_app():
         DB_USER=None,
         DB_PASS=None,
         DB_PASSWORD=None,
+        DB_POOL_MIN_SIZE=1,
+        DB_POOL_MAX_SIZE=10,
+        DB_POOL_TIMEOUT=10.0,
+        DB_POOL_IDLE_TIMEOUT=300.0,
+        DB_POOL_CHECK_INTERVAL=30.0,
+        DB_REPLICAS=[],
+        DB_REPLICA_TIMEOUT=1.0,
+        DB_REPLICA_EJECT_TIME=30.0,
+        ASYNC_DB_POOL_MIN_SIZE=1,
+        ASYNC_DB_POOL_MAX_SIZE=20,
+        SESSION_CACHE_SIZE=10000,
+        SESSION_CACHE_TTL=60.0,
+        SESSION_CACHE_BACKEND="local",
+        SESSION_CACHE_PATH=None,
+        SESSION_CACHE_NOTIFY=True,
+        ACTIVITY_FLUSH_INTERVAL=5.0,
+        ACTIVITY_MAX_STALENESS=60.0,
+        PASSWORD_HASH_METHOD="scrypt:32768:8:1",
+        PASSWORD_HASH_WORKERS=2,
+        PASSWORD_HASH_QUEUE_LIMIT=32,
+        PASSWORD_HASH_TIMEOUT=10.0,
+        MAIL_OUTBOX_THREAD=True,
+        MAIL_OUTBOX_BATCH_SIZE=50,
+        MAIL_OUTBOX_INTERVAL=10.0,
+        MAIL_OUTBOX_MAX_ATTEMPTS=8,
+        MAIL_OUTBOX_BACKOFF=30.0,
+        RATE_LIMITS={
+            "connect": {"concurrency": 32, "ip": (30, 60.0), "username": (10, 60.0)},
+            "register": {"concurrency": 8, "ip": (5, 3600.0)},
+            "api_register": {"concurrency": 8, "ip": (5, 3600.0)},
+        },
+        RATE_LIMIT_BACKEND="shared",
+        RATE_LIMIT_PATH=None,
+        RATE_LIMIT_SLOTS=65536,
+        RATE_LIMIT_WORKERS=64,
+        RECAPTCHA_VERIFIER="recaptcha",
+        RECAPTCHA_URL="https://www.google.com/recaptcha/api/siteverify",
+        RECAPTCHA_CONNECT_TIMEOUT=3.05,
+        RECAPTCHA_READ_TIMEOUT=5.0,
+        RECAPTCHA_POOL_SIZE=10,
+        RECAPTCHA_FAILURE_THRESHOLD=5,
+        RECAPTCHA_RESET_TIMEOUT=30.0,
+        METRICS_ENDPOINT="/metrics",
+        METRICS_TOKEN=None,
+        # Behind a proxy on the same host every client looks local
+        METRICS_ALLOW_FROM=[],
+        METRICS_DIR=None,
+        METRICS_FLUSH_INTERVAL=5.0,
+        PROFILE_SAMPLE_RATE=0.0,
+        PROFILE_SECRET=None,
+        PROFILE_HEADER="X-STK-Profile",
+        PROFILE_DIR=None,
+        PROFILE_KEEP=200,
+        PROFILE_WINDOW=3600.0,
+        JINJA_BYTECODE_CACHE=True,
+        JINJA_BYTECODE_CACHE_DIR=None,
+        PAGE_CACHE_SIZE=128,
+        ASSETS_BUILD_DIR=None,
+        ASSETS_SASS_SOURCE=None,
+        ASSETS_SASS_COMMAND=["sass", "--style=compressed", "--no-source-map"],
+        ASSETS_MAX_AGE=365 * 24 * 3600,
+        CATALOGUE_DIR=None,
+        CATALOGUE_FILE_URL="/dl/{file}",
+        CATALOGUE_REFRESH_INTERVAL=30.0,
+        DOWNLOADS_DIR=None,
+        DOWNLOADS_OFFLOAD=None,
+        DOWNLOADS_ACCEL_PREFIX="/internal/packages/",
+        DOWNLOADS_MAX_AGE=24 * 3600,
+        DOWNLOADS_FLUSH_INTERVAL=10.0,
+        SQL_STATS_ENABLED=True,
+        SQL_SLOW_QUERY_MS=200,
+        SQL_REPEAT_WARN=3,
+        SESSION_TTL=30 * 24 * 3600,
+        VERIFICATION_TTL=7 * 24 * 3600,
+        SWEEPER_INTERVAL=0,
+        SWEEPER_BATCH_SIZE=1000,
         VERSION="0.1 - Special Week",
     )
-    app.config.from_pyfile("config.py", True)
+    if test_config is None:
+        app.config.from_pyfile("config.py", True)
+    else:
+        app.config.from_mapping(test_config)
     os.makedirs(app.instance_path, exist_ok=True)
 
     logging.basicConfig(
@@ -31,7 +125,22 @@ def create_app():
     mail = Mail()
 
     mail.init_app(app)
+    metrics.init_app(app)
+    profiling.init_app(app)
+    page_cache.init_app(app)
+    assets.init_app(app)
     db_handler.init_app(app)
+    session_cache.init_app(app)
+    activity.init_app(app)
+    downloads.init_app(app)
+    passwords.init_app(app)
+    admission.init_app(app)
+    captcha.init_app(app)
+    mailer.init_app(app)
+    users.init_app(app)
+    migrations.init_app(app)
+    importer.init_app(app)
+    sweeper.init_app(app)
 
     from .api import bp as api
     from .resources import bp as resources
@@ -39,6 +148,7 @@ def create_app():
     from .routes.register import bp as register
 
     app.register_blueprint(api)
+    app.register_blueprint(downloads.bp)
     app.register_blueprint(resources)
     app.register_blueprint(index)
     app.register_blueprint(register)
@@ -0,0 +1,495 @@
+from __future__ import annotations
+
+import asyncio
+import asyncpg
+import datetime
+from flask import render_template
+import logging
+import time
+from typing import TYPE_CHECKING, Optional
+from urllib.parse import parse_qs
+
+from .api.users import check_registration, parse_achievements
+from .client_session import ClientSession
+from .errors import (
+    DatabaseError,
+    EmailTaken,
+    InvalidCredentials,
+    InvalidSession,
+    RateLimited,
+    ServerBusy,
+    UserException,
+    UserNotFound,
+    UsernameTaken,
+)
+from . import session_cache
+from .users import ADD_ACHIEVEMENTS_QUERY, User
+from . import util
+from . import xml_response
+
+if TYPE_CHECKING:
+    from flask import Flask
+
+log = logging.getLogger("stkaddons.asgi")
+
+MAX_BODY = 64 * 1024
+
+
+class Request:
+    __slots__ = ("method", "path", "headers", "form", "remote_addr")
+
+    def __init__(
+        self, method: str, path: str, headers: dict, form: dict, remote_addr: str
+    ):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.form = form
+        self.remote_addr = remote_addr
+
+
+class AsyncApi:
+    """ASGI application serving the STK client API from an asyncpg pool.
+
+    Configuration, templates, the password hasher, the session cache, the
+    activity buffer and the mail outbox are shared with the Flask app, so
+    both give the same responses and can serve the same database.
+    """
+
+    def __init__(self, flask_app: Flask, fallback=None):
+        self.flask_app = flask_app
+        self.config = flask_app.config
+        self.fallback = fallback
+        self.pool: Optional[asyncpg.Pool] = None
+        self._pool_lock = asyncio.Lock()
+
+        self.routes = {
+            "/api/v2/version/": (("GET", "POST"), self.version),
+            "/api/v2/user/register/": (("POST",), self.register),
+            "/api/v2/user/connect/": (("POST",), self.connect),
+            "/api/v2/user/saved-session/": (("POST",), self.saved_session),
+            "/api/v2/user/achieving/": (("POST",), self.achieving),
+            "/api/v2/user/poll/": (("POST",), self.poll),
+            "/api/v2/user/disconnect/": (("POST",), self.disconnect),
+        }
+
+    @property
+    def metrics(self):
+        return self.flask_app.extensions["stkaddons_metrics"]
+
+    @property
+    def session_cache(self):
+        return self.flask_app.extensions.get("stkaddons_session_cache")
+
+    async def startup(self) -> None:
+        async with self._pool_lock:
+            if self.pool is None:
+                self.pool = await self._create_pool()
+
+        if listener := self.flask_app.extensions.get("stkaddons_session_listener"):
+            listener.ensure_started()
+
+        if self.config["MAIL_OUTBOX_THREAD"]:
+            self.flask_app.extensions["stkaddons_mailer"].start()
+
+    def _create_pool(self):
+        c = self.config
+        return asyncpg.create_pool(
+            database=c["DB_NAME"],
+            user=c["DB_USER"],
+            password=c["DB_PASS"],
+            host=c["DB_HOST"],
+            port=c["DB_PORT"],
+            min_size=c["ASYNC_DB_POOL_MIN_SIZE"],
+            max_size=c["ASYNC_DB_POOL_MAX_SIZE"],
+            max_inactive_connection_lifetime=c["DB_POOL_IDLE_TIMEOUT"],
+        )
+
+    async def shutdown(self) -> None:
+        if self.pool is not None:
+            await self.pool.close()
+
+        # The flush writes through the blocking connection pool
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.flask_app.extensions["stkaddons_activity"].flush
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+
+        if scope["type"] != "http":
+            return
+
+        route = self.routes.get(scope["path"])
+
+        if route is None:
+            if self.fallback is not None:
+                return await self.fallback(scope, receive, send)
+            return await self._send(send, 404, b"Not Found", "text/plain")
+
+        methods, handler = route
+        if scope["method"] not in methods:
+            return await self._send(send, 405, b"Method Not Allowed", "text/plain")
+
+        if self.pool is None:
+            # ASGI servers without lifespan support
+            await self.startup()
+
+        body = await self._read_body(receive)
+        if body is None:
+            return await self._send(send, 413, b"Payload Too Large", "text/plain")
+
+        headers = {
+            k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]
+        }
+        form = {}
+        if headers.get("content-type", "").startswith(
+            "application/x-www-form-urlencoded"
+        ):
+            # Like request.form.get, the first of repeated fields wins
+            form = {
+                k: v[0]
+                for k, v in parse_qs(
+                    body.decode("utf-8", "replace"), keep_blank_values=True
+                ).items()
+            }
+
+        client = scope.get("client")
+        request = Request(
+            scope["method"],
+            scope["path"],
+            headers,
+            form,
+            client[0] if client else None,
+        )
+
+        start = time.perf_counter()
+        try:
+            result = await handler(request)
+        except Exception as e:
+            self.metrics.inc("api_errors_total", (("type", type(e).__name__),))
+
+            if isinstance(e, UserException):
+                result = util.generic_response(success=False, info=str(e))
+            elif isinstance(e, RateLimited):
+                result = util.generic_response(success=False, info=str(e)), 429
+            elif isinstance(e, ServerBusy):
+                result = util.generic_response(success=False, info=str(e)), 503
+            else:
+                log.exception("Unhandled exception in request")
+                result = util.generic_response(
+                    success=False, info=f"Exception Error: {str(e)}"
+                )
+
+        status = 200
+        if isinstance(result, tuple):
+            result, status = result
+
+        endpoint = (("endpoint", f"asgi.{handler.__name__}"),)
+        self.metrics.observe(
+            "http_request_duration_seconds", time.perf_counter() - start, endpoint
+        )
+        self.metrics.inc("http_requests_total", endpoint + (("status", status),))
+
+        await self._send(send, status, result, "application/xml")
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    log.exception("Unable to start the async API")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _read_body(self, receive) -> Optional[bytes]:
+        chunks = []
+        size = 0
+
+        while True:
+            message = await receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > MAX_BODY:
+                return None
+            chunks.append(chunk)
+
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    async def _send(self, send, status: int, body: bytes, content_type: str) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", content_type.encode()),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def _get_session(self, request: Request) -> ClientSession:
+        """Async counterpart of ClientSession.get"""
+        id = int(request.form["userid"])
+        token = request.form["token"]
+        cache = self.session_cache
+
+        if cache is not None:
+            if session := cache.get(id, token):
+                return session
+
+        read_at = time.time()
+        row = await self.pool.fetchrow(
+            """
+            SELECT u.* FROM sessions s JOIN users u ON u.id = s.id
+            WHERE s.token_hash = $1 AND s.id = $2
+            """,
+            util.hash_token(token),
+            id,
+        )
+
+        if row is None:
+            if await self.pool.fetchval("SELECT 1 FROM users WHERE id = $1", id):
+                raise InvalidSession
+            raise UserNotFound
+
+        session = ClientSession(token, User(*row))
+
+        if cache is not None:
+            cache.put(session, read_at)
+
+        return session
+
+    def _session_response(self, scope: str, session: ClientSession) -> bytes:
+        user = session.user
+        return xml_response.element(
+            scope,
+            {
+                "success": "yes",
+                "token": session.session_id,
+                "username": user.username,
+                "realname": user.realname,
+                "userid": str(user.id),
+                "achieved": user.achieved,
+            },
+        )
+
+    async def version(self, request: Request):
+        return xml_response.constant(
+            "api",
+            (("success", "yes"), ("version", self.config["VERSION"]), ("info", "")),
+        )
+
+    def _admit(self, name: str, request: Request):
+        return self.flask_app.extensions["stkaddons_admission"].admit(
+            name, request.remote_addr, request.form.get("username")
+        )
+
+    async def connect(self, request: Request):
+        with self._admit("connect", request):
+            return await self._connect(request)
+
+    async def _connect(self, request: Request):
+        username = request.form.get("username")
+        password = request.form.get("password")
+
+        if not username or not password:
+            raise InvalidCredentials
+
+        row = await self.pool.fetchrow(
+            "SELECT * FROM users WHERE lower(username) = lower($1)", username
+        )
+        if row is None:
+            raise InvalidCredentials
+
+        user = User(*row)
+        hasher = self.flask_app.extensions["stkaddons_passwords"]
+
+        if not await hasher.verify_async(user.password, password):
+            raise InvalidCredentials
+
+        new_hash = None
+        if hasher.needs_rehash(user.password):
+            try:
+                new_hash = await hasher.hash_async(password)
+            except ServerBusy:
+                pass
+
+        token = util.random_string()
+        now = datetime.datetime.now()
+
+        await self.pool.execute(
+            """
+            WITH s AS (
+                INSERT INTO sessions (id, token_hash, user_agent)
+                VALUES ($1, $2, $3)
+            )
+            UPDATE users
+            SET date_login = $4, password = COALESCE($5, password)
+            WHERE id = $1
+            """,
+            user.id,
+            util.hash_token(token),
+            request.headers.get("user-agent", ""),
+            now,
+            new_hash,
+        )
+
+        user.date_login = now
+        if new_hash is not None:
+            user.password = new_hash
+
+        return self._session_response("connect", ClientSession(token, user))
+
+    async def saved_session(self, request: Request):
+        session = await self._get_session(request)
+        return self._session_response("saved-session", session)
+
+    async def achieving(self, request: Request):
+        session = await self._get_session(request)
+        user = session.user
+        ids = parse_achievements(request.form.get("achievementid"))
+        ids = sorted(set(ids) - set(user.achievements))
+
+        if ids:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    achievements = await conn.fetchval(
+                        ADD_ACHIEVEMENTS_QUERY.format(ids="$1", id="$2"), ids, user.id
+                    )
+                    await conn.execute(
+                        "SELECT pg_notify($1, $2)",
+                        session_cache.CHANNEL,
+                        session_cache.payload(user.id),
+                    )
+
+            if achievements is not None:
+                user.achievements = achievements
+
+            if cache := self.session_cache:
+                cache.invalidate_user(user.id)
+
+        return util.generic_response("achieving")
+
+    async def poll(self, request: Request):
+        session = await self._get_session(request)
+        self.flask_app.extensions["stkaddons_activity"].record(session.token_hash)
+        return util.generic_response("poll")
+
+    async def disconnect(self, request: Request):
+        session = await self._get_session(request)
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    "DELETE FROM sessions WHERE token_hash = $1", session.token_hash
+                )
+                await conn.execute(
+                    "SELECT pg_notify($1, $2)",
+                    session_cache.CHANNEL,
+                    session_cache.payload(session.user.id, session.token_hash),
+                )
+
+        self.flask_app.extensions["stkaddons_activity"].forget(session.token_hash)
+        if cache := self.session_cache:
+            cache.invalidate(session.user.id, session.token_hash)
+
+        return util.generic_response("disconnect")
+
+    async def register(self, request: Request):
+        with self._admit("api_register", request):
+            return await self._register(request)
+
+    def _render_verification(self, f: dict, code: str) -> str:
+        """Render the verification mail; runs in the default executor"""
+        with self.flask_app.app_context():
+            return render_template(
+                "mail/new_account.html",
+                user={"username": f["username"], "realname": f.get("realname")},
+                code=code,
+            )
+
+    async def _register(self, request: Request):
+        f = request.form
+        scope = "registration"
+
+        if error := check_registration(self.config, f):
+            return util.generic_response(scope, False, error[0]), error[1]
+
+        hasher = self.flask_app.extensions["stkaddons_passwords"]
+        password_hash = await hasher.hash_async(f["password"])
+        code = util.random_string(50)
+
+        html = await asyncio.get_running_loop().run_in_executor(
+            None, self._render_verification, f, code
+        )
+
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    id = await conn.fetchval(
+                        """
+                        INSERT INTO users (username, password, realname, email)
+                        VALUES ($1, $2, $3, $4)
+                        RETURNING id
+                        """,
+                        f["username"],
+                        password_hash,
+                        f.get("realname"),
+                        f["email"],
+                    )
+                    await conn.execute(
+                        "INSERT INTO verification VALUES ($1, $2)", id, code
+                    )
+                    await conn.execute(
+                        """
+                        INSERT INTO mail_outbox (recipient, subject, html)
+                        VALUES ($1, $2, $3)
+                        """,
+                        f["email"],
+                        "New SuperTuxKart Account",
+                        html,
+                    )
+        except asyncpg.UniqueViolationError as e:
+            if e.constraint_name == "user_unique_email":
+                raise EmailTaken
+            if e.constraint_name == "user_unique_username":
+                raise UsernameTaken
+
+            raise DatabaseError(
+                "A database error occurred while trying to register"
+            ) from e
+
+        if self.config["MAIL_OUTBOX_THREAD"]:
+            self.flask_app.extensions["stkaddons_mailer"].wake()
+
+        return util.generic_response(scope)
+
+
+def create_asgi_app(flask_app: Flask = None, fallback=None) -> AsyncApi:
+    """Create the ASGI API.
+
+    Requests outside the API are passed to ``fallback`` if given, e.g. the
+    Flask website wrapped in ``asgiref.wsgi.WsgiToAsgi``; otherwise they get
+    a 404 and are expected to be routed elsewhere by the front proxy.
+    Without ``flask_app`` the app of the package is shared.
+    """
+    if flask_app is None:
+        from . import app as flask_app
+
+    return AsyncApi(flask_app, fallback)
+
+
+app = create_asgi_app()
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import click
+from flask import current_app, url_for
+from flask.cli import AppGroup
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+from typing import TYPE_CHECKING
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+if TYPE_CHECKING:
+    from flask import Flask
+
+log = logging.getLogger("stkaddons.assets")
+
+# Only text compresses well enough to be worth a variant
+COMPRESSIBLE = {".css", ".js", ".svg", ".txt", ".json", ".ico"}
+
+# Content-Encoding -> file suffix, in order of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def build_dir(app: Flask) -> str:
+    return app.config["ASSETS_BUILD_DIR"] or os.path.join(app.instance_path, "assets")
+
+
+def _hashed_name(name: str, data: bytes) -> str:
+    root, ext = os.path.splitext(name)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def compile_sass(app: Flask) -> None:
+    """Compile the stylesheet into the static folder.
+
+    The sources use ``@use``, which only Dart Sass understands, so this
+    runs the ``sass`` command rather than libsass.
+    """
+    c = app.config
+    source = c["ASSETS_SASS_SOURCE"] or os.path.join(
+        app.root_path, os.pardir, "sass", "style.scss"
+    )
+    target = os.path.join(app.static_folder, "style.css")
+
+    subprocess.run([*c["ASSETS_SASS_COMMAND"], source, target], check=True)
+
+
+def build(app: Flask) -> dict[str, str]:
+    """Copy the static files under content-hashed names with compressed
+    variants and write the manifest; returns the manifest."""
+    out = build_dir(app)
+    os.makedirs(out, exist_ok=True)
+
+    manifest_path = os.path.join(out, "manifest.json")
+    previous = load_manifest(out)
+    manifest = {}
+
+    for dirpath, _, filenames in os.walk(app.static_folder):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, app.static_folder).replace(os.sep, "/")
+
+            with open(path, "rb") as f:
+                data = f.read()
+
+            hashed = _hashed_name(name, data)
+            manifest[name] = hashed
+            target = os.path.join(out, hashed)
+
+            if os.path.exists(target):
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(path, target)
+
+            if os.path.splitext(name)[1] not in COMPRESSIBLE:
+                continue
+
+            with open(target + ".gz", "wb") as f:
+                f.write(gzip.compress(data, 9, mtime=0))
+
+            if brotli is not None:
+                with open(target + ".br", "wb") as f:
+                    f.write(brotli.compress(data, quality=11))
+
+    # Keep the previous build, pages rendered before a deploy still use it
+    keep = set(manifest.values()) | set(previous.values())
+    for dirpath, _, filenames in os.walk(out):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, out).replace(os.sep, "/")
+            base = name.removesuffix(".gz").removesuffix(".br")
+            if name != "manifest.json" and base not in keep:
+                os.unlink(path)
+
+    tmp = manifest_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, manifest_path)
+
+    return manifest
+
+
+def load_manifest(directory: str) -> dict[str, str]:
+    try:
+        with open(os.path.join(directory, "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def asset_url(name: str) -> str:
+    """URL of a static file, under its hashed name once assets are built"""
+    manifest = current_app.extensions["stkaddons_assets"]
+
+    if hashed := manifest.get(name):
+        return url_for("resources.asset", filename=hashed)
+
+    return url_for("static", filename=name)
+
+
+assets_cli = AppGroup("assets", help="Build static assets.")
+
+
+@assets_cli.command("build")
+@click.option("--no-sass", is_flag=True, help="Use the committed style.css as is.")
+def build_command(no_sass: bool):
+    """Compile the stylesheet and build hashed, compressed assets."""
+    if not no_sass:
+        try:
+            compile_sass(current_app)
+        except FileNotFoundError as e:
+            raise click.ClickException(
+                "The sass command was not found. Install Dart Sass or pass --no-sass."
+            ) from e
+
+    manifest = build(current_app)
+
+    if brotli is None:
+        click.echo("brotli is not installed, only gzip variants were written")
+
+    click.echo(f"Built {len(manifest)} asset(s) into {build_dir(current_app)}")
+
+
+def init_app(app: Flask):
+    # Read once; a new build takes effect when the workers restart
+    app.extensions["stkaddons_assets"] = load_manifest(build_dir(app))
+    app.add_template_global(asset_url)
+    app.cli.add_command(assets_cli)
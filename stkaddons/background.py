@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+log = logging.getLogger("stkaddons.background")
+
+
+class BackgroundThread:
+    """A daemon thread per process, started on first use.
+
+    Workers are forked from a master process that may have used the owner
+    already, and the thread does not survive the fork. ``ensure_started``
+    is cheap once the thread of the current process runs, so it can be
+    called on every use. ``on_start`` runs first in each new process, to
+    drop state inherited from the parent.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        target: Callable[[], None],
+        on_start: Callable[[], None] = None,
+    ):
+        self.name = name
+        self.target = target
+        self.on_start = on_start
+
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self) -> bool:
+        """Start the thread of this process; returns whether it was started"""
+        if self._pid == os.getpid():
+            return False
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return False
+
+            if self.on_start is not None:
+                self.on_start()
+
+            threading.Thread(target=self.target, name=self.name, daemon=True).start()
+            self._pid = os.getpid()
+
+        return True
+
+
+class Flusher(BackgroundThread):
+    """Calls ``flush`` every ``interval`` seconds and once more at exit.
+
+    For write-behind buffers: errors are logged with ``error`` and the
+    buffer is expected to keep what it could not write for the next call.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        flush: Callable[[], object],
+        interval: float,
+        error: str,
+        on_start: Callable[[], None] = None,
+    ):
+        super().__init__(name, self._run, on_start)
+        self.flush = flush
+        self.interval = interval
+        self.error = error
+
+    def ensure_started(self) -> bool:
+        started = super().ensure_started()
+        if started:
+            atexit.register(self.flush_once)
+
+        return started
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.flush_once()
+
+    def flush_once(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            log.exception(self.error)
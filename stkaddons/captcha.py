@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import abc
+from bisect import bisect_left
+from flask import current_app
+import logging
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+import requests
+from requests.adapters import HTTPAdapter
+
+from .errors import CaptchaUnavailable
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from typing import Optional
+    from .metrics import Metrics
+
+log = logging.getLogger("stkaddons.captcha")
+
+# Upper bounds in seconds of the verification latency histogram
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class CircuitBreaker:
+    """Stop calling an upstream after ``threshold`` failures in a row.
+
+    While open, calls fail immediately. After ``reset_timeout`` seconds one
+    trial call is let through; its outcome closes or reopens the circuit.
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._trial:
+                return "half-open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if self._trial or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+
+            self._trial = True
+            return True
+
+    def success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+
+            if self._trial or self._failures >= self.threshold:
+                if self._opened_at is None:
+                    log.warning("Opening the circuit after %d failures", self._failures)
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+
+class Verifier(abc.ABC):
+    """Checks the response token of a captcha challenge.
+
+    ``verify`` returns whether the challenge was solved and raises
+    CaptchaUnavailable if that cannot be determined right now.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self._latency_sum = 0.0
+        self._outcomes: dict[str, int] = {}
+        # set by init_app
+        self.metrics: Optional[Metrics] = None
+
+    @abc.abstractmethod
+    def _check(self, response: str, remote_ip: str = None) -> bool:
+        """Return whether the challenge was solved"""
+
+    def _record(self, outcome: str, elapsed: float = None) -> None:
+        with self._lock:
+            self._outcomes[outcome] = self._outcomes.get(outcome, 0) + 1
+
+            if elapsed is not None:
+                self._buckets[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+                self._latency_sum += elapsed
+
+        if self.metrics and elapsed is not None:
+            self.metrics.observe(
+                "captcha_duration_seconds", elapsed, (("outcome", outcome),)
+            )
+
+    def verify(self, response: str, remote_ip: str = None) -> bool:
+        start = time.perf_counter()
+        try:
+            ok = self._check(response, remote_ip)
+        except CaptchaUnavailable:
+            self._record("unavailable", time.perf_counter() - start)
+            raise
+
+        self._record("passed" if ok else "failed", time.perf_counter() - start)
+        return ok
+
+    def stats(self) -> dict:
+        """Return outcome counts and a cumulative latency histogram"""
+        with self._lock:
+            cumulative = []
+            total = 0
+            for bound, n in zip(LATENCY_BUCKETS + (float("inf"),), self._buckets):
+                total += n
+                cumulative.append((bound, total))
+
+            return {
+                "outcomes": dict(self._outcomes),
+                "latency": {
+                    "buckets": cumulative,
+                    "count": total,
+                    "sum": self._latency_sum,
+                },
+            }
+
+
+class StubVerifier(Verifier):
+    """Offline verifier for tests and development.
+
+    Accepts every response except ``reject``; raises CaptchaUnavailable for
+    ``unavailable`` so both failure paths can be exercised.
+    """
+
+    def __init__(self, reject: str = "reject", unavailable: str = "unavailable"):
+        super().__init__()
+        self.reject = reject
+        self.unavailable = unavailable
+
+    def _check(self, response: str, remote_ip: str = None) -> bool:
+        if response == self.unavailable:
+            raise CaptchaUnavailable
+        return response != self.reject
+
+
+class RecaptchaVerifier(Verifier):
+    """Verifies reCAPTCHA responses against Google's siteverify endpoint.
+
+    Requests go through a per-process ``requests.Session`` so the TLS
+    connection is reused, with strict timeouts and a circuit breaker so an
+    unhealthy upstream costs a failed check instead of a stuck worker.
+    """
+
+    def __init__(
+        self,
+        secret: str,
+        *,
+        url: str = "https://www.google.com/recaptcha/api/siteverify",
+        user_agent: str = None,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 5.0,
+        pool_size: int = 10,
+        breaker: CircuitBreaker = None,
+    ):
+        super().__init__()
+        self.secret = secret
+        self.url = url
+        self.user_agent = user_agent
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+
+        self._session = None
+        self._pid = None
+
+    def _get_session(self) -> requests.Session:
+        # Sessions hold sockets and are not shared across a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=1, pool_maxsize=self.pool_size, max_retries=0
+                    )
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    if self.user_agent:
+                        session.headers["User-Agent"] = self.user_agent
+
+                    self._session = session
+                    self._pid = os.getpid()
+
+        return self._session
+
+    def _check(self, response: str, remote_ip: str = None) -> bool:
+        if not self.breaker.allow():
+            raise CaptchaUnavailable
+
+        data = {"secret": self.secret, "response": response}
+        if remote_ip:
+            data["remoteip"] = remote_ip
+
+        try:
+            r = self._get_session().post(self.url, data=data, timeout=self.timeout)
+            r.raise_for_status()
+            result = r.json()
+        except (requests.RequestException, ValueError) as e:
+            log.warning("reCAPTCHA verification failed: %s", e)
+            self.breaker.failure()
+            raise CaptchaUnavailable from e
+        except Exception:
+            # Still settle the call, or a half-open circuit never closes
+            self.breaker.failure()
+            raise
+
+        self.breaker.success()
+
+        if not result.get("success"):
+            errors = result.get("error-codes", [])
+            if {"invalid-input-secret", "missing-input-secret"} & set(errors):
+                log.error("reCAPTCHA rejected the secret key: %s", errors)
+            else:
+                log.info("Failure verifying challenge: %s", result)
+            return False
+
+        return True
+
+    def stats(self) -> dict:
+        return {**super().stats(), "circuit": self.breaker.state}
+
+
+def get_verifier() -> Verifier:
+    return current_app.extensions["stkaddons_captcha"]
+
+
+def verify(response: str, remote_ip: str = None) -> bool:
+    return get_verifier().verify(response, remote_ip)
+
+
+def init_app(app: Flask):
+    c = app.config
+    verifier = c["RECAPTCHA_VERIFIER"]
+
+    if verifier == "recaptcha":
+        verifier = RecaptchaVerifier(
+            c.get("RECAPTCHA_SECRET_KEY"),
+            url=c["RECAPTCHA_URL"],
+            user_agent=(
+                f"STKAddons-Next ({c['VERSION']}) "
+                "+https://github.com/searinminecraft/stk-addons-next"
+            ),
+            connect_timeout=c["RECAPTCHA_CONNECT_TIMEOUT"],
+            read_timeout=c["RECAPTCHA_READ_TIMEOUT"],
+            pool_size=c["RECAPTCHA_POOL_SIZE"],
+            breaker=CircuitBreaker(
+                c["RECAPTCHA_FAILURE_THRESHOLD"], c["RECAPTCHA_RESET_TIMEOUT"]
+            ),
+        )
+    elif verifier == "stub":
+        verifier = StubVerifier()
+    elif not isinstance(verifier, Verifier):
+        raise ValueError(f"Unknown RECAPTCHA_VERIFIER {verifier!r}")
+
+    verifier.metrics = app.extensions["stkaddons_metrics"]
+    app.extensions["stkaddons_captcha"] = verifier
@@ -1,11 +1,15 @@
 from __future__ import annotations
 from flask import request
 import datetime
+import time
 from typing import TYPE_CHECKING
-from werkzeug.security import check_password_hash
 
-from .database import get_database
-from .errors import InvalidCredentials, InvalidSession, UserNotFound
+from .activity import get_activity_buffer
+from .database import autocommit, get_database, release_database
+from .errors import InvalidCredentials, InvalidSession, ServerBusy, UserNotFound
+from .passwords import get_hasher
+from . import session_cache
+from .session_cache import get_session_cache
 from . import util
 from .users import User
 
@@ -23,76 +27,116 @@ class ClientSession:
         if not username or not password:
             raise InvalidCredentials
 
-        user = User.get_user(username=username)
+        with autocommit(get_database()):
+            user = User.get_for_login(username)
+
+        # Hashing takes long, so no pooled connection is held meanwhile
+        release_database()
 
         if not user:
             raise InvalidCredentials
 
-        check = check_password_hash(user.password, password)
+        hasher = get_hasher()
+
+        check = hasher.verify(user.password, password)
         if not check:
             raise InvalidCredentials
 
-        token_str = util.random_string()
-
-        db = get_database()
-        cur = db.cursor()
+        new_hash = None
+        if hasher.needs_rehash(user.password):
+            try:
+                new_hash = hasher.hash(password)
+            except ServerBusy:
+                pass
 
-        cur.execute(
-            """
-            INSERT INTO sessions (id, token, user_agent)
-            VALUES (%(id)s, %(token)s, %(ua)s)
-            """,
-            {"id": user.id, "token": token_str, "ua": request.user_agent.string},
-        )
-        cur.execute(
-            """
-            UPDATE users SET date_login = %s WHERE id = %s
-            """,
-            (datetime.datetime.now(), user.id),
-        )
-        db.commit()
+        token_str = util.random_string()
+        now = datetime.datetime.now()
+
+        # The session insert and the user update share one statement, so
+        # they apply atomically without an explicit transaction
+        with autocommit(get_database()) as db:
+            db.cursor().execute(
+                """
+                WITH s AS (
+                    INSERT INTO sessions (id, token_hash, user_agent)
+                    VALUES (%(id)s, %(token_hash)s, %(ua)s)
+                )
+                UPDATE users
+                SET date_login = %(now)s,
+                    password = COALESCE(%(password)s, password)
+                WHERE id = %(id)s
+                """,
+                {
+                    "id": user.id,
+                    "token_hash": util.hash_token(token_str),
+                    "ua": request.user_agent.string,
+                    "now": now,
+                    "password": new_hash,
+                },
+            )
+
+        user.date_login = now
+        if new_hash is not None:
+            user.password = new_hash
 
         return cls(token_str, user)
 
     @classmethod
     def get(cls, id: str, token: str) -> ClientSession:
         """Get a session"""
-        user = User.get_user(id=id)
+        cache = get_session_cache()
 
-        if not user:
-            raise UserNotFound
+        if cache is not None:
+            if session := cache.get(int(id), token):
+                return session
 
         db = get_database()
         cur = db.cursor()
+        # Taken before the read, see SharedSessionCache.put
+        read_at = time.time()
 
-        cur.execute("SELECT token FROM sessions WHERE id = %s", (user.id,))
-        data = cur.fetchall()
+        # One probe of the token primary key; the user comes along with it
+        cur.execute(
+            """
+            SELECT u.* FROM sessions s JOIN users u ON u.id = s.id
+            WHERE s.token_hash = %s AND s.id = %s
+            """,
+            (util.hash_token(token), int(id)),
+        )
+        data = cur.fetchone()
 
         if not data:
+            if User.get_user(id=id) is None:
+                raise UserNotFound
             raise InvalidSession
 
-        if token not in [x[0] for x in data]:
-            raise InvalidSession
+        session = cls(token, User._load(data))
+
+        if cache is not None:
+            cache.put(session, read_at)
+
+        return session
 
-        return cls(token, user)
+    @property
+    def token_hash(self) -> bytes:
+        return util.hash_token(self.session_id)
 
     def poll(self):
         """Poll server for activity status and notifications"""
 
-        db = get_database()
-        cur = db.cursor()
-
-        cur.execute(
-            "UPDATE sessions SET last_activity = %s WHERE id = %s",
-            (datetime.datetime.now(), self.user.id),
-        )
-        db.commit()
+        get_activity_buffer().record(self.token_hash)
 
     def destroy(self):
         """Destroy the session, making the token invalid"""
         db = get_database()
         cur = db.cursor()
 
-        cur.execute("DELETE FROM sessions WHERE token = %s", (self.session_id,))
+        cur.execute("DELETE FROM sessions WHERE token_hash = %s", (self.token_hash,))
+        session_cache.publish(cur, self.user.id, self.token_hash)
 
         db.commit()
+
+        get_activity_buffer().forget(self.token_hash)
+
+        if cache := get_session_cache():
+            cache.invalidate(self.user.id, self.token_hash)
@@ -1,38 +1,518 @@
 from __future__ import annotations
 
+from collections import deque
+from contextlib import contextmanager
 from flask import current_app, g
+import logging
+import os
+import threading
+import time
 from typing import TYPE_CHECKING
 import psycopg2
+from psycopg2 import extensions
+
+from .errors import PoolTimeout
+from . import sql_stats
 
 if TYPE_CHECKING:
     from flask import Flask
     from psycopg2._psycopg import connection as Connection
     from typing import Optional
 
+log = logging.getLogger("stkaddons.database")
+
+
+class ConnectionPool:
+    """Thread-safe pool of PostgreSQL connections owned by one worker process.
+
+    Idle connections are kept in LIFO order so the hot ones get reused and
+    the cold ones age out through ``idle_timeout``.
+    """
+
+    def __init__(
+        self,
+        connect_kwargs: dict,
+        *,
+        min_size: int = 1,
+        max_size: int = 10,
+        timeout: float = 10.0,
+        idle_timeout: float = 300.0,
+        check_interval: float = 30.0,
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size")
+
+        self.connect_kwargs = connect_kwargs
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+
+        self._cond = threading.Condition()
+        # (connection, time it was returned to the pool)
+        self._idle: deque[tuple[Connection, float]] = deque()
+        self._in_use = 0
+        self._waiting = 0
+
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._discarded = 0
+
+    def _connect(self) -> Connection:
+        return psycopg2.connect(**self.connect_kwargs)
+
+    @property
+    def size(self) -> int:
+        return self._in_use + len(self._idle)
+
+    def _healthy(self, conn: Connection, idle_since: float) -> bool:
+        """Check a connection before handing it out.
+
+        A round trip is only made for connections that sat idle for longer
+        than ``check_interval``; recently used ones are trusted.
+        """
+        if conn.closed:
+            return False
+
+        if time.monotonic() - idle_since < self.check_interval:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def _discard(self, conn: Connection) -> None:
+        self._discarded += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _prune(self) -> None:
+        """Close connections idle for longer than ``idle_timeout``.
+
+        Must be called with the condition held.
+        """
+        now = time.monotonic()
+        while (
+            len(self._idle)
+            and self.size > self.min_size
+            and now - self._idle[0][1] > self.idle_timeout
+        ):
+            conn, _ = self._idle.popleft()
+            self._discard(conn)
+
+    def getconn(self) -> Connection:
+        """Check out a connection, waiting up to ``timeout`` seconds"""
+        start = time.monotonic()
+        deadline = start + self.timeout
+
+        with self._cond:
+            self._prune()
+            self._waiting += 1
+            try:
+                while True:
+                    if self._idle:
+                        conn, idle_since = self._idle.pop()
+                        self._in_use += 1
+                        break
+
+                    if self.size < self.max_size:
+                        conn, idle_since = None, 0.0
+                        self._in_use += 1
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        if not self._idle and self.size >= self.max_size:
+                            self._timeouts += 1
+                            raise PoolTimeout
+            finally:
+                self._waiting -= 1
+
+        # Connecting and health checks happen outside of the lock so a slow
+        # server does not block every other checkout.
+        try:
+            if conn is not None and not self._healthy(conn, idle_since):
+                log.info("Discarding broken pooled connection")
+                self._discard(conn)
+                conn = None
+
+            if conn is None:
+                conn = self._connect()
+        except BaseException:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - start
+        with self._cond:
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        return conn
+
+    def warm(self) -> None:
+        """Open connections until the pool holds ``min_size`` of them"""
+        while True:
+            with self._cond:
+                if self.size >= self.min_size:
+                    return
+                # Reserve the slot so checkouts meanwhile cannot overshoot
+                self._in_use += 1
+
+            try:
+                conn = self._connect()
+            except psycopg2.Error:
+                with self._cond:
+                    self._in_use -= 1
+                    self._cond.notify()
+                log.warning("Unable to open the minimum pool connections")
+                return
+
+            self.putconn(conn)
+
+    def putconn(self, conn: Connection) -> None:
+        """Return a connection, rolling back anything left uncommitted"""
+        keep = not conn.closed
+
+        if keep:
+            try:
+                status = conn.info.transaction_status
+                if status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                keep = False
+
+        with self._cond:
+            self._in_use -= 1
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._discard(conn)
+            self._cond.notify()
+
+    def closeall(self) -> None:
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                conn.close()
+
+    def stats(self) -> dict:
+        """Return a snapshot of the pool usage counters"""
+        with self._cond:
+            return {
+                "size": self.size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "max_size": self.max_size,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "discarded": self._discarded,
+                "wait_total": self._wait_total,
+                "wait_max": self._wait_max,
+                "wait_avg": (
+                    self._wait_total / self._checkouts if self._checkouts else 0.0
+                ),
+            }
+
+
+class ReplicaSet:
+    """Pools of read replicas, used in round-robin order.
+
+    A replica that cannot be connected to, or whose connection broke during
+    a request, is skipped for ``eject_time`` seconds.
+    """
+
+    def __init__(self, pools: list[ConnectionPool], eject_time: float = 30.0):
+        self.pools = pools
+        self.eject_time = eject_time
+
+        self._lock = threading.Lock()
+        self._next = 0
+        self._ejected_until = [0.0] * len(pools)
+        self.ejections = 0
+
+    def eject(self, index: int) -> None:
+        with self._lock:
+            self._ejected_until[index] = time.monotonic() + self.eject_time
+            self.ejections += 1
+
+        log.warning("Ejecting read replica %d for %.0f seconds", index, self.eject_time)
+
+    def getconn(self) -> Optional[tuple[int, Connection]]:
+        """Check out a connection from the next healthy replica.
+
+        Returns ``(replica index, connection)``, or None if no replica is
+        available and the caller should use the primary.
+        """
+        with self._lock:
+            start = self._next
+            self._next = (start + 1) % len(self.pools)
+
+        for i in range(len(self.pools)):
+            index = (start + i) % len(self.pools)
+            if self._ejected_until[index] > time.monotonic():
+                continue
+
+            try:
+                return index, self.pools[index].getconn()
+            except PoolTimeout:
+                # Busy, not broken
+                continue
+            except psycopg2.OperationalError:
+                log.exception("Unable to connect to read replica %d", index)
+                self.eject(index)
+
+        return None
+
+    def putconn(self, index: int, conn: Connection) -> None:
+        if conn.closed:
+            self.eject(index)
 
-def get_database() -> Connection:
+        self.pools[index].putconn(conn)
 
+    def closeall(self) -> None:
+        for pool in self.pools:
+            pool.closeall()
+
+    def stats(self) -> list[dict]:
+        now = time.monotonic()
+        return [
+            {**pool.stats(), "ejected": self._ejected_until[i] > now}
+            for i, pool in enumerate(self.pools)
+        ]
+
+
+def connect_kwargs(config) -> dict:
+    return dict(
+        dbname=config["DB_NAME"],
+        user=config["DB_USER"],
+        password=config["DB_PASS"],
+        host=config["DB_HOST"],
+        port=config["DB_PORT"],
+    )
+
+
+def replica_kwargs(config, replica) -> dict:
+    """Connection parameters of a replica given as a DSN or a dict.
+
+    A dict only needs the parameters that differ from the primary, e.g.
+    ``{"host": "db-replica-1"}``. Replica sessions are read-only so that a
+    write routed there by mistake fails instead of diverging.
+    """
+    if isinstance(replica, str):
+        kwargs = {"dsn": replica}
+    else:
+        kwargs = {**connect_kwargs(config), **replica}
+
+    kwargs["options"] = "-c default_transaction_read_only=on"
+    return kwargs
+
+
+def _state(app: Flask) -> dict:
+    """Return the pools of the current worker process, creating them if needed.
+
+    Pools are never shared across a fork; a worker forked from a preloaded
+    master builds its own on first use.
+    """
+    state = app.extensions["stkaddons_db"]
+
+    if state["pid"] != os.getpid() or state["pool"] is None:
+        with state["lock"]:
+            if state["pid"] != os.getpid() or state["pool"] is None:
+                c = app.config
+                pool_kwargs = dict(
+                    min_size=c["DB_POOL_MIN_SIZE"],
+                    max_size=c["DB_POOL_MAX_SIZE"],
+                    idle_timeout=c["DB_POOL_IDLE_TIMEOUT"],
+                    check_interval=c["DB_POOL_CHECK_INTERVAL"],
+                )
+
+                state["pool"] = ConnectionPool(
+                    {
+                        **connect_kwargs(c),
+                        "connection_factory": sql_stats.InstrumentedConnection,
+                    },
+                    timeout=c["DB_POOL_TIMEOUT"],
+                    **pool_kwargs,
+                )
+
+                state["replicas"] = None
+                if c["DB_REPLICAS"]:
+                    state["replicas"] = ReplicaSet(
+                        [
+                            ConnectionPool(
+                                {
+                                    **replica_kwargs(c, replica),
+                                    "connection_factory": (
+                                        sql_stats.InstrumentedConnection
+                                    ),
+                                },
+                                timeout=c["DB_REPLICA_TIMEOUT"],
+                                **pool_kwargs,
+                            )
+                            for replica in c["DB_REPLICAS"]
+                        ],
+                        c["DB_REPLICA_EJECT_TIME"],
+                    )
+
+                state["pid"] = os.getpid()
+
+                state["pool"].warm()
+                if state["replicas"]:
+                    for pool in state["replicas"].pools:
+                        pool.warm()
+
+    return state
+
+
+def get_pool(app: Optional[Flask] = None) -> ConnectionPool:
+    """Return the primary connection pool of the current worker process"""
+    return _state(app or current_app._get_current_object())["pool"]
+
+
+def get_replicas(app: Optional[Flask] = None) -> Optional[ReplicaSet]:
+    """Return the read replicas of the current worker process, if configured"""
+    return _state(app or current_app._get_current_object())["replicas"]
+
+
+def pool_stats() -> dict:
+    """Return usage statistics of this worker's connection pools"""
+    stats = get_pool().stats()
+
+    if replicas := get_replicas():
+        stats["replicas"] = replicas.stats()
+
+    return stats
+
+
+def _pool_samples(app: Flask):
+    """Pool metrics of this worker; pools are not created just to report"""
+    state = app.extensions["stkaddons_db"]
+    if state["pid"] != os.getpid():
+        return
+
+    pools = [("primary", state["pool"].stats())]
+    if state["replicas"]:
+        pools += [
+            (f"replica{i}", stats) for i, stats in enumerate(state["replicas"].stats())
+        ]
+
+    for name, stats in pools:
+        pool = (("pool", name),)
+        for kind in ("idle", "in_use"):
+            yield ("db_pool_connections", pool + (("state", kind),)), stats[kind]
+        yield ("db_pool_waiting", pool), stats["waiting"]
+        yield ("db_pool_checkouts_total", pool), stats["checkouts"]
+        yield ("db_pool_timeouts_total", pool), stats["timeouts"]
+        yield ("db_pool_wait_seconds_total", pool), stats["wait_total"]
+
+
+def get_database(readonly: bool = False) -> Connection:
+    """Return the database connection of the current request.
+
+    With ``readonly`` the connection may be one to a read replica, which
+    can lag behind the primary. Once a request has used the primary all of
+    its reads stay there, so they see the request's own writes. Lookups
+    that must see a write made by an earlier request should not pass
+    ``readonly``.
+    """
     if db := g.get("db"):
         return db
 
-    conn: Connection = psycopg2.connect(
-        dbname=current_app.config["DB_NAME"],
-        user=current_app.config["DB_USER"],
-        password=current_app.config["DB_PASS"],
-        host=current_app.config["DB_HOST"],
-        port=current_app.config["DB_PORT"],
-    )
+    if readonly:
+        if replica := g.get("db_replica"):
+            return replica[1]
+
+        if replicas := get_replicas():
+            if replica := replicas.getconn():
+                sql_stats.start(replica[1])
+                g.db_replica = replica
+                return replica[1]
+
+    conn: Connection = get_pool().getconn()
+    sql_stats.start(conn)
 
     g.db = conn
     return conn
 
 
+def release_database() -> None:
+    """Return the primary connection of the request to the pool early.
+
+    Lets a request give up its connection during slow work that needs no
+    database; the next ``get_database`` checks one out again and its
+    statements are reported with the earlier ones. Does nothing while a
+    transaction is open.
+    """
+    db: Optional[Connection] = g.get("db")
+
+    if db is None or db.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+        return
+
+    del g.db
+    # the statistics stay on ``g`` and are reported at teardown even if the
+    # request never checks out another connection
+    db.stats = None
+    get_pool().putconn(db)
+
+
+@contextmanager
+def autocommit(conn: Connection):
+    """Run statements on ``conn`` in autocommit mode.
+
+    Each statement commits on its own, saving the BEGIN and COMMIT round
+    trips. If a transaction is already open the connection is left as is.
+    """
+    if conn.autocommit or (
+        conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE
+    ):
+        yield conn
+        return
+
+    conn.autocommit = True
+    try:
+        yield conn
+    finally:
+        conn.autocommit = False
+
+
 def close_database(exc) -> None:
     db: Optional[Connection] = g.pop("db", None)
 
     if db is not None:
-        db.close()
+        sql_stats.finish(db)
+        get_pool().putconn(db)
+
+    if replica := g.pop("db_replica", None):
+        sql_stats.finish(replica[1])
+        get_replicas().putconn(*replica)
+
+    if stats := g.get("sql_stats"):
+        sql_stats.report(stats)
 
 
 def init_app(app: Flask):
+    sql_stats.init_app(app)
+    app.extensions["stkaddons_db"] = {
+        "pool": None,
+        "replicas": None,
+        "pid": None,
+        "lock": threading.Lock(),
+    }
     app.teardown_appcontext(close_database)
+    app.extensions["stkaddons_metrics"].add_collector(lambda: _pool_samples(app))
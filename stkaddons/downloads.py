@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+from flask import Blueprint, Response, abort, current_app, request, send_from_directory
+import logging
+import mimetypes
+import os
+import threading
+from typing import TYPE_CHECKING
+from urllib.parse import quote
+from psycopg2 import Error as PgError
+from psycopg2.extras import execute_values
+from werkzeug.security import safe_join
+
+from .background import Flusher
+from . import database
+from .errors import DatabaseError
+
+if TYPE_CHECKING:
+    from flask import Flask
+
+bp = Blueprint("downloads", __name__)
+log = logging.getLogger("stkaddons.downloads")
+
+OFFLOAD_MODES = (None, "x-sendfile", "x-accel-redirect")
+
+
+class DownloadCounter:
+    """Write-behind counter for ``addons.downloads``.
+
+    Downloads are counted in memory per package file. A background thread
+    adds the counts of every package in one batched UPDATE each
+    ``interval`` seconds.
+    """
+
+    def __init__(self, app: Flask, interval: float = 10.0):
+        self.app = app
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._pending: dict[str, int] = {}
+        self._thread = Flusher(
+            "downloads-flush",
+            self.flush,
+            interval,
+            "Unable to flush download counts",
+            self._forget_inherited,
+        )
+
+        self.flushes = 0
+        self.downloads_written = 0
+
+    def _forget_inherited(self) -> None:
+        # Anything inherited over a fork belongs to the parent
+        with self._lock:
+            self._pending.clear()
+
+    def record(self, file: str) -> None:
+        """Count one download of a package file"""
+        self._thread.ensure_started()
+
+        with self._lock:
+            self._pending[file] = self._pending.get(file, 0) + 1
+
+    def flush(self) -> int:
+        """Write all pending counts and return the number of rows sent"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+
+        pool = database.get_pool(self.app)
+        conn = None
+        try:
+            conn = pool.getconn()
+            with conn.cursor() as cur:
+                # `updated` is left alone, counting must not change the feed
+                execute_values(
+                    cur,
+                    """
+                    UPDATE addons AS a SET downloads = a.downloads + v.n
+                    FROM (VALUES %s) AS v (file, n)
+                    WHERE a.file = v.file
+                    """,
+                    list(batch.items()),
+                    page_size=1000,
+                )
+            conn.commit()
+        except (PgError, DatabaseError):
+            with self._lock:
+                for file, n in batch.items():
+                    self._pending[file] = self._pending.get(file, 0) + n
+            raise
+        finally:
+            if conn is not None:
+                pool.putconn(conn)
+
+        with self._lock:
+            self.flushes += 1
+            self.downloads_written += sum(batch.values())
+
+        return len(batch)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": sum(self._pending.values()),
+                "flushes": self.flushes,
+                "downloads_written": self.downloads_written,
+            }
+
+
+def get_download_counter() -> DownloadCounter:
+    return current_app.extensions["stkaddons_downloads"]
+
+
+def packages_dir(app: Flask) -> str:
+    return app.config["DOWNLOADS_DIR"] or os.path.join(app.instance_path, "packages")
+
+
+def _from_start() -> bool:
+    """Whether the request reads the package from its first byte.
+
+    A resumed download asks for the rest of the file and is not counted
+    again.
+    """
+    if request.method != "GET":
+        return False
+
+    return request.range is None or request.range.ranges[0][0] == 0
+
+
+def _offload(mode: str, directory: str, file: str) -> Response:
+    path = safe_join(directory, file)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    response = Response(
+        mimetype=mimetypes.guess_type(file)[0] or "application/octet-stream"
+    )
+    if mode == "x-sendfile":
+        response.headers["X-Sendfile"] = os.path.abspath(path)
+    else:
+        prefix = current_app.config["DOWNLOADS_ACCEL_PREFIX"]
+        response.headers["X-Accel-Redirect"] = prefix + quote(file)
+
+    return response
+
+
+@bp.get("/dl/<path:file>")
+def download(file: str):
+    """Serve an addon package.
+
+    By default the file is sent by the WSGI server, with ``sendfile``
+    where it provides ``wsgi.file_wrapper``, and Range and conditional
+    requests are answered here. With DOWNLOADS_OFFLOAD the front proxy
+    is told to send the file itself and handles both.
+    """
+    c = current_app.config
+    directory = packages_dir(current_app)
+    mode = c["DOWNLOADS_OFFLOAD"]
+
+    if mode:
+        response = _offload(mode, directory, file)
+        response.cache_control.max_age = c["DOWNLOADS_MAX_AGE"]
+        counted = _from_start()
+    else:
+        response = send_from_directory(directory, file, max_age=c["DOWNLOADS_MAX_AGE"])
+        counted = response.status_code in (200, 206) and _from_start()
+
+    response.cache_control.public = True
+
+    if counted:
+        get_download_counter().record(file)
+        current_app.extensions["stkaddons_metrics"].inc(
+            "addon_downloads_total", (("mode", mode or "direct"),)
+        )
+
+    return response
+
+
+def init_app(app: Flask):
+    c = app.config
+
+    if c["DOWNLOADS_OFFLOAD"] not in OFFLOAD_MODES:
+        raise ValueError(f"Unknown DOWNLOADS_OFFLOAD {c['DOWNLOADS_OFFLOAD']}")
+
+    app.extensions["stkaddons_downloads"] = DownloadCounter(
+        app, c["DOWNLOADS_FLUSH_INTERVAL"]
+    )
@@ -4,6 +4,36 @@ class DatabaseError(Exception):
     pass
 
 
+class PoolTimeout(DatabaseError):
+    """Raised when no database connection could be checked out in time"""
+
+    def __init__(self):
+        super().__init__("Timed out waiting for a database connection")
+
+
+class ServerBusy(Exception):
+    """Raised when the server is too busy to take on more expensive work"""
+
+    def __init__(self):
+        super().__init__("The server is busy. Please try again later.")
+
+
+class CaptchaUnavailable(Exception):
+    """Raised when a captcha response cannot be verified right now"""
+
+    def __init__(self):
+        super().__init__(
+            "The reCAPTCHA verification is unavailable. Please try again later."
+        )
+
+
+class RateLimited(Exception):
+    """Raised when a request exceeds the admission limits of an endpoint"""
+
+    def __init__(self):
+        super().__init__("Too many requests. Please try again later.")
+
+
 class UserException(Exception):
     """Base class for user-related exceptions"""
 
@@ -80,3 +110,10 @@ class InvalidSession(UserException):
 
     def __init__(self):
         super().__init__("Session not valid. Please sign in.")
+
+
+class InvalidAchievement(UserException):
+    """Raised when a client reports malformed achievement ids"""
+
+    def __init__(self):
+        super().__init__("Invalid achievement ID")
@@ -0,0 +1,344 @@
+from __future__ import annotations
+
+import click
+import csv
+from flask import current_app
+from flask.cli import with_appcontext
+import io
+import itertools
+import logging
+import os
+import psycopg2
+import time
+from typing import TYPE_CHECKING, Iterable, Iterator, Optional
+
+from . import database
+from .errors import UserException
+from .users import User
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from psycopg2._psycopg import connection as Connection, cursor as Cursor
+
+log = logging.getLogger("stkaddons.importer")
+
+# Legacy column -> column of the staging table, in COPY order
+USER_COLUMNS = {
+    "id": "id",
+    "username": "username",
+    "role": "role",
+    "password": "password",
+    "name": "realname",
+    "email": "email",
+    "date_login": "date_login",
+    "date_register": "date_register",
+    "homepage": "homepage",
+    "active": "activated",
+}
+
+ACHIEVEMENT_COLUMNS = {"userid": "id", "achievementid": "achievement_id"}
+
+# MySQL writes unset dates as zeroes
+_NULL_DATES = {"", "0000-00-00", "0000-00-00 00:00:00"}
+
+# Ids go to integer columns
+_MAX_ID = 2**31 - 1
+
+
+def _valid_id(value: Optional[str]) -> bool:
+    # str.isdigit() alone also accepts digits such as "²" that int() and
+    # PostgreSQL refuse, and one bad value would abort the whole COPY
+    return bool(value) and value.isascii() and value.isdigit() and int(value) <= _MAX_ID
+
+
+def _progress(cur: Cursor, source: str) -> int:
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS legacy_import (
+            source text PRIMARY KEY,
+            rows_done bigint NOT NULL,
+            updated timestamptz NOT NULL DEFAULT now()
+        )
+        """)
+    cur.execute("SELECT rows_done FROM legacy_import WHERE source = %s", (source,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def _set_progress(cur: Cursor, source: str, rows_done: int) -> None:
+    cur.execute(
+        """
+        INSERT INTO legacy_import (source, rows_done) VALUES (%s, %s)
+        ON CONFLICT (source) DO UPDATE
+        SET rows_done = excluded.rows_done, updated = now()
+        """,
+        (source, rows_done),
+    )
+
+
+def _chunks(rows: Iterable, size: int) -> Iterator[list]:
+    it = iter(rows)
+    while chunk := list(itertools.islice(it, size)):
+        yield chunk
+
+
+def _copy(cur: Cursor, table: str, columns: Iterable[str], rows: list) -> None:
+    """COPY rows into a table; None is written as NULL"""
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf
+    )
+
+
+def validate_users(rows: list[dict]) -> tuple[list[tuple], list[tuple[dict, str]]]:
+    """Split a batch of legacy users into staging rows and rejected rows.
+
+    Usernames and emails are checked with the rules of the registration
+    form. Duplicates are left to the unique constraints of ``users``.
+    """
+    valid = []
+    rejected = []
+
+    for row in rows:
+        values = {}
+        for source, column in USER_COLUMNS.items():
+            value = (row.get(source) or "").strip()
+            if column.startswith("date_") and value in _NULL_DATES:
+                value = ""
+            values[column] = value or None
+
+        if not _valid_id(values["id"]):
+            rejected.append((row, "Invalid id"))
+            continue
+
+        if not values["password"]:
+            rejected.append((row, "Missing password"))
+            continue
+
+        try:
+            User.check_username(values["username"] or "")
+            User.check_email(values["email"] or "")
+        except UserException as e:
+            rejected.append((row, str(e)))
+            continue
+
+        values["activated"] = values["activated"] in ("1", "t", "true", "yes")
+        valid.append(tuple(values.values()))
+
+    return valid, rejected
+
+
+def validate_achievements(rows: list[dict]) -> tuple[list[tuple], list]:
+    valid = []
+    rejected = []
+
+    for row in rows:
+        values = tuple(
+            (row.get(source) or "").strip() for source in ACHIEVEMENT_COLUMNS
+        )
+        if all(_valid_id(v) for v in values):
+            valid.append(values)
+        else:
+            rejected.append((row, "Invalid achievement"))
+
+    return valid, rejected
+
+
+def _load_users(cur: Cursor, rows: list[tuple]) -> int:
+    cur.execute("TRUNCATE import_users")
+    _copy(cur, "import_users", USER_COLUMNS.values(), rows)
+    # Rows already imported by an interrupted run, and rows clashing with
+    # an existing id, username or email, are skipped
+    cur.execute("""
+        INSERT INTO users (
+            id, username, role_id, password, realname, email,
+            date_login, date_register, homepage, activated
+        )
+        SELECT s.id, s.username, COALESCE(r.id, 1), s.password, s.realname,
+               s.email, s.date_login, COALESCE(s.date_register, now()),
+               s.homepage, s.activated
+        FROM import_users s LEFT JOIN roles r ON lower(r.name) = lower(s.role)
+        ON CONFLICT DO NOTHING
+        """)
+    return cur.rowcount
+
+
+def _load_achievements(cur: Cursor, rows: list[tuple]) -> int:
+    cur.execute("TRUNCATE import_achieved")
+    _copy(cur, "import_achieved", ACHIEVEMENT_COLUMNS.values(), rows)
+    cur.execute("""
+        UPDATE users u SET achievements = ARRAY(
+            SELECT DISTINCT unnest(u.achievements || s.ids) ORDER BY 1
+        )
+        FROM (
+            SELECT id, array_agg(achievement_id) AS ids
+            FROM import_achieved GROUP BY id
+        ) s
+        WHERE u.id = s.id
+        """)
+    return cur.rowcount
+
+
+# kind -> (legacy columns, staging table, validation, merge)
+_KINDS = {
+    "users": (
+        USER_COLUMNS,
+        """
+        CREATE TEMP TABLE IF NOT EXISTS import_users (
+            id integer, username text, role text, password text,
+            realname text, email text, date_login timestamp,
+            date_register timestamp, homepage text, activated boolean
+        )
+        """,
+        validate_users,
+        _load_users,
+    ),
+    "achievements": (
+        ACHIEVEMENT_COLUMNS,
+        """
+        CREATE TEMP TABLE IF NOT EXISTS import_achieved (
+            id integer, achievement_id integer
+        )
+        """,
+        validate_achievements,
+        _load_achievements,
+    ),
+}
+
+
+def import_file(
+    conn: Connection,
+    kind: str,
+    path: str,
+    chunk_size: int = 10000,
+    restart: bool = False,
+    rejects=None,
+) -> Iterator[dict]:
+    """Import a legacy CSV export one chunk at a time.
+
+    Each chunk is validated, COPYed into a staging table and merged in
+    one transaction that also records how many source rows are done, so
+    an interrupted import resumes after the last committed chunk. Yields
+    the running totals after each chunk. Rejected rows are written to the
+    ``rejects`` csv writer, if any.
+    """
+    columns, create, validate, load = _KINDS[kind]
+    # A new export under the same name must not resume where the old one
+    # stopped
+    st = os.stat(path)
+    source = f"{kind}:{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+    with conn.cursor() as cur:
+        done = _progress(cur, source)
+        if restart:
+            done = 0
+        cur.execute(create)
+    conn.commit()
+
+    stats = {"rows": 0, "skipped": done, "loaded": 0, "rejected": 0, "seconds": 0.0}
+    start = time.perf_counter()
+
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        missing = set(columns) - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError(f"{path} lacks the column(s) {', '.join(sorted(missing))}")
+
+        for chunk in _chunks(itertools.islice(reader, done, None), chunk_size):
+            valid, rejected = validate(chunk)
+
+            with conn.cursor() as cur:
+                loaded = load(cur, valid) if valid else 0
+                done += len(chunk)
+                _set_progress(cur, source, done)
+            conn.commit()
+
+            if rejects is not None:
+                for row, reason in rejected:
+                    rejects.writerow([source, reason, *row.values()])
+
+            stats["rows"] += len(chunk)
+            stats["loaded"] += loaded
+            stats["rejected"] += len(rejected)
+            stats["seconds"] = time.perf_counter() - start
+            yield stats
+
+    if kind == "users":
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT setval('users_id_seq', GREATEST(max(id), 1)) FROM users"
+            )
+        conn.commit()
+
+
+@click.command("import-legacy")
+@click.option(
+    "--users",
+    "users_path",
+    type=click.Path(exists=True, dir_okay=False),
+    help="CSV export of the legacy users table.",
+)
+@click.option(
+    "--achievements",
+    "achievements_path",
+    type=click.Path(exists=True, dir_okay=False),
+    help="CSV export of the legacy achieved table.",
+)
+@click.option("--chunk-size", default=10000, help="Rows per COPY and transaction.")
+@click.option("--restart", is_flag=True, help="Ignore the progress of earlier runs.")
+@click.option(
+    "--rejects",
+    type=click.File("a", encoding="utf-8"),
+    help="Append rejected rows and the reason to this CSV file.",
+)
+@with_appcontext
+def import_legacy_command(
+    users_path: str, achievements_path: str, chunk_size: int, restart: bool, rejects
+):
+    """Import accounts from the old stk-addons database.
+
+    Password hashes are kept and no verification mail is sent.
+    """
+    if not users_path and not achievements_path:
+        raise click.UsageError("Pass --users, --achievements or both")
+
+    writer = csv.writer(rejects) if rejects else None
+    conn = psycopg2.connect(**database.connect_kwargs(current_app.config))
+
+    try:
+        for kind, path in (("users", users_path), ("achievements", achievements_path)):
+            if not path:
+                continue
+
+            stats = None
+            try:
+                for stats in import_file(conn, kind, path, chunk_size, restart, writer):
+                    click.echo(
+                        f"{kind}: {stats['skipped'] + stats['rows']} rows, "
+                        f"{stats['loaded']} loaded, {stats['rejected']} rejected, "
+                        f"{stats['rows'] / max(stats['seconds'], 1e-9):.0f} rows/s"
+                    )
+            except ValueError as e:
+                raise click.ClickException(str(e)) from e
+            except psycopg2.Error as e:
+                # Chunks committed so far are kept, a new run resumes after them
+                conn.rollback()
+                raise click.ClickException(f"{kind}: {e}") from e
+
+            if stats is None:
+                click.echo(f"{kind}: nothing left to import")
+                continue
+
+            summary = (
+                f"{kind}: imported {stats['rows']} rows in {stats['seconds']:.1f}s"
+            )
+            if stats["skipped"]:
+                summary += f", {stats['skipped']} done by an earlier run"
+            click.echo(summary)
+    finally:
+        conn.close()
+
+
+def init_app(app: Flask):
+    app.cli.add_command(import_legacy_command)
@@ -0,0 +1,273 @@
+from __future__ import annotations
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from flask_mail import Message
+import logging
+import smtplib
+import threading
+from typing import TYPE_CHECKING
+
+from .background import BackgroundThread
+from . import database
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from psycopg2._psycopg import cursor as Cursor
+
+log = logging.getLogger("stkaddons.mailer")
+
+# Seconds a claimed batch is hidden from other drainers. A worker dying
+# while sending leaves its batch to be sent again after this.
+CLAIM_LEASE = 600
+
+
+def enqueue(cur: Cursor, recipient: str, subject: str, html: str) -> None:
+    """Queue a mail in the outbox.
+
+    The row is written with the given cursor and is only sent once the
+    caller commits, so a rolled back transaction never sends mail.
+    """
+    cur.execute(
+        """
+        INSERT INTO mail_outbox (recipient, subject, html)
+        VALUES (%s, %s, %s)
+        """,
+        (recipient, subject, html),
+    )
+
+
+class OutboxWorker:
+    """Drains ``mail_outbox`` in batches over a single SMTP connection.
+
+    Failed mails are retried with exponential backoff and moved to the
+    ``dead`` state after ``max_attempts``.
+    """
+
+    def __init__(
+        self,
+        app: Flask,
+        batch_size: int = 50,
+        interval: float = 10.0,
+        max_attempts: int = 8,
+        backoff: float = 30.0,
+    ):
+        self.app = app
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = BackgroundThread("mail-outbox", self.run)
+
+        self.sent = 0
+        self.failed = 0
+        self.dead = 0
+
+    def _send_batch(self, rows: list) -> tuple[list, list]:
+        sent, failed = [], []
+
+        try:
+            with self.app.app_context():
+                mail = self.app.extensions["mail"]
+                with mail.connect() as smtp:
+                    for id, recipient, subject, html, _ in rows:
+                        message = Message(
+                            subject=subject, recipients=[recipient], html=html
+                        )
+                        try:
+                            smtp.send(message)
+                            sent.append(id)
+                        except smtplib.SMTPServerDisconnected:
+                            smtp.host = smtp.configure_host()
+                            try:
+                                smtp.send(message)
+                                sent.append(id)
+                            except (smtplib.SMTPException, OSError) as e:
+                                failed.append((id, str(e)))
+                        except (smtplib.SMTPException, OSError) as e:
+                            failed.append((id, str(e)))
+        except (smtplib.SMTPException, OSError) as e:
+            # The connection itself failed; whatever was not sent is retried
+            done = set(sent) | {id for id, _ in failed}
+            failed.extend((row[0], str(e)) for row in rows if row[0] not in done)
+
+        return sent, failed
+
+    def _claim(self, conn) -> list:
+        """Lease a batch of due mails and commit, so no lock is held while
+        they are sent"""
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE mail_outbox
+                SET next_attempt = now() + %s * interval '1 second'
+                WHERE id IN (
+                    SELECT id FROM mail_outbox
+                    WHERE status = 'pending' AND next_attempt <= now()
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, recipient, subject, html, attempts
+                """,
+                (CLAIM_LEASE, self.batch_size),
+            )
+            rows = cur.fetchall()
+
+        conn.commit()
+        return sorted(rows)
+
+    def _record(self, conn, rows: list, sent: list, failed: list) -> int:
+        """Store the outcome of a batch; returns the number of dead mails"""
+        attempts = {row[0]: row[4] for row in rows}
+        dead = 0
+
+        with conn.cursor() as cur:
+            if sent:
+                cur.execute(
+                    """
+                    UPDATE mail_outbox SET status = 'sent', sent_at = now()
+                    WHERE id = ANY(%s)
+                    """,
+                    (sent,),
+                )
+
+            for id, error in failed:
+                tries = attempts[id] + 1
+                if tries >= self.max_attempts:
+                    dead += 1
+                    log.error("Giving up on mail %s: %s", id, error)
+                cur.execute(
+                    """
+                    UPDATE mail_outbox
+                    SET attempts = %(tries)s,
+                        last_error = %(error)s,
+                        status = %(status)s,
+                        next_attempt = now() + %(delay)s * interval '1 second'
+                    WHERE id = %(id)s
+                    """,
+                    {
+                        "id": id,
+                        "tries": tries,
+                        "error": error,
+                        "status": "dead" if tries >= self.max_attempts else "pending",
+                        "delay": self.backoff * 2 ** (tries - 1),
+                    },
+                )
+
+        conn.commit()
+        return dead
+
+    def drain_once(self) -> int:
+        """Send one batch of due mails and return how many rows were handled"""
+        pool = database.get_pool(self.app)
+
+        conn = pool.getconn()
+        try:
+            rows = self._claim(conn)
+        finally:
+            pool.putconn(conn)
+
+        if not rows:
+            return 0
+
+        sent, failed = self._send_batch(rows)
+
+        conn = pool.getconn()
+        try:
+            dead = self._record(conn, rows, sent, failed)
+        finally:
+            pool.putconn(conn)
+
+        with self._lock:
+            self.sent += len(sent)
+            self.failed += len(failed)
+            self.dead += dead
+
+        metrics = self.app.extensions["stkaddons_metrics"]
+        for outcome, n in (
+            ("sent", len(sent)),
+            ("failed", len(failed)),
+            ("dead", dead),
+        ):
+            if n:
+                metrics.inc("mail_messages_total", (("outcome", outcome),), n)
+
+        return len(rows)
+
+    def drain(self) -> int:
+        """Send due mails until the outbox has no full batch left"""
+        total = 0
+        while (count := self.drain_once()) > 0:
+            total += count
+            if count < self.batch_size:
+                break
+
+        return total
+
+    def run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                self.drain()
+            except Exception:
+                log.exception("Unable to drain the mail outbox")
+
+            self._wakeup.wait(self.interval)
+
+    def start(self) -> None:
+        """Start the worker thread of this process if it is not running"""
+        self._thread.ensure_started()
+
+    def wake(self) -> None:
+        """Start the worker thread if needed and make it check the outbox now"""
+        self.start()
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sent": self.sent, "failed": self.failed, "dead": self.dead}
+
+
+def get_worker() -> OutboxWorker:
+    return current_app.extensions["stkaddons_mailer"]
+
+
+def notify() -> None:
+    """Signal that new mail was committed to the outbox"""
+    if current_app.config["MAIL_OUTBOX_THREAD"]:
+        get_worker().wake()
+
+
+@click.command("mail-worker")
+@click.option("--once", is_flag=True, help="Drain the outbox once and exit.")
+@with_appcontext
+def mail_worker_command(once: bool):
+    """Send queued mail from the outbox."""
+    worker = get_worker()
+
+    if once:
+        click.echo(f"Processed {worker.drain()} mail(s)")
+        return
+
+    worker.run()
+
+
+def init_app(app: Flask):
+    app.extensions["stkaddons_mailer"] = OutboxWorker(
+        app,
+        app.config["MAIL_OUTBOX_BATCH_SIZE"],
+        app.config["MAIL_OUTBOX_INTERVAL"],
+        app.config["MAIL_OUTBOX_MAX_ATTEMPTS"],
+        app.config["MAIL_OUTBOX_BACKOFF"],
+    )
+    app.cli.add_command(mail_worker_command)
+
+    if app.config["MAIL_OUTBOX_THREAD"]:
+        # Mail left pending by an earlier process is sent without waiting
+        # for a new registration to wake the worker
+        app.before_request(app.extensions["stkaddons_mailer"].start)
@@ -0,0 +1,473 @@
+from __future__ import annotations
+
+import atexit
+from bisect import bisect_left
+from collections import deque
+import fcntl
+from flask import Response, abort, current_app, g, request
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from typing import TYPE_CHECKING
+import weakref
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from typing import Optional
+
+log = logging.getLogger("stkaddons.metrics")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+# name: (type, help, buckets)
+DEFINITIONS = {
+    "http_requests_total": (
+        "counter",
+        "HTTP responses by endpoint and status code",
+        None,
+    ),
+    "http_request_duration_seconds": (
+        "histogram",
+        "Time to produce a response, by endpoint",
+        LATENCY_BUCKETS,
+    ),
+    "db_request_duration_seconds": (
+        "histogram",
+        "Time spent running SQL statements per request, by endpoint",
+        LATENCY_BUCKETS,
+    ),
+    "db_request_statements": (
+        "histogram",
+        "SQL statements run per request, by endpoint",
+        COUNT_BUCKETS,
+    ),
+    "password_hash_duration_seconds": (
+        "histogram",
+        "Time to hash or verify a password, queueing included",
+        LATENCY_BUCKETS,
+    ),
+    "password_hash_rejected_total": (
+        "counter",
+        "Password operations refused because the hashing queue was full",
+        None,
+    ),
+    "mail_messages_total": (
+        "counter",
+        "Outbox mails by outcome (sent, failed, dead)",
+        None,
+    ),
+    "captcha_duration_seconds": (
+        "histogram",
+        "Time to verify a captcha response, by outcome",
+        LATENCY_BUCKETS,
+    ),
+    "api_errors_total": (
+        "counter",
+        "Errors returned by the client API, by exception type",
+        None,
+    ),
+    "admission_total": (
+        "counter",
+        "Requests admitted or rejected by the admission rules",
+        None,
+    ),
+    "db_pool_connections": (
+        "gauge",
+        "Open connections of the worker pools, by pool and state",
+        None,
+    ),
+    "db_pool_waiting": (
+        "gauge",
+        "Requests waiting for a pooled connection, by pool",
+        None,
+    ),
+    "db_pool_checkouts_total": (
+        "counter",
+        "Connections checked out of the worker pools, by pool",
+        None,
+    ),
+    "db_pool_timeouts_total": (
+        "counter",
+        "Checkouts that timed out waiting for a connection, by pool",
+        None,
+    ),
+    "db_pool_wait_seconds_total": (
+        "counter",
+        "Time spent waiting for a pooled connection, by pool",
+        None,
+    ),
+    "addon_downloads_total": (
+        "counter",
+        "Addon package downloads counted, by serving mode",
+        None,
+    ),
+}
+
+
+def _kind(name: str) -> str:
+    return DEFINITIONS.get(name, ("counter",))[0]
+
+
+def _merge(into: dict, samples) -> None:
+    for key, value in samples:
+        if isinstance(value, list):
+            old = into.get(key)
+            into[key] = value[:] if old is None else [a + b for a, b in zip(old, value)]
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+class _Owner:
+    """Kept in a thread-local; its finalizer reports the thread has ended"""
+
+    __slots__ = ("__weakref__",)
+
+
+class Metrics:
+    """Counters and histograms of one worker process.
+
+    Each thread records into its own shard, so an observation is a few
+    dictionary operations and takes no lock. Shards are summed when the
+    metrics are read, together with the samples of the collectors added
+    with ``add_collector``. The shard of a thread that ended is folded
+    into one total, so servers starting a thread per request do not
+    accumulate them.
+
+    With a ``directory``, every worker writes its totals there every
+    ``flush_interval`` seconds and ``aggregate`` adds up the files of all
+    workers. Totals of workers that exited are folded into one archive
+    file so counters never go backwards.
+    """
+
+    def __init__(self, directory: str = None, flush_interval: float = 5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+
+        self._collectors: list = []
+        self._pid = None
+        self._reset()
+
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        # Whatever the parent recorded is reported by the parent
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shards: dict[int, dict] = {}
+        self._keys = itertools.count()
+        # Keys of the shards of ended threads, and their folded totals
+        self._ended: deque[int] = deque()
+        self._retired: dict = {}
+
+    def _fold(self) -> None:
+        """Move the shards of ended threads into the totals; holds the lock"""
+        while self._ended:
+            shard = self._shards.pop(self._ended.popleft(), None)
+            if shard is not None:
+                _merge(self._retired, shard.items())
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            pass
+
+        shard = self._local.shard = {}
+        owner = self._local.owner = _Owner()
+        with self._lock:
+            self._fold()
+            key = next(self._keys)
+            self._shards[key] = shard
+
+        # The finalizer may run at any point, so it only queues the key
+        weakref.finalize(owner, self._ended.append, key).atexit = False
+
+        if self.directory and self._pid != os.getpid():
+            self._start()
+
+        return shard
+
+    def add_collector(self, fn) -> None:
+        """Add a callable returning ``((name, labels), value)`` samples.
+
+        It is called whenever the metrics are read and reports current
+        values, such as gauges or counters kept elsewhere.
+        """
+        self._collectors.append(fn)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: tuple = ()) -> None:
+        buckets = DEFINITIONS[name][2]
+        shard = self._shard()
+        key = (name, labels)
+
+        h = shard.get(key)
+        if h is None:
+            # one count per bucket, +Inf, then the sum
+            h = shard[key] = [0] * (len(buckets) + 1) + [0.0]
+
+        h[bisect_left(buckets, value)] += 1
+        h[-1] += value
+
+    def collect(self) -> dict:
+        """Return the totals of this process"""
+        with self._lock:
+            self._fold()
+            shards = list(self._shards.values())
+            totals = {}
+            _merge(totals, self._retired.items())
+
+        for shard in shards:
+            # Copying a dict is atomic, iterating one that grows is not
+            _merge(totals, dict(shard).items())
+
+        for fn in self._collectors:
+            try:
+                _merge(totals, fn())
+            except Exception:
+                log.exception("Metrics collector failed")
+
+        return totals
+
+    # Cross-process aggregation
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _load(path: str) -> list:
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return []
+
+        return [((name, tuple(map(tuple, labels))), v) for name, labels, v in data]
+
+    @staticmethod
+    def _save(path: str, totals: dict) -> None:
+        data = [[name, labels, v] for (name, labels), v in totals.items()]
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def _locked(self):
+        fd = os.open(self._path(".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _unlock(self, fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _archive(self, pid: int) -> None:
+        """Fold the file of a worker into the archive; holds the lock"""
+        path = self._path(f"{pid}.json")
+        if not os.path.exists(path):
+            return
+
+        archived = dict(self._load(self._path("archive.json")))
+        # The gauges of a worker that exited no longer hold
+        _merge(
+            archived,
+            (s for s in self._load(path) if _kind(s[0][0]) != "gauge"),
+        )
+        self._save(self._path("archive.json"), archived)
+        os.unlink(path)
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            os.makedirs(self.directory, exist_ok=True)
+            fd = self._locked()
+            try:
+                # A file under our pid is from an earlier process
+                self._archive(os.getpid())
+            finally:
+                self._unlock(fd)
+
+            threading.Thread(
+                target=self._run, name="metrics-flush", daemon=True
+            ).start()
+            self._pid = os.getpid()
+            atexit.register(self.dump)
+
+    def dump(self) -> None:
+        """Write the totals of this process for the other workers to read"""
+        if self._pid != os.getpid():
+            return
+
+        self._save(self._path(f"{os.getpid()}.json"), self.collect())
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.dump()
+            except OSError:
+                log.exception("Unable to write metrics")
+
+    def _workers(self) -> list[int]:
+        """Return the pids of the other workers that wrote their totals"""
+        pids = []
+        for entry in os.scandir(self.directory):
+            name, ext = os.path.splitext(entry.name)
+            if ext == ".json" and name.isdigit() and int(name) != os.getpid():
+                pids.append(int(name))
+
+        return pids
+
+    def aggregate(self) -> dict:
+        """Return the totals of every worker sharing the directory"""
+        if not self.directory:
+            return self.collect()
+
+        os.makedirs(self.directory, exist_ok=True)
+        fd = self._locked()
+        try:
+            for pid in self._workers():
+                if not _alive(pid):
+                    self._archive(pid)
+
+            totals = dict(self._load(self._path("archive.json")))
+            for pid in self._workers():
+                _merge(totals, self._load(self._path(f"{pid}.json")))
+        finally:
+            self._unlock(fd)
+
+        _merge(totals, self.collect().items())
+        return totals
+
+    def render(self, prefix: str = "stkaddons") -> str:
+        """Render the aggregated metrics in the Prometheus text format"""
+        totals = self.aggregate()
+        lines = []
+
+        for name, (kind, help, buckets) in DEFINITIONS.items():
+            samples = sorted(
+                (labels, v) for (n, labels), v in totals.items() if n == name
+            )
+            if not samples:
+                continue
+
+            full = f"{prefix}_{name}"
+            lines.append(f"# HELP {full} {help}")
+            lines.append(f"# TYPE {full} {kind}")
+
+            for labels, value in samples:
+                if kind != "histogram":
+                    lines.append(f"{full}{_labels(labels)} {value}")
+                    continue
+
+                count = 0
+                for bound, n in zip(buckets + ("+Inf",), value[:-1]):
+                    count += n
+                    le = labels + (("le", str(bound)),)
+                    lines.append(f"{full}_bucket{_labels(le)} {count}")
+
+                lines.append(f"{full}_sum{_labels(labels)} {value[-1]}")
+                lines.append(f"{full}_count{_labels(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+
+    def escape(v) -> str:
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+
+def get_metrics(app: Optional[Flask] = None) -> Metrics:
+    app = app or current_app
+    return app.extensions["stkaddons_metrics"]
+
+
+def _before_request() -> None:
+    g.metrics_start = time.perf_counter()
+
+
+def _after_request(response: Response) -> Response:
+    start = g.get("metrics_start")
+    if start is None:
+        return response
+
+    endpoint = request.endpoint or "unmatched"
+    metrics = get_metrics()
+    metrics.observe(
+        "http_request_duration_seconds",
+        time.perf_counter() - start,
+        (("endpoint", endpoint),),
+    )
+    metrics.inc(
+        "http_requests_total",
+        (("endpoint", endpoint), ("status", response.status_code)),
+    )
+    return response
+
+
+def _allowed() -> bool:
+    c = current_app.config
+
+    if token := c["METRICS_TOKEN"]:
+        given = request.headers.get("Authorization", "")
+        if secrets.compare_digest(given.encode(), f"Bearer {token}".encode()):
+            return True
+
+    try:
+        addr = ipaddress.ip_address(request.remote_addr)
+    except ValueError:
+        return False
+
+    return any(addr in ipaddress.ip_network(n) for n in c["METRICS_ALLOW_FROM"])
+
+
+def metrics_view():
+    if not _allowed():
+        abort(404)
+
+    return Response(
+        get_metrics().render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def init_app(app: Flask):
+    c = app.config
+
+    app.extensions["stkaddons_metrics"] = Metrics(
+        c["METRICS_DIR"] or os.path.join(app.instance_path, "metrics"),
+        c["METRICS_FLUSH_INTERVAL"],
+    )
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+    if c["METRICS_ENDPOINT"]:
+        app.add_url_rule(c["METRICS_ENDPOINT"], "metrics", metrics_view)
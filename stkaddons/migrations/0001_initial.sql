@@ -0,0 +1,69 @@
+CREATE TABLE roles (
+    id serial PRIMARY KEY,
+    name text NOT NULL UNIQUE,
+    display_name text
+);
+
+INSERT INTO roles (id, name, display_name) VALUES
+    (1, 'user', 'User'),
+    (2, 'moderator', 'Moderator'),
+    (3, 'admin', 'Administrator');
+SELECT setval('roles_id_seq', 3);
+
+-- The column order matters: users are loaded with SELECT *
+CREATE TABLE users (
+    id serial PRIMARY KEY,
+    username text NOT NULL,
+    role_id integer NOT NULL DEFAULT 1 REFERENCES roles (id),
+    password text NOT NULL,
+    realname text,
+    email text NOT NULL,
+    date_login timestamp,
+    date_register timestamp NOT NULL DEFAULT now(),
+    homepage text,
+    activated boolean NOT NULL DEFAULT false,
+    CONSTRAINT user_unique_email UNIQUE (email)
+);
+
+-- Usernames are unique regardless of case and looked up by lower()
+CREATE UNIQUE INDEX user_unique_username ON users (lower(username));
+
+CREATE TABLE sessions (
+    id integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    token text NOT NULL,
+    user_agent text,
+    last_activity timestamp NOT NULL DEFAULT now(),
+    created timestamp NOT NULL DEFAULT now()
+);
+
+CREATE UNIQUE INDEX sessions_token ON sessions (token);
+CREATE INDEX sessions_user ON sessions (id);
+
+CREATE TABLE verification (
+    id integer PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE,
+    code text NOT NULL
+);
+
+CREATE UNIQUE INDEX verification_code ON verification (code);
+
+CREATE TABLE achieved (
+    id integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    achievement_id integer NOT NULL,
+    PRIMARY KEY (id, achievement_id)
+);
+
+CREATE TABLE mail_outbox (
+    id bigserial PRIMARY KEY,
+    recipient text NOT NULL,
+    subject text NOT NULL,
+    html text NOT NULL,
+    status text NOT NULL DEFAULT 'pending'
+        CHECK (status IN ('pending', 'sent', 'dead')),
+    attempts integer NOT NULL DEFAULT 0,
+    next_attempt timestamptz NOT NULL DEFAULT now(),
+    last_error text,
+    created timestamptz NOT NULL DEFAULT now(),
+    sent_at timestamptz
+);
+
+CREATE INDEX mail_outbox_due ON mail_outbox (next_attempt) WHERE status = 'pending';
@@ -0,0 +1,9 @@
+-- Sessions are identified by the SHA-256 digest of their token; the token
+-- itself is only ever known to the client.
+ALTER TABLE sessions ADD COLUMN token_hash bytea;
+UPDATE sessions SET token_hash = sha256(convert_to(token, 'UTF8'));
+ALTER TABLE sessions ALTER COLUMN token_hash SET NOT NULL;
+
+DROP INDEX sessions_token;
+ALTER TABLE sessions DROP COLUMN token;
+ALTER TABLE sessions ADD CONSTRAINT sessions_pkey PRIMARY KEY (token_hash);
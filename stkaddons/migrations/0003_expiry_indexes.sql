@@ -0,0 +1,5 @@
+-- Lets the sweeper find expired rows without scanning whole tables
+ALTER TABLE verification ADD COLUMN created timestamp NOT NULL DEFAULT now();
+
+CREATE INDEX sessions_last_activity ON sessions (last_activity);
+CREATE INDEX verification_created ON verification (created);
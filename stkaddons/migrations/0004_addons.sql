@@ -0,0 +1,27 @@
+-- Karts, tracks and arenas offered to the game. `updated` is set by the
+-- application whenever a field of the feed changes; the download counter
+-- is deliberately left out so counting does not invalidate the feed.
+CREATE TABLE addons (
+    id text PRIMARY KEY,
+    type text NOT NULL CHECK (type IN ('kart', 'track', 'arena')),
+    name text NOT NULL,
+    uploader integer REFERENCES users (id) ON DELETE SET NULL,
+    designer text,
+    description text,
+    revision integer NOT NULL DEFAULT 1,
+    file text NOT NULL,
+    size bigint NOT NULL,
+    status integer NOT NULL DEFAULT 0,
+    format integer NOT NULL,
+    image text,
+    icon text,
+    min_include_version text,
+    max_include_version text,
+    license text,
+    rating real NOT NULL DEFAULT 0,
+    downloads bigint NOT NULL DEFAULT 0,
+    date timestamp NOT NULL DEFAULT now(),
+    updated timestamp NOT NULL DEFAULT now()
+);
+
+CREATE INDEX addons_updated ON addons (updated);
@@ -0,0 +1,2 @@
+-- Downloads are counted by package file name
+CREATE UNIQUE INDEX addons_file ON addons (file);
@@ -0,0 +1,12 @@
+-- Achievements move into an array on the user row, so they come along
+-- with every query loading a user and are recorded in one UPDATE
+ALTER TABLE users ADD COLUMN achievements integer[] NOT NULL DEFAULT '{}';
+
+UPDATE users u SET achievements = a.ids
+FROM (
+    SELECT id, array_agg(achievement_id ORDER BY achievement_id) AS ids
+    FROM achieved GROUP BY id
+) a
+WHERE u.id = a.id;
+
+DROP TABLE achieved;
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from importlib import resources
+import json
+import logging
+import re
+from typing import TYPE_CHECKING
+import psycopg2
+
+from .. import database
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from psycopg2._psycopg import connection as Connection
+
+log = logging.getLogger("stkaddons.migrations")
+
+MIGRATION_RE = re.compile(r"^(\d{4})_(\w+)\.sql$")
+
+# Any number; keeps two runners from migrating at the same time
+LOCK_ID = 0x53544B41
+
+# Statements on the request path that must be answered from an index.
+# Parameters only need the right type, EXPLAIN does not run the statement.
+HOT_QUERIES = {
+    "user by id": ("SELECT * FROM users WHERE id = %s", (1,)),
+    "user by username": (
+        "SELECT * FROM users WHERE lower(username) = lower(%s)",
+        ("someone",),
+    ),
+    "session": (
+        """
+        SELECT u.* FROM sessions s JOIN users u ON u.id = s.id
+        WHERE s.token_hash = %s AND s.id = %s
+        """,
+        (b"x", 1),
+    ),
+    "session by token": ("DELETE FROM sessions WHERE token_hash = %s", (b"x",)),
+    "session activity": (
+        """
+        UPDATE sessions AS s SET last_activity = v.ts
+        FROM (VALUES ('\\x00'::bytea, now()::timestamp)) AS v (token_hash, ts)
+        WHERE s.token_hash = v.token_hash
+        """,
+        None,
+    ),
+    "verification code": ("SELECT id FROM verification WHERE code = %s", ("x",)),
+    "achievements": (
+        "UPDATE users SET achievements = achievements WHERE id = %s",
+        (1,),
+    ),
+    "idle sessions": (
+        """
+        SELECT token_hash FROM sessions
+        WHERE last_activity < now()::timestamp LIMIT 1000
+        """,
+        None,
+    ),
+    "stale verification codes": (
+        "SELECT id FROM verification WHERE created < now()::timestamp LIMIT 1000",
+        None,
+    ),
+    "addon by file": ("SELECT id FROM addons WHERE file = %s", ("some.zip",)),
+    "changed addons": (
+        "SELECT id FROM addons WHERE updated >= now()::timestamp",
+        None,
+    ),
+    "mail outbox": (
+        """
+        SELECT id FROM mail_outbox
+        WHERE status = 'pending' AND next_attempt <= now()
+        ORDER BY id LIMIT 50
+        """,
+        None,
+    ),
+}
+
+
+def available() -> list[tuple[int, str, str]]:
+    """Return ``(version, name, sql)`` of every migration, in order"""
+    migrations = []
+
+    for entry in resources.files(__name__).iterdir():
+        if m := MIGRATION_RE.match(entry.name):
+            migrations.append((int(m[1]), m[2], entry.read_text("utf-8")))
+
+    migrations.sort()
+    return migrations
+
+
+def _versions(cur) -> set[int]:
+    cur.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+
+def applied(conn: Connection) -> set[int]:
+    """Return the applied migration versions, creating the table if needed"""
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version integer PRIMARY KEY,
+                name text NOT NULL,
+                applied_at timestamptz NOT NULL DEFAULT now()
+            )
+            """)
+        versions = _versions(cur)
+
+    conn.commit()
+    return versions
+
+
+def migrate(conn: Connection, target: int = None) -> list[int]:
+    """Apply pending migrations up to ``target``, each in its own transaction"""
+    done = []
+    already = applied(conn)
+
+    for version, name, sql in available():
+        if target is not None and version > target:
+            break
+
+        if version in already:
+            continue
+
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (LOCK_ID,))
+
+            # Re-read under the lock, another runner may have got here first
+            if version in _versions(cur):
+                conn.commit()
+                continue
+
+            log.info("Applying migration %04d_%s", version, name)
+            try:
+                cur.execute(sql)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    (version, name),
+                )
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+                raise
+
+        done.append(version)
+
+    return done
+
+
+def _seq_scans(plan: dict) -> list[str]:
+    found = []
+    if plan["Node Type"] == "Seq Scan":
+        found.append(plan["Relation Name"])
+
+    for child in plan.get("Plans", ()):
+        found.extend(_seq_scans(child))
+
+    return found
+
+
+def check_plans(conn: Connection) -> dict[str, list[str]]:
+    """EXPLAIN every hot query and return those that scan a whole table.
+
+    Sequential scans are disabled for the check so that tiny development
+    tables do not hide a missing index: the planner only falls back to one
+    when no index can answer the predicate.
+    """
+    failures = {}
+
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL enable_seqscan = off")
+
+        for name, (query, params) in HOT_QUERIES.items():
+            cur.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+
+            if tables := _seq_scans(plan[0]["Plan"]):
+                failures[name] = tables
+
+    conn.rollback()
+    return failures
+
+
+db_cli = AppGroup("db", help="Manage the database schema.")
+
+
+def _connect() -> Connection:
+    return psycopg2.connect(**database.connect_kwargs(current_app.config))
+
+
+@db_cli.command("migrate")
+@click.option("--target", type=int, help="Stop after this migration version.")
+def migrate_command(target: int):
+    """Apply pending schema migrations."""
+    conn = _connect()
+    try:
+        versions = migrate(conn, target)
+    finally:
+        conn.close()
+
+    if versions:
+        click.echo("Applied " + ", ".join(f"{v:04d}" for v in versions))
+    else:
+        click.echo("Schema is up to date")
+
+
+@db_cli.command("status")
+def status_command():
+    """Show applied and pending migrations."""
+    conn = _connect()
+    try:
+        done = applied(conn)
+    finally:
+        conn.close()
+
+    for version, name, _ in available():
+        mark = "applied" if version in done else "pending"
+        click.echo(f"{version:04d}_{name}: {mark}")
+
+
+@db_cli.command("check-plans")
+def check_plans_command():
+    """Fail if a hot query would need a sequential scan."""
+    conn = _connect()
+    try:
+        failures = check_plans(conn)
+    finally:
+        conn.close()
+
+    for name, tables in failures.items():
+        click.echo(f"{name}: sequential scan on {', '.join(tables)}", err=True)
+
+    if failures:
+        raise SystemExit(1)
+
+    click.echo(f"All {len(HOT_QUERIES)} hot queries use an index")
+
+
+def init_app(app: Flask):
+    app.cli.add_command(db_cli)
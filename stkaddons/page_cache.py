@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from flask import Response, current_app, render_template, request, session
+import hashlib
+from jinja2 import FileSystemBytecodeCache
+import os
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from flask import Flask
+
+
+class PageCache:
+    """LRU cache of rendered pages with their ETag"""
+
+    def __init__(self, max_size: int = 128):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple, tuple[str, bytes]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: tuple, body: bytes) -> tuple[str, bytes]:
+        entry = (hashlib.blake2b(body, digest_size=16).hexdigest(), body)
+
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def render_page(template: str, **context) -> Response:
+    """Render a page that looks the same to every visitor.
+
+    The output is rendered once per worker and served with an ETag, so a
+    browser revalidating with If-None-Match gets a 304. Pages carrying
+    flashed messages are rendered as usual and not cached.
+    """
+    cache: PageCache = current_app.extensions.get("stkaddons_page_cache")
+
+    if cache is None or session.get("_flashes"):
+        return Response(render_template(template, **context), mimetype="text/html")
+
+    key = (template, tuple(sorted(context.items())))
+    entry = cache.get(key)
+    if entry is None:
+        entry = cache.put(key, render_template(template, **context).encode())
+
+    etag, body = entry
+    response = Response(body, mimetype="text/html")
+    response.set_etag(etag)
+    # Revalidate every time so a page with flashed messages is never reused
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def init_app(app: Flask):
+    c = app.config
+
+    if c["JINJA_BYTECODE_CACHE"]:
+        directory = c["JINJA_BYTECODE_CACHE_DIR"] or os.path.join(
+            app.instance_path, "jinja_cache"
+        )
+        os.makedirs(directory, exist_ok=True)
+        # Must be set before the Jinja environment is first used
+        app.jinja_options = {
+            **app.jinja_options,
+            "bytecode_cache": FileSystemBytecodeCache(directory),
+        }
+
+    # Templates may change under a reloading development server
+    if c["PAGE_CACHE_SIZE"] > 0 and not (app.debug or c["TEMPLATES_AUTO_RELOAD"]):
+        app.extensions["stkaddons_page_cache"] = PageCache(c["PAGE_CACHE_SIZE"])
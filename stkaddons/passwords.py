@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import Future, ProcessPoolExecutor
+from flask import current_app
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Callable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from .errors import ServerBusy
+
+try:
+    import bcrypt
+except ImportError:
+    bcrypt = None
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from typing import Optional
+    from .metrics import Metrics
+
+log = logging.getLogger("stkaddons.passwords")
+
+# Hashes imported from the old PHP site, made by password_hash()
+LEGACY_PREFIXES = ("$2y$", "$2a$", "$2b$")
+
+
+def _verification(pwhash: str, password: str) -> Optional[tuple[Callable, tuple]]:
+    """Return the library call that checks a password against its hash.
+
+    The pool runs that werkzeug or bcrypt function itself, so its worker
+    processes import those libraries and not this package. None when the
+    hash cannot be checked here.
+    """
+    if pwhash.startswith(LEGACY_PREFIXES):
+        if bcrypt is None:
+            log.error("Install bcrypt to check the passwords of imported accounts")
+            return None
+
+        # PHP's $2y$ is the same algorithm as $2b$, and like PHP only the
+        # first 72 bytes of the password count
+        return bcrypt.checkpw, (password.encode()[:72], b"$2b$" + pwhash[4:].encode())
+
+    return check_password_hash, (pwhash, password)
+
+
+class PasswordHasher:
+    """Runs password hashing and verification in a pool of worker processes.
+
+    At most ``queue_limit`` operations may be queued or running at once;
+    anything beyond that fails fast with ``ServerBusy`` instead of making
+    the request thread wait behind a burst of logins. An operation taking
+    longer than ``timeout`` also raises ``ServerBusy``.
+    """
+
+    def __init__(
+        self,
+        method: str,
+        workers: int = 2,
+        queue_limit: int = 32,
+        timeout: float = 10.0,
+    ):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._prefix: Optional[str] = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+        # set by init_app
+        self.metrics: Optional[Metrics] = None
+
+        self.rejected = 0
+        self._timings: dict[str, list] = {
+            "hash": [0, 0.0, 0.0],
+            "verify": [0, 0.0, 0.0],
+        }
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # spawn so that the children never inherit the threads
+                    # and sockets of a running worker
+                    self._executor = ProcessPoolExecutor(
+                        self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                    self._pid = os.getpid()
+
+        return self._executor
+
+    def _acquire(self) -> None:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            if self.metrics:
+                self.metrics.inc("password_hash_rejected_total")
+            raise ServerBusy
+
+    def _record(self, op: str, elapsed: float) -> None:
+        with self._lock:
+            t = self._timings[op]
+            t[0] += 1
+            t[1] += elapsed
+            t[2] = max(t[2], elapsed)
+
+        if self.metrics:
+            self.metrics.observe(
+                "password_hash_duration_seconds", elapsed, (("op", op),)
+            )
+
+    def _released(self, fn, *args):
+        try:
+            return fn(*args)
+        finally:
+            self._slots.release()
+
+    def _submit(self, fn, *args) -> Future:
+        """Start a job in the pool.
+
+        Its slot is released when the job ends rather than when the caller
+        gives up waiting, so jobs left running after a timeout still count
+        against the queue limit.
+        """
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _run(self, op: str, fn, *args):
+        self._acquire()
+
+        start = time.perf_counter()
+        if self.workers > 0:
+            future = self._submit(fn, *args)
+            try:
+                result = future.result(self.timeout)
+            except TimeoutError as e:
+                # Drop the job if it has not started yet
+                future.cancel()
+                raise ServerBusy from e
+        else:
+            result = self._released(fn, *args)
+
+        self._record(op, time.perf_counter() - start)
+        return result
+
+    async def _run_async(self, op: str, fn, *args):
+        self._acquire()
+
+        start = time.perf_counter()
+        if self.workers > 0:
+            future = asyncio.wrap_future(self._submit(fn, *args))
+        else:
+            future = asyncio.get_running_loop().run_in_executor(
+                None, self._released, fn, *args
+            )
+        try:
+            result = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError as e:
+            raise ServerBusy from e
+
+        self._record(op, time.perf_counter() - start)
+        return result
+
+    def hash(self, password: str) -> str:
+        return self._run("hash", generate_password_hash, password, self.method)
+
+    def verify(self, pwhash: str, password: str) -> bool:
+        if (call := _verification(pwhash, password)) is None:
+            return False
+
+        fn, args = call
+        try:
+            return self._run("verify", fn, *args)
+        except ValueError:
+            # A hash in an unknown format never matches
+            return False
+
+    async def hash_async(self, password: str) -> str:
+        return await self._run_async(
+            "hash", generate_password_hash, password, self.method
+        )
+
+    async def verify_async(self, pwhash: str, password: str) -> bool:
+        if (call := _verification(pwhash, password)) is None:
+            return False
+
+        fn, args = call
+        try:
+            return await self._run_async("verify", fn, *args)
+        except ValueError:
+            return False
+
+    def needs_rehash(self, pwhash: str) -> bool:
+        """Check whether a hash was made with other parameters than configured.
+
+        Always true for legacy hashes, so they are replaced on login.
+        """
+        if self._prefix is None:
+            # The method may omit parameters that the hashes then spell out,
+            # such as "scrypt" for "scrypt:32768:8:1"
+            self._prefix = generate_password_hash("", self.method).split("$", 1)[0]
+
+        return pwhash.split("$", 1)[0] != self._prefix
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "rejected": self.rejected,
+                **{
+                    op: {"count": t[0], "total": t[1], "max": t[2]}
+                    for op, t in self._timings.items()
+                },
+            }
+
+
+def get_hasher() -> PasswordHasher:
+    return current_app.extensions["stkaddons_passwords"]
+
+
+def hash_password(password: str) -> str:
+    return get_hasher().hash(password)
+
+
+def verify_password(pwhash: str, password: str) -> bool:
+    return get_hasher().verify(pwhash, password)
+
+
+def init_app(app: Flask):
+    hasher = PasswordHasher(
+        app.config["PASSWORD_HASH_METHOD"],
+        app.config["PASSWORD_HASH_WORKERS"],
+        app.config["PASSWORD_HASH_QUEUE_LIMIT"],
+        app.config["PASSWORD_HASH_TIMEOUT"],
+    )
+    hasher.metrics = app.extensions["stkaddons_metrics"]
+    app.extensions["stkaddons_passwords"] = hasher
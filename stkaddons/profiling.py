@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import click
+import cProfile
+from flask import current_app, g, request
+from flask.cli import with_appcontext
+import hmac
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from flask import Flask
+
+log = logging.getLogger("stkaddons.profiling")
+
+# Where the time of a request went: category -> (file suffix, functions).
+# The cumulative time of those functions is attributed to the category.
+CATEGORIES = {
+    "sql": ("stkaddons/sql_stats.py", ("execute", "executemany", "copy_expert")),
+    "hash": ("stkaddons/passwords.py", ("_run",)),
+    "render": ("flask/templating.py", ("render_template", "render_template_string")),
+    "captcha": ("stkaddons/captcha.py", ("verify",)),
+}
+
+_UNSAFE_RE = re.compile(r"[^\w.-]")
+
+
+def sign(secret: str, expires: int) -> str:
+    """Return a value for the profiling header that is valid until ``expires``"""
+    digest = hmac.new(secret.encode(), str(expires).encode(), "sha256").hexdigest()
+    return f"{expires}.{digest}"
+
+
+def _valid(secret: str, value: str) -> bool:
+    expires, _, _ = value.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+
+    return hmac.compare_digest(sign(secret, int(expires)), value)
+
+
+def breakdown(stats: pstats.Stats) -> dict[str, float]:
+    """Attribute the time of a profile to the CATEGORIES"""
+    spent = dict.fromkeys(CATEGORIES, 0.0)
+
+    for (filename, _, func), (_, _, _, cumulative, _) in stats.stats.items():
+        for category, (suffix, functions) in CATEGORIES.items():
+            if func in functions and filename.endswith(suffix):
+                spent[category] += cumulative
+
+    return spent
+
+
+class Profiler:
+    """Profiles a sample of requests with cProfile.
+
+    Each profile is written to ``directory`` with a JSON summary next to
+    it. Profiles older than ``window`` seconds are deleted and of the rest
+    only the ``keep`` slowest are kept, so the directory holds a rolling
+    top of the slowest recent requests.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        sample_rate: float = 0.0,
+        secret: str = None,
+        header: str = "X-STK-Profile",
+        keep: int = 200,
+        window: float = 3600.0,
+    ):
+        if keep < 1:
+            raise ValueError("A profiler has to keep at least one profile")
+
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.secret = secret
+        self.header = header
+        self.keep = keep
+        self.window = window
+
+    def forced(self) -> bool:
+        """Whether the request carries a valid profiling header"""
+        if self.secret and (value := request.headers.get(self.header)):
+            if _valid(self.secret, value):
+                return True
+            log.warning("Ignoring an invalid %s header", self.header)
+
+        return False
+
+    def start(self) -> None:
+        forced = self.forced()
+        if not forced and random.random() >= self.sample_rate:
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active in this thread
+            return
+
+        g.profile = (profile, time.perf_counter(), forced)
+
+    def finish(self, exc) -> None:
+        started = g.pop("profile", None)
+        if started is None:
+            return
+
+        profile, start, forced = started
+        profile.disable()
+        duration = time.perf_counter() - start
+
+        try:
+            self._save(profile, duration, forced)
+        except OSError:
+            log.exception("Unable to write a request profile")
+
+    def _save(self, profile: cProfile.Profile, duration: float, forced: bool) -> None:
+        endpoint = request.endpoint or "unmatched"
+        stats = pstats.Stats(profile)
+
+        os.makedirs(self.directory, exist_ok=True)
+        # Names start with the duration, so they sort fastest first
+        name = "{:012d}-{}-{}-{}".format(
+            round(duration * 1e6),
+            int(time.time() * 1000),
+            os.getpid(),
+            _UNSAFE_RE.sub("_", endpoint),
+        )
+        path = os.path.join(self.directory, name)
+
+        summary = {
+            "time": time.time(),
+            "endpoint": endpoint,
+            "method": request.method,
+            "path": request.path,
+            "duration": duration,
+            "breakdown": breakdown(stats),
+            "profile": f"{path}.prof",
+        }
+
+        stats.dump_stats(f"{path}.prof")
+        with open(f"{path}.json", "w") as f:
+            json.dump(summary, f)
+
+        # Whoever asked for this profile is about to look for it
+        self._prune(name if forced else None)
+
+    def _prune(self, protected: str = None) -> None:
+        """Delete the profiles that left the window or the top ``keep``"""
+        cutoff = (time.time() - self.window) * 1000
+        recent = []
+        stale = []
+
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+
+            name = entry.name[: -len(".json")]
+            duration, _, rest = name.partition("-")
+            written, _, _ = rest.partition("-")
+            if not (duration.isdigit() and written.isdigit()):
+                continue
+
+            if int(written) < cutoff:
+                stale.append(name)
+            else:
+                recent.append((int(duration), name))
+
+        recent.sort(reverse=True)
+        stale.extend(name for _, name in recent[self.keep :])
+
+        for name in stale:
+            if name == protected:
+                continue
+
+            for suffix in (".json", ".prof"):
+                try:
+                    os.unlink(os.path.join(self.directory, name + suffix))
+                except FileNotFoundError:
+                    pass
+
+
+def load_summaries(directory: str) -> list[dict]:
+    """Return the summaries of every profile kept in ``directory``"""
+    summaries = []
+    if not os.path.isdir(directory):
+        return summaries
+
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".json"):
+            try:
+                with open(entry.path) as f:
+                    summaries.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+    return summaries
+
+
+def _directory(app: Flask) -> str:
+    return app.config["PROFILE_DIR"] or os.path.join(app.instance_path, "profiles")
+
+
+@click.command("profile-top")
+@click.option("-n", "count", default=20, help="Number of requests to show.")
+@with_appcontext
+def profile_top_command(count: int):
+    """Show the slowest profiled requests of all workers."""
+    summaries = load_summaries(_directory(current_app))
+    summaries.sort(key=lambda s: s["duration"], reverse=True)
+
+    for s in summaries[:count]:
+        parts = ", ".join(
+            f"{category} {seconds * 1000:.1f}"
+            for category, seconds in s["breakdown"].items()
+            if seconds
+        )
+        click.echo(
+            f"{s['duration'] * 1000:8.1f} ms  {s['method']} {s['path']} "
+            f"({s['endpoint']})"
+        )
+        if parts:
+            click.echo(f"             {parts} ms")
+        click.echo(f"             {s['profile']}")
+
+
+@click.command("profile-token")
+@click.option("--ttl", default=3600, help="Seconds the header stays valid.")
+@with_appcontext
+def profile_token_command(ttl: int):
+    """Print a signed header value that forces a request to be profiled."""
+    c = current_app.config
+    if not c["PROFILE_SECRET"]:
+        raise click.ClickException("PROFILE_SECRET is not set")
+
+    click.echo(
+        f"{c['PROFILE_HEADER']}: {sign(c['PROFILE_SECRET'], int(time.time()) + ttl)}"
+    )
+
+
+def init_app(app: Flask):
+    c = app.config
+
+    app.cli.add_command(profile_top_command)
+    app.cli.add_command(profile_token_command)
+
+    if c["PROFILE_SAMPLE_RATE"] <= 0 and not c["PROFILE_SECRET"]:
+        # No hooks at all, so disabled profiling costs nothing
+        return
+
+    profiler = Profiler(
+        _directory(app),
+        c["PROFILE_SAMPLE_RATE"],
+        c["PROFILE_SECRET"],
+        c["PROFILE_HEADER"],
+        c["PROFILE_KEEP"],
+        c["PROFILE_WINDOW"],
+    )
+    app.extensions["stkaddons_profiler"] = profiler
+    app.before_request(profiler.start)
+    app.teardown_request(profiler.finish)
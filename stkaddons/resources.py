@@ -1,13 +1,56 @@
-from flask import Blueprint, redirect
+from flask import Blueprint, current_app, request, send_from_directory
+import mimetypes
+import os
+from werkzeug.security import safe_join
+
+from .assets import ENCODINGS, build_dir
 
 bp = Blueprint("resources", __name__)
 
+# Files requested by browsers and crawlers at fixed URLs
+FIXED_MAX_AGE = 24 * 3600
+
 
 @bp.route("/favicon.ico")
 def favicon():
-    return redirect("/static/icon.png", code=308)
+    return send_from_directory(
+        current_app.static_folder,
+        "icon.png",
+        mimetype="image/png",
+        max_age=FIXED_MAX_AGE,
+    )
 
 
 @bp.route("/robots.txt")
 def robots_file():
-    return redirect("/static/robots.txt", code=308)
+    return send_from_directory(
+        current_app.static_folder, "robots.txt", max_age=FIXED_MAX_AGE
+    )
+
+
+@bp.route("/assets/<path:filename>")
+def asset(filename: str):
+    """Serve a built asset, precompressed if the client accepts it"""
+    directory = build_dir(current_app)
+    max_age = current_app.config["ASSETS_MAX_AGE"]
+
+    for encoding, suffix in ENCODINGS:
+        path = safe_join(directory, filename + suffix)
+        if request.accept_encodings[encoding] and path and os.path.isfile(path):
+            response = send_from_directory(
+                directory,
+                filename + suffix,
+                mimetype=mimetypes.guess_type(filename)[0]
+                or "application/octet-stream",
+                max_age=max_age,
+            )
+            response.content_encoding = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename, max_age=max_age)
+
+    # The name changes with the content, so it never needs revalidating
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add("Accept-Encoding")
+    return response
@@ -1,8 +1,10 @@
-from flask import Blueprint, render_template
+from flask import Blueprint
+
+from ..page_cache import render_page
 
 bp = Blueprint("index", __name__)
 
 
 @bp.route("/")
 def main():
-    return render_template("pages/index.html")
+    return render_page("pages/index.html")
@@ -1,16 +1,24 @@
 from flask import (
     Blueprint,
     abort,
+    current_app,
     flash,
     request,
-    current_app,
     redirect,
     render_template,
 )
 import logging
-import requests
 
-from ..errors import UsernameTaken, EmailTaken
+from ..admission import limited
+from .. import captcha
+from ..page_cache import render_page
+from ..errors import (
+    CaptchaUnavailable,
+    RateLimited,
+    ServerBusy,
+    UsernameTaken,
+    EmailTaken,
+)
 from ..users import User
 from ..database import get_database
 
@@ -18,7 +26,14 @@ bp = Blueprint("register", __name__)
 log = logging.getLogger("stkaddons.routes.register")
 
 
+@bp.errorhandler(RateLimited)
+def rate_limited(e: RateLimited):
+    flash(str(e), "error")
+    return render_template("pages/register/index.html"), 429
+
+
 @bp.route("/register", methods=("GET", "POST"))
+@limited("register")
 def main():
     if request.method == "POST":
         f = request.form
@@ -47,29 +62,12 @@ def main():
             return render_template("pages/register/index.html"), 400
 
         try:
-            r = requests.post(
-                "https://www.google.com/recaptcha/api/siteverify",
-                headers={
-                    "Content-Type": "application/x-www-form-urlencoded",
-                    "User-Agent": f"STKAddons-Next ({current_app.config['VERSION']}) +https://github.com/searinminecraft/stk-addons-next",
-                },
-                data=(
-                    f"secret={current_app.config['RECAPTCHA_SECRET_KEY']}"
-                    f"&response={f['g-recaptcha-response']}"
-                    f"&remoteip={request.remote_addr}"
-                ),
-            )
-
-            json = r.json()
-            if not json["success"]:
-                log.error("Failure verifying challenge: %s", json)
+            if not captcha.verify(f["g-recaptcha-response"], request.remote_addr):
                 flash("Invalid reCAPTCHA response", "error")
                 return render_template("pages/register/index.html"), 400
-        except Exception:
-            log.exception(
-                "Unable to connect to reCAPTCHA. Try again or contact the site administrator."
-            )
-            return render_template("pages/register/index.html"), 500
+        except CaptchaUnavailable as e:
+            flash(str(e), "error")
+            return render_template("pages/register/index.html"), 503
 
         try:
             user = User.register(
@@ -78,6 +76,9 @@ def main():
         except (UsernameTaken, EmailTaken) as e:
             flash(str(e), "error")
             return render_template("pages/register/index.html"), 400
+        except ServerBusy as e:
+            flash(str(e), "error")
+            return render_template("pages/register/index.html"), 503
         except Exception:
             log.exception("Failure creating user account %s", f["username"])
             flash(
@@ -88,7 +89,7 @@ def main():
 
         return render_template("pages/register/activation.html", email=f["email"])
     else:
-        return render_template("pages/register/index.html")
+        return render_page("pages/register/index.html")
 
 
 @bp.route("/confirm_account")
@@ -97,12 +98,25 @@ def confirm_account():
         log.error("User tried to go to confirm_account without code!")
         abort(400)
 
-    db = get_database()
+    code = request.args["code"]
+    # The sweeper only runs now and then, so a code past VERIFICATION_TTL
+    # may still be in the table
+    query = """
+        SELECT id FROM verification
+        WHERE code = %s AND created >= now() - %s * interval '1 second'
+    """
+    ttl = current_app.config["VERIFICATION_TTL"]
+    db = get_database(readonly=True)
     cur = db.cursor()
-
-    cur.execute("SELECT id FROM verification WHERE code = %s", (request.args["code"],))
+    cur.execute(query, (code, ttl))
     data = cur.fetchone()
 
+    if not data and get_database() is not db:
+        # The account may be too new to have reached the replica
+        cur = get_database().cursor()
+        cur.execute(query, (code, ttl))
+        data = cur.fetchone()
+
     if not data:
         abort(400)
 
@@ -110,4 +124,4 @@ def confirm_account():
     user = User.get_user(id=id)
     user.activate_user()
 
-    return render_template("pages/register/success.html")
+    return render_page("pages/register/success.html")
@@ -0,0 +1,366 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from flask import current_app
+import logging
+import os
+import pickle
+import select
+import struct
+import threading
+import time
+from typing import TYPE_CHECKING
+import psycopg2
+from psycopg2 import extensions
+
+from .background import BackgroundThread
+from . import database
+from .shm import SharedTable
+from . import util
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from psycopg2._psycopg import cursor as Cursor
+    from typing import Optional
+    from .client_session import ClientSession
+
+log = logging.getLogger("stkaddons.session_cache")
+
+CHANNEL = "stkaddons_session_cache"
+
+
+class SessionCache:
+    """Bounded LRU cache of validated client sessions with a TTL.
+
+    Entries are keyed by ``(userid, token hash)``. A secondary index by
+    user id lets every session of a user be dropped at once, e.g. on
+    activation or password change. Invalidations are remembered for one
+    TTL, so a session read from the database before one is not cached.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple[int, bytes], tuple[float, ClientSession]] = (
+            OrderedDict()
+        )
+        self._by_user: dict[int, set[bytes]] = {}
+        # (userid,) or (userid, token hash) -> time.time() of the last
+        # invalidation, oldest first
+        self._invalidated: OrderedDict[tuple, float] = OrderedDict()
+        self._cleared_at = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _unlink(self, key: tuple[int, bytes]) -> None:
+        tokens = self._by_user.get(key[0])
+        if tokens is not None:
+            tokens.discard(key[1])
+            if not tokens:
+                del self._by_user[key[0]]
+
+    def get(self, userid: int, token: str) -> Optional[ClientSession]:
+        key = (userid, util.hash_token(token))
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                self._unlink(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _mark(self, key: tuple) -> None:
+        """Remember an invalidation; holds the lock"""
+        now = time.time()
+        self._invalidated[key] = now
+        self._invalidated.move_to_end(key)
+
+        while next(iter(self._invalidated.values())) < now - self.ttl:
+            self._invalidated.popitem(last=False)
+
+    def put(self, session: ClientSession, cached_at: float = None) -> None:
+        """Cache a session read from the database.
+
+        ``cached_at`` is the time.time() taken before that read. The session
+        is not cached if it or its user was invalidated since.
+        """
+        key = (session.user.id, session.token_hash)
+        now = time.time()
+        if cached_at is None:
+            cached_at = now
+
+        with self._lock:
+            # Invalidations are only remembered for one TTL
+            if cached_at <= max(
+                now - self.ttl,
+                self._cleared_at,
+                self._invalidated.get(key[:1], 0.0),
+                self._invalidated.get(key, 0.0),
+            ):
+                return
+
+            expires = time.monotonic() + self.ttl - (now - cached_at)
+            self._entries[key] = (expires, session)
+            self._entries.move_to_end(key)
+            self._by_user.setdefault(key[0], set()).add(key[1])
+
+            while len(self._entries) > self.max_size:
+                old, _ = self._entries.popitem(last=False)
+                self._unlink(old)
+                self.evictions += 1
+
+    def invalidate(self, userid: int, token_hash: bytes) -> None:
+        """Drop a single session"""
+        key = (userid, token_hash)
+
+        with self._lock:
+            self._mark(key)
+            if self._entries.pop(key, None) is not None:
+                self._unlink(key)
+
+    def invalidate_user(self, userid: int) -> None:
+        """Drop every cached session of a user"""
+        with self._lock:
+            self._mark((userid,))
+            for token_hash in self._by_user.pop(userid, ()):
+                self._entries.pop((userid, token_hash), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cleared_at = time.time()
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+_MARKER = struct.Struct("<d")
+
+
+def _cached_fields(user_type) -> list[str]:
+    """User attributes stored in the shared file; never the password hash"""
+    return [name for name in user_type.__slots__ if name != "password"]
+
+
+class SharedSessionCache:
+    """Session cache shared by every worker process of the host.
+
+    Sessions live in a memory-mapped table, so a session validated by one
+    worker is a hit in all others. Invalidating a user stores the time of
+    the invalidation in a second table; entries cached before it are
+    treated as misses. Should a live marker ever be evicted from that
+    table, the whole cache is cleared rather than risk serving a revoked
+    session.
+    """
+
+    def __init__(self, path: str, slots: int = 65536, ttl: float = 60.0):
+        self.ttl = ttl
+        self._sessions = SharedTable(path, slots, 512)
+        self._markers = SharedTable(path + ".users", max(slots // 4, 64), 8)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, userid: int, token: str) -> Optional[ClientSession]:
+        from .client_session import ClientSession
+        from .users import User
+
+        token_hash = util.hash_token(token)
+        data = self._sessions.get(f"{userid}:{token_hash.hex()}")
+
+        if data is None:
+            self._count("misses")
+            return None
+
+        cached_at, state = pickle.loads(data)
+
+        if marker := self._markers.get(str(userid)):
+            if _MARKER.unpack(marker)[0] >= cached_at:
+                self._count("misses")
+                return None
+
+        # The password hash is not cached, nothing reads it off a session
+        user = User(password=None, **dict(zip(_cached_fields(User), state)))
+        self._count("hits")
+        return ClientSession(token, user)
+
+    def put(self, session: ClientSession, cached_at: float = None) -> None:
+        """Cache a session read from the database.
+
+        ``cached_at`` is the time.time() taken before that read, so an
+        invalidation of the user committed meanwhile still hides the entry.
+        """
+        now = time.time()
+        if cached_at is None:
+            cached_at = now
+
+        # The entry must not outlive the markers of invalidations after the
+        # read, which expire ttl seconds after they are written
+        ttl = self.ttl - (now - cached_at)
+        if ttl <= 0:
+            return
+
+        user = session.user
+        state = tuple(getattr(user, name) for name in _cached_fields(type(user)))
+        data = pickle.dumps((cached_at, state), pickle.HIGHEST_PROTOCOL)
+
+        if len(data) > self._sessions.value_size:
+            return
+
+        if self._sessions.put(f"{user.id}:{session.token_hash.hex()}", data, ttl):
+            self._count("evictions")
+
+    def invalidate(self, userid: int, token_hash: bytes) -> None:
+        self._sessions.delete(f"{userid}:{token_hash.hex()}")
+
+    def invalidate_user(self, userid: int) -> None:
+        if self._markers.put(str(userid), _MARKER.pack(time.time()), self.ttl):
+            self._sessions.clear()
+
+    def clear(self) -> None:
+        self._sessions.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def publish(cur: Cursor, userid: int, token_hash: bytes = None) -> None:
+    """Tell every worker to drop a session, or all sessions of a user.
+
+    The notification is part of the caller's transaction and is only
+    delivered once it commits.
+    """
+    cur.execute("SELECT pg_notify(%s, %s)", (CHANNEL, payload(userid, token_hash)))
+
+
+def publish_many(cur: Cursor, payloads: list[str]) -> None:
+    """Publish several ``payload``s in one round trip"""
+    if payloads:
+        cur.execute(
+            "SELECT pg_notify(%s, p) FROM unnest(%s::text[]) AS p", (CHANNEL, payloads)
+        )
+
+
+def payload(userid: int, token_hash: bytes = None) -> str:
+    """Return the notification that drops a session, or all sessions of a user"""
+    return f"s:{userid}:{token_hash.hex()}" if token_hash else f"u:{userid}"
+
+
+class InvalidationListener:
+    """LISTENs for invalidations from other workers and applies them locally"""
+
+    def __init__(self, app: Flask, cache):
+        self.app = app
+        self.cache = cache
+        self._thread = BackgroundThread("session-cache-listener", self._run)
+
+    def ensure_started(self) -> None:
+        self._thread.ensure_started()
+
+    def _apply(self, payload: str) -> None:
+        kind, _, rest = payload.partition(":")
+
+        if kind == "u":
+            self.cache.invalidate_user(int(rest))
+        elif kind == "s":
+            userid, _, token_hash = rest.partition(":")
+            self.cache.invalidate(int(userid), bytes.fromhex(token_hash))
+
+    def _listen(self) -> None:
+        conn = psycopg2.connect(**database.connect_kwargs(self.app.config))
+        try:
+            conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CHANNEL}")
+
+            # Anything published while we were not listening is lost
+            self.cache.clear()
+
+            while True:
+                if select.select([conn], [], [], 30.0) == ([], [], []):
+                    continue
+
+                conn.poll()
+                while conn.notifies:
+                    self._apply(conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
+
+    def _run(self) -> None:
+        delay = 1.0
+
+        while True:
+            started = time.monotonic()
+            try:
+                self._listen()
+            except Exception:
+                log.exception("Session cache invalidation listener failed")
+
+            if time.monotonic() - started > 60:
+                delay = 1.0
+            time.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+
+def get_session_cache() -> Optional[SessionCache | SharedSessionCache]:
+    """Return the session cache of the app, or None if it is disabled"""
+    return current_app.extensions.get("stkaddons_session_cache")
+
+
+def init_app(app: Flask):
+    c = app.config
+
+    if c["SESSION_CACHE_SIZE"] <= 0:
+        return
+
+    if c["SESSION_CACHE_BACKEND"] == "shared":
+        cache = SharedSessionCache(
+            c["SESSION_CACHE_PATH"]
+            or os.path.join(app.instance_path, "session_cache.shm"),
+            c["SESSION_CACHE_SIZE"],
+            c["SESSION_CACHE_TTL"],
+        )
+    elif c["SESSION_CACHE_BACKEND"] == "local":
+        cache = SessionCache(c["SESSION_CACHE_SIZE"], c["SESSION_CACHE_TTL"])
+    else:
+        raise ValueError(f"Unknown SESSION_CACHE_BACKEND {c['SESSION_CACHE_BACKEND']}")
+
+    app.extensions["stkaddons_session_cache"] = cache
+
+    if c["SESSION_CACHE_NOTIFY"]:
+        listener = InvalidationListener(app, cache)
+        app.extensions["stkaddons_session_listener"] = listener
+        app.before_request(listener.ensure_started)
@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Callable, Optional
+
+_HEADER = struct.Struct("<8sII")
+_MAGIC = b"STKSHM01"
+# sequence, key digest, expiry (time.time()), value length
+_SLOT_HEADER = struct.Struct("<I16sdH")
+# Slots probed per key; a key lives in one of them
+_WAYS = 4
+_READ_RETRIES = 8
+
+
+class SharedTable:
+    """Fixed-size key/value table in a memory-mapped file.
+
+    Every process on the host that maps the same file sees the same
+    entries. Writers serialize on a file lock; readers take no lock and
+    use a per-slot sequence number to detect a concurrent write, so the
+    common read path costs a few ``struct`` calls.
+
+    Values are bytes of at most ``value_size``; each entry has an expiry
+    and the oldest one in its probe window is replaced when all are taken.
+    """
+
+    def __init__(self, path: str, slots: int = 65536, value_size: int = 256):
+        self.path = path
+        self.slots = slots
+        self.value_size = value_size
+        self.slot_size = _SLOT_HEADER.size + value_size
+
+        size = _HEADER.size + slots * self.slot_size
+        header = _HEADER.pack(_MAGIC, slots, value_size)
+
+        # Writers lock a separate file, so it stays the same one when the
+        # table file is replaced
+        self._lock_path = path + ".lock"
+        self._thread_lock = threading.Lock()
+        self._lock_fd = None
+        self._lock_pid = None
+
+        with self._locked():
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size != size:
+                    # Other processes may still map the old file; truncating
+                    # it would fault their next access, so build a new one
+                    tmp = f"{path}.{os.getpid()}.tmp"
+                    new = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+                    os.close(fd)
+                    fd = new
+                    os.ftruncate(fd, size)
+                    os.pwrite(fd, header, 0)
+                    os.replace(tmp, path)
+                elif os.pread(fd, _HEADER.size, 0) != header:
+                    raise ValueError(f"{path} holds a table of another layout")
+
+                self._map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def digest(key: str) -> bytes:
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+    def _offsets(self, digest: bytes):
+        first = int.from_bytes(digest[:8], "little") % self.slots
+        for i in range(_WAYS):
+            yield _HEADER.size + ((first + i) % self.slots) * self.slot_size
+
+    @contextmanager
+    def _locked(self):
+        # flock only excludes other open file descriptions, so every
+        # process opens its own and threads share it behind a mutex.
+        with self._thread_lock:
+            if self._lock_pid != os.getpid():
+                self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+                self._lock_pid = os.getpid()
+
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _read(self, offset: int) -> Optional[tuple[bytes, float, bytes]]:
+        """Read a slot consistently, or return None if it kept changing"""
+        m = self._map
+        for _ in range(_READ_RETRIES):
+            seq, key, expires, length = _SLOT_HEADER.unpack_from(m, offset)
+            if seq & 1:
+                continue
+
+            start = offset + _SLOT_HEADER.size
+            value = m[start : start + length]
+
+            if _SLOT_HEADER.unpack_from(m, offset)[0] == seq:
+                return key, expires, value
+
+        return None
+
+    def _write(self, offset: int, key: bytes, expires: float, value: bytes) -> None:
+        """Overwrite a slot; the caller holds the write lock"""
+        m = self._map
+        seq = _SLOT_HEADER.unpack_from(m, offset)[0]
+        struct.pack_into("<I", m, offset, seq + 1)
+
+        start = offset + _SLOT_HEADER.size
+        m[start : start + len(value)] = value
+        _SLOT_HEADER.pack_into(m, offset, seq + 1, key, expires, len(value))
+
+        struct.pack_into("<I", m, offset, seq + 2)
+
+    def get(self, key: str) -> Optional[bytes]:
+        digest = self.digest(key)
+        now = time.time()
+
+        for offset in self._offsets(digest):
+            slot = self._read(offset)
+            if slot is not None and slot[0] == digest:
+                return slot[2] if slot[1] > now else None
+
+        return None
+
+    def _find(self, digest: bytes, now: float) -> tuple[int, bool]:
+        """Pick the slot for a key; returns (offset, evicts a live entry)"""
+        slots = [
+            (offset, *_SLOT_HEADER.unpack_from(self._map, offset)[1:3])
+            for offset in self._offsets(digest)
+        ]
+
+        for offset, key, _ in slots:
+            if key == digest:
+                return offset, False
+
+        offset, _, expires = min(slots, key=lambda slot: slot[2])
+        return offset, expires > now
+
+    def put(self, key: str, value: bytes, ttl: float) -> bool:
+        """Store a value; returns True if a live entry had to be evicted"""
+        if len(value) > self.value_size:
+            raise ValueError("Value too large for the table")
+
+        digest = self.digest(key)
+        with self._locked():
+            now = time.time()
+            offset, evicted = self._find(digest, now)
+            self._write(offset, digest, now + ttl, value)
+
+        return evicted
+
+    def update(
+        self,
+        key: str,
+        fn: Callable[[Optional[bytes]], tuple[bytes, float]],
+    ):
+        """Atomically replace a value with ``fn(old)``.
+
+        ``fn`` gets the current value (None if absent or expired) and
+        returns the new value and its TTL.
+        """
+        digest = self.digest(key)
+        with self._locked():
+            now = time.time()
+            offset, _ = self._find(digest, now)
+            _, key_, expires, length = _SLOT_HEADER.unpack_from(self._map, offset)
+
+            old = None
+            if key_ == digest and expires > now:
+                start = offset + _SLOT_HEADER.size
+                old = self._map[start : start + length]
+
+            value, ttl = fn(old)
+            if len(value) > self.value_size:
+                raise ValueError("Value too large for the table")
+            self._write(offset, digest, now + ttl, value)
+
+        return value
+
+    def delete(self, key: str) -> None:
+        digest = self.digest(key)
+        with self._locked():
+            for offset in self._offsets(digest):
+                if _SLOT_HEADER.unpack_from(self._map, offset)[1] == digest:
+                    self._write(offset, digest, 0.0, b"")
+
+    def clear(self) -> None:
+        with self._locked():
+            for i in range(self.slots):
+                offset = _HEADER.size + i * self.slot_size
+                if _SLOT_HEADER.unpack_from(self._map, offset)[2] > 0:
+                    self._write(offset, bytes(16), 0.0, b"")
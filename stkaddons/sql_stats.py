@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+from collections import Counter
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+import logging
+import re
+import time
+from typing import TYPE_CHECKING
+from psycopg2 import extensions
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from typing import Optional
+
+log = logging.getLogger("stkaddons.sql")
+
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize(query) -> str:
+    """Reduce a statement to its shape, so repeats can be told apart"""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    elif not isinstance(query, str):
+        # psycopg2.sql.Composable
+        query = repr(query)
+
+    return _SPACE_RE.sub(" ", _LITERAL_RE.sub("?", query)).strip()
+
+
+class QueryStats:
+    """Statements executed on one connection during one request"""
+
+    def __init__(self, slow_threshold: float, endpoint: Optional[str] = None):
+        self.slow_threshold = slow_threshold
+        self.endpoint = endpoint
+        self.count = 0
+        self.total_time = 0.0
+        # (statement, seconds) in execution order
+        self.statements: list[tuple[str, float]] = []
+
+    def record(self, query, elapsed: float) -> None:
+        statement = normalize(query)
+        self.count += 1
+        self.total_time += elapsed
+        self.statements.append((statement, elapsed))
+
+        if elapsed >= self.slow_threshold:
+            log.warning("Slow query (%.1f ms): %s", elapsed * 1000, statement)
+
+    def repeated(self, threshold: int) -> list[tuple[str, int]]:
+        """Return statements that ran at least ``threshold`` times"""
+        counts = Counter(statement for statement, _ in self.statements)
+        return [(s, n) for s, n in counts.most_common() if n >= threshold]
+
+
+class InstrumentedCursor(extensions.cursor):
+    def execute(self, query, vars=None):
+        stats: Optional[QueryStats] = self.connection.stats
+        if stats is None:
+            return super().execute(query, vars)
+
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            stats.record(query, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        stats: Optional[QueryStats] = self.connection.stats
+        if stats is None:
+            return super().executemany(query, vars_list)
+
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            stats.record(query, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        stats: Optional[QueryStats] = self.connection.stats
+        if stats is None:
+            return super().copy_expert(sql, file, size)
+
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            stats.record(sql, time.perf_counter() - start)
+
+
+class InstrumentedConnection(extensions.connection):
+    """Connection whose cursors report to ``stats`` while it is set"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = InstrumentedCursor
+        self.stats: Optional[QueryStats] = None
+
+
+def start(conn: InstrumentedConnection) -> None:
+    """Begin recording the statements of the current request"""
+    if not current_app.config["SQL_STATS_ENABLED"]:
+        return
+
+    # A request reading from a replica and writing to the primary reports
+    # the statements of both connections together
+    if "sql_stats" not in g:
+        g.sql_stats = QueryStats(
+            current_app.config["SQL_SLOW_QUERY_MS"] / 1000,
+            request.endpoint if has_request_context() else None,
+        )
+
+    conn.stats = g.sql_stats
+
+
+def finish(conn: InstrumentedConnection) -> None:
+    """Stop recording and report on the statements of the current request"""
+    stats: Optional[QueryStats] = conn.stats
+    conn.stats = None
+
+    if stats is not None:
+        report(stats)
+
+
+def report(stats: QueryStats) -> None:
+    """Report on the statements of the current request, once"""
+    if g.pop("sql_stats", None) is not stats:
+        return
+
+    endpoint = (("endpoint", stats.endpoint or "none"),)
+    metrics = current_app.extensions["stkaddons_metrics"]
+    metrics.observe("db_request_duration_seconds", stats.total_time, endpoint)
+    metrics.observe("db_request_statements", stats.count, endpoint)
+
+    threshold = current_app.config["SQL_REPEAT_WARN"]
+
+    for statement, n in stats.repeated(threshold):
+        log.warning(
+            "Statement ran %d times in one request to %s (possible N+1): %s",
+            n,
+            stats.endpoint,
+            statement,
+        )
+
+    for recorder in current_app.extensions["stkaddons_sql_stats"]:
+        recorder.append(stats)
+
+
+@contextmanager
+def record_queries(app: Flask):
+    """Collect the QueryStats of every request handled inside the block"""
+    recorded: list[QueryStats] = []
+    recorders = app.extensions["stkaddons_sql_stats"]
+    recorders.append(recorded)
+    try:
+        yield recorded
+    finally:
+        recorders.remove(recorded)
+
+
+@contextmanager
+def query_budget(app: Flask, max_queries: int):
+    """Fail if a request handled inside the block runs too many statements.
+
+    Meant for tests::
+
+        with query_budget(app, 2):
+            client.post("/api/v2/user/poll/", data=...)
+    """
+    with record_queries(app) as recorded:
+        yield recorded
+
+    for stats in recorded:
+        if stats.count > max_queries:
+            listing = "\n".join(f"  {s}" for s, _ in stats.statements)
+            raise AssertionError(
+                f"Request ran {stats.count} statements, "
+                f"budget is {max_queries}:\n{listing}"
+            )
+
+
+def init_app(app: Flask):
+    app.extensions["stkaddons_sql_stats"] = []
@@ -1,22 +1,25 @@
-from flask import render_template
-from flask_mail import Mail, Message
-from .database import get_database
-from .users import User
+from __future__ import annotations
 
+from flask import render_template
+from typing import TYPE_CHECKING, Optional
 
-def send_new_account_verification(id) -> None:
-    db = get_database()
-    cur = db.cursor()
-    mail = Mail()
+from . import mailer
 
-    user = User.get_user(id=id)
+if TYPE_CHECKING:
+    from psycopg2._psycopg import cursor as Cursor
 
-    cur.execute("SELECT code FROM verification WHERE id = %s", (id,))
-    code = cur.fetchone()[0]
 
-    message = Message(
-        subject="New SuperTuxKart Account",
-        recipients=[user.email],
-        html=render_template("mail/new_account.html", user=user, code=code),
+def queue_new_account_verification(
+    cur: Cursor, email: str, username: str, realname: Optional[str], code: str
+) -> None:
+    """Queue the account verification mail in the caller's transaction"""
+    mailer.enqueue(
+        cur,
+        email,
+        "New SuperTuxKart Account",
+        render_template(
+            "mail/new_account.html",
+            user={"username": username, "realname": realname},
+            code=code,
+        ),
     )
-    mail.send(message)
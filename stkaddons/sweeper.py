@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+import datetime
+import logging
+import time
+from typing import TYPE_CHECKING, Callable, Optional
+
+from .background import BackgroundThread
+from . import database
+from . import session_cache
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from psycopg2._psycopg import connection as Connection, cursor as Cursor
+
+log = logging.getLogger("stkaddons.sweeper")
+
+# Only one worker sweeps at a time
+LOCK_ID = 0x53574550
+
+
+def _delete_batches(
+    conn: Connection,
+    query: str,
+    cutoff,
+    batch_size: int,
+    before_commit: Callable[[Cursor, list], None] = None,
+    after_commit: Callable[[list], None] = None,
+) -> int:
+    """Run a bounded DELETE until it removes less than a full batch.
+
+    The callbacks get the rows returned by each batch, before and after
+    its transaction commits.
+    """
+    total = 0
+
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(query, {"cutoff": cutoff, "limit": batch_size})
+            rows = cur.fetchall()
+            if before_commit is not None:
+                before_commit(cur, rows)
+        conn.commit()
+
+        if after_commit is not None:
+            after_commit(rows)
+
+        total += len(rows)
+        if len(rows) < batch_size:
+            return total
+
+
+def _announce_sessions(cur: Cursor, rows: list) -> None:
+    """Tell the other workers to forget the dropped ``(user id, token hash)``"""
+    session_cache.publish_many(
+        cur, [session_cache.payload(userid, bytes(h)) for userid, h in rows]
+    )
+
+
+def sweep(
+    conn: Connection,
+    session_ttl: float,
+    verification_ttl: float,
+    batch_size: int,
+    cache=None,
+) -> Optional[dict]:
+    """Delete idle sessions and stale verification codes.
+
+    Rows are deleted ``batch_size`` at a time, each batch in its own short
+    transaction, so a large backlog never holds locks for long. Dropped
+    sessions are removed from ``cache`` and announced to the other
+    workers. Returns None if another process is already sweeping.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (LOCK_ID,))
+        locked = cur.fetchone()[0]
+    conn.commit()
+
+    if not locked:
+        return None
+
+    start = time.perf_counter()
+    now = datetime.datetime.now()
+
+    def forget(rows: list) -> None:
+        if cache is not None:
+            for userid, token_hash in rows:
+                cache.invalidate(userid, bytes(token_hash))
+
+    try:
+        sessions = _delete_batches(
+            conn,
+            """
+            DELETE FROM sessions WHERE token_hash IN (
+                SELECT token_hash FROM sessions
+                WHERE last_activity < %(cutoff)s
+                LIMIT %(limit)s
+            )
+            RETURNING id, token_hash
+            """,
+            now - datetime.timedelta(seconds=session_ttl),
+            batch_size,
+            _announce_sessions,
+            forget,
+        )
+        codes = _delete_batches(
+            conn,
+            """
+            DELETE FROM verification WHERE id IN (
+                SELECT id FROM verification
+                WHERE created < %(cutoff)s
+                LIMIT %(limit)s
+            )
+            RETURNING id
+            """,
+            now - datetime.timedelta(seconds=verification_ttl),
+            batch_size,
+        )
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (LOCK_ID,))
+        conn.commit()
+
+    return {
+        "sessions": sessions,
+        "codes": codes,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def sweep_app(app: Flask) -> Optional[dict]:
+    """Sweep with the settings and connection pool of ``app``"""
+    c = app.config
+    pool = database.get_pool(app)
+    conn = pool.getconn()
+    try:
+        result = sweep(
+            conn,
+            c["SESSION_TTL"],
+            c["VERIFICATION_TTL"],
+            c["SWEEPER_BATCH_SIZE"],
+            app.extensions.get("stkaddons_session_cache"),
+        )
+    finally:
+        pool.putconn(conn)
+
+    if result:
+        log.info(
+            "Removed %d session(s) and %d verification code(s) in %.2fs",
+            result["sessions"],
+            result["codes"],
+            result["seconds"],
+        )
+
+    return result
+
+
+class SweeperThread:
+    def __init__(self, app: Flask):
+        self.app = app
+        self._thread = BackgroundThread("sweeper", self._run)
+
+    def ensure_started(self) -> None:
+        self._thread.ensure_started()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.app.config["SWEEPER_INTERVAL"])
+            try:
+                sweep_app(self.app)
+            except Exception:
+                # Keep sweeping on the next interval whatever went wrong
+                log.exception("Unable to sweep expired sessions")
+
+
+@click.command("sweep")
+@with_appcontext
+def sweep_command():
+    """Delete idle sessions and stale verification codes."""
+    result = sweep_app(current_app)
+
+    if result is None:
+        click.echo("Another sweep is already running", err=True)
+        raise SystemExit(1)
+
+    click.echo(
+        f"Removed {result['sessions']} session(s) and "
+        f"{result['codes']} verification code(s) "
+        f"in {result['seconds']:.2f}s"
+    )
+
+
+def init_app(app: Flask):
+    app.cli.add_command(sweep_command)
+
+    if app.config["SWEEPER_INTERVAL"] > 0:
+        thread = SweeperThread(app)
+        app.before_request(thread.ensure_started)
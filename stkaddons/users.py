@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from . import database
+from . import mailer
 from .errors import (
     UsernameLengthError,
     PasswordLengthError,
@@ -13,18 +14,39 @@ from .errors import (
 )
 
 import datetime
+from flask import current_app, g
 from psycopg2 import Error as PgError
+import logging
 import re
-from typing import TYPE_CHECKING, Optional
-from werkzeug.security import generate_password_hash
-
+import threading
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Iterable, Mapping, Optional
+from .passwords import hash_password
+from . import session_cache
+from .session_cache import get_session_cache
 from . import util
 
 if TYPE_CHECKING:
+    from flask import Flask
     from psycopg2._psycopg import (
         cursor as Cursor,
     )
 
+log = logging.getLogger("stkaddons.users")
+
+# The role of new accounts, see the default of users.role_id
+DEFAULT_ROLE_ID = 1
+
+# Merges achievement ids into a user's sorted array. Shared with the ASGI
+# API, so the placeholders of the driver are filled in with str.format.
+ADD_ACHIEVEMENTS_QUERY = """
+    UPDATE users SET achievements = ARRAY(
+        SELECT DISTINCT unnest(achievements || {ids}::integer[]) ORDER BY 1
+    )
+    WHERE id = {id}
+    RETURNING achievements
+"""
+
 USERNAME_RE = re.compile(r"^[a-zA-Z0-9\.\-\_]+$")
 PASSWORD_RE = re.compile(
     r"^[a-zA-Z0-9\!\@\#\$\%\^\&\*\(\)\_\+\=\-\/\\\{\}\~\>\<\'\;\[\]\,\.\"\|\`]+$"
@@ -35,13 +57,80 @@ EMAIL_RE = re.compile(
 
 
 class Role:
+    __slots__ = ("id", "name", "display_name")
+
     def __init__(self, id, name, display_name):
         self.id: int = id
         self.name: str = name
         self.display_name: Optional[str] = display_name
 
 
+_roles_lock = threading.Lock()
+
+
+def get_roles() -> Mapping[int, Role]:
+    """Return the role catalogue, loading it on first use.
+
+    The catalogue is read-only and shared by every request of the worker.
+    Call ``reload_roles`` after changing the ``roles`` table.
+    """
+    state = current_app.extensions["stkaddons_roles"]
+
+    if state["roles"] is None:
+        with _roles_lock:
+            if state["roles"] is None:
+                state["roles"] = _load_roles()
+
+    return state["roles"]
+
+
+def reload_roles() -> Mapping[int, Role]:
+    """Reload the role catalogue from the database"""
+    roles = _load_roles()
+    current_app.extensions["stkaddons_roles"]["roles"] = roles
+    return roles
+
+
+def _load_roles() -> Mapping[int, Role]:
+    db = database.get_database(readonly=True)
+    with db.cursor() as cur:
+        cur.execute("SELECT id, name, display_name FROM roles")
+        roles = {row[0]: Role(*row) for row in cur.fetchall()}
+
+    # Users with an unknown role fall back to it, so it must exist
+    if DEFAULT_ROLE_ID not in roles:
+        raise RuntimeError(
+            f"The roles table has no default role (id {DEFAULT_ROLE_ID}); "
+            "apply the migrations or restore the row"
+        )
+
+    return MappingProxyType(roles)
+
+
+def _identity_map() -> tuple[dict[int, User], dict[str, User]]:
+    """Return the users already loaded in this request, by id and username"""
+    if "users_by_id" not in g:
+        g.users_by_id = {}
+        g.users_by_name = {}
+
+    return g.users_by_id, g.users_by_name
+
+
 class User:
+    __slots__ = (
+        "id",
+        "username",
+        "role_id",
+        "password",
+        "realname",
+        "email",
+        "date_login",
+        "date_register",
+        "homepage",
+        "activated",
+        "achievements",
+    )
+
     def __init__(
         self,
         id,
@@ -54,6 +143,7 @@ class User:
         date_register,
         homepage,
         activated,
+        achievements=None,
     ):
         self.id: int = id
         self.username: str = username
@@ -65,20 +155,42 @@ class User:
         self.date_register: datetime.datetime = date_register
         self.homepage: Optional[str] = homepage
         self.activated: bool = activated
+        self.achievements: list[int] = achievements or []
+
+    @classmethod
+    def _load(cls, row: tuple) -> User:
+        """Build a user from a row, or return the copy this request already has"""
+        by_id, by_name = _identity_map()
+
+        if user := by_id.get(row[0]):
+            return user
+
+        user = cls(*row)
+        by_id[user.id] = by_name[user.username.lower()] = user
+        return user
 
     @classmethod
     def get_user(cls, *, id: int = None, username: str = None) -> Optional[User]:
-        print(id, username)
         if id is None and username is None:
             raise ValueError("Provide a username or ID")
 
-        db = database.get_database()
+        by_id, by_name = _identity_map()
+        if id:
+            if user := by_id.get(int(id)):
+                return user
+        elif username:
+            if user := by_name.get(username.lower()):
+                return user
+
+        db = database.get_database(readonly=True)
         cur: Cursor = db.cursor()
 
         if id:
             cur.execute("SELECT * FROM users WHERE id = %s", (int(id),))
         elif username:
-            cur.execute("SELECT * FROM users WHERE username LIKE %s", (username,))
+            cur.execute(
+                "SELECT * FROM users WHERE lower(username) = lower(%s)", (username,)
+            )
         else:
             raise ValueError("Provide a username or ID")
 
@@ -87,7 +199,23 @@ class User:
         if not res:
             return None
 
-        return cls(*res)
+        return cls._load(res)
+
+    @classmethod
+    def get_for_login(cls, username: str) -> Optional[User]:
+        """Get a user from the primary, so a fresh registration can log in"""
+        db = database.get_database()
+        cur: Cursor = db.cursor()
+
+        cur.execute(
+            "SELECT * FROM users WHERE lower(username) = lower(%s)", (username,)
+        )
+        res = cur.fetchone()
+
+        if not res:
+            return None
+
+        return cls._load(res)
 
     @classmethod
     def register(cls, username, password, email, realname: Optional[str] = None):
@@ -105,12 +233,13 @@ class User:
                 """,
                 {
                     "username": username,
-                    "password": str(generate_password_hash(password)),
+                    "password": hash_password(password),
                     "realname": realname,
                     "email": email,
                 },
             )
         except PgError as e:
+            db.rollback()
             if e.diag.constraint_name == "user_unique_email":
                 raise EmailTaken
             if e.diag.constraint_name == "user_unique_username":
@@ -121,47 +250,84 @@ class User:
             ) from e
 
         id = cur.fetchone()[0]
-        db.commit()
-        print(id)
-
-        cls.set_verification(id)
+        code = cls.set_verification(id)
 
         from . import stk_mail
 
-        stk_mail.send_new_account_verification(id)
+        stk_mail.queue_new_account_verification(cur, email, username, realname, code)
+        db.commit()
+
+        mailer.notify()
 
     @staticmethod
-    def set_verification(id):
-        """Set a verification code for the User"""
+    def set_verification(id) -> str:
+        """Set a verification code for the User.
+
+        The code is written in the current transaction; the caller commits.
+        """
 
         db = database.get_database()
         cur = db.cursor()
 
+        code = util.random_string(50)
         cur.execute(
             "INSERT INTO verification VALUES (%(id)s, %(code)s)",
-            {"id": id, "code": util.random_string(50)},
+            {"id": id, "code": code},
         )
-        db.commit()
+
+        return code
 
     @property
     def role(self) -> Role:
-        db = database.get_database()
-        with db.cursor() as cur:
-            cur.execute("SELECT * FROM roles WHERE id = %(id)s", {"id": self.id})
-            data = cur.fetchone()
-            return Role(*data)
+        roles = get_roles()
+
+        if self.role_id not in roles:
+            # Most likely a role created after the catalogue was loaded
+            roles = reload_roles()
+
+        if self.role_id not in roles:
+            # Never grant more than a plain account on a dangling role
+            log.error(
+                "User %s has unknown role %s, using the default role",
+                self.id,
+                self.role_id,
+            )
+            return roles[DEFAULT_ROLE_ID]
+
+        return roles[self.role_id]
 
     @property
-    def achievements(self):
+    def achieved(self) -> str:
+        """The achievements as the space separated list sent to the game"""
+        return " ".join(map(str, self.achievements))
+
+    def add_achievements(self, ids: Iterable[int]):
+        """Record newly unlocked achievements in a single statement"""
+        ids = sorted(set(ids) - set(self.achievements))
+        if not ids:
+            return
+
         db = database.get_database()
         cur: Cursor = db.cursor()
 
-        cur.execute(
-            "SELECT achievement_id FROM achieved WHERE id = %(id)s", {"id": self.id}
-        )
-        data = cur.fetchall()
+        try:
+            cur.execute(
+                ADD_ACHIEVEMENTS_QUERY.format(ids="%s", id="%s"), (ids, self.id)
+            )
+            res = cur.fetchone()
+            session_cache.publish(cur, self.id)
+            db.commit()
+        except PgError as e:
+            db.rollback()
+            raise DatabaseError(
+                "A database error occurred while trying to save achievements"
+            ) from e
+
+        if res:
+            self.achievements = res[0]
 
-        return [x[0] for x in data]
+        if cache := get_session_cache():
+            cache.invalidate_user(self.id)
 
     @staticmethod
     def check_username(username: str):
@@ -196,9 +362,68 @@ class User:
         try:
             cur.execute("UPDATE users SET activated = true WHERE id = %s", (self.id,))
             cur.execute("DELETE FROM verification WHERE id = %s", (self.id,))
+            session_cache.publish(cur, self.id)
             db.commit()
         except PgError as e:
             db.rollback()
             raise DatabaseError(
                 "A database error occurred while trying to activate your account"
             ) from e
+
+        self.activated = True
+
+        if cache := get_session_cache():
+            cache.invalidate_user(self.id)
+
+    def change_password(self, password: str):
+        """Changes the password of the user"""
+
+        db = database.get_database()
+        cur: Cursor = db.cursor()
+
+        password_hash = hash_password(password)
+
+        try:
+            cur.execute(
+                "UPDATE users SET password = %s WHERE id = %s",
+                (password_hash, self.id),
+            )
+            session_cache.publish(cur, self.id)
+            db.commit()
+        except PgError as e:
+            db.rollback()
+            raise DatabaseError(
+                "A database error occurred while trying to change your password"
+            ) from e
+
+        self.password = password_hash
+
+        if cache := get_session_cache():
+            cache.invalidate_user(self.id)
+
+    def set_role(self, role_id: int):
+        """Changes the role of the user"""
+
+        db = database.get_database()
+        cur: Cursor = db.cursor()
+
+        try:
+            cur.execute(
+                "UPDATE users SET role_id = %s WHERE id = %s", (role_id, self.id)
+            )
+            session_cache.publish(cur, self.id)
+            db.commit()
+        except PgError as e:
+            db.rollback()
+            raise DatabaseError(
+                "A database error occurred while trying to change the role"
+            ) from e
+
+        self.role_id = role_id
+
+        if cache := get_session_cache():
+            cache.invalidate_user(self.id)
+
+
+def init_app(app: Flask):
+    app.extensions["stkaddons_roles"] = {"roles": None}
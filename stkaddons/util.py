@@ -1,20 +1,46 @@
 from .errors import InvalidSession
 from functools import wraps
 from flask import request
+import hashlib
+import secrets
 import string
-import random
-from xml.etree import ElementTree as et
 
+from . import xml_response
 
-def generic_response(scope: str = "api", success: bool = True, info: str = "") -> str:
+
+def generic_response(scope: str = "api", success: bool = True, info: str = "") -> bytes:
     """Return a generic response which does not contain additional data"""
-    element = et.Element(scope, {"success": "yes" if success else "no", "info": info})
-    return et.tostring(element)
+    attrs = (("success", "yes" if success else "no"), ("info", info))
+
+    # Messages vary too much to cache, they would evict the fixed responses
+    if info:
+        return xml_response.element(scope, dict(attrs))
+
+    return xml_response.constant(scope, attrs)
+
+
+_ALPHABET = string.ascii_letters.encode()
+# Byte values past the largest multiple of the alphabet size are dropped so
+# that every letter is equally likely.
+_ACCEPTED = 256 - 256 % len(_ALPHABET)
+_TO_ALPHABET = bytes(_ALPHABET[b % len(_ALPHABET)] for b in range(256))
+_REJECTED = bytes(range(_ACCEPTED, 256))
 
 
 def random_string(length: int = 30):
     """Generate a random string with desired length (default 30)"""
-    return "".join([random.choice(string.ascii_letters) for x in range(length)])
+    out = b""
+    while len(out) < length:
+        # Draw a little more than needed so one round almost always suffices
+        draw = secrets.token_bytes(length + length // 4 + 8)
+        out += draw.translate(_TO_ALPHABET, _REJECTED)
+
+    return out[:length].decode("ascii")
+
+
+def hash_token(token: str) -> bytes:
+    """Return the digest under which a session token is stored"""
+    return hashlib.sha256(token.encode()).digest()
 
 
 def need_client_session(f):
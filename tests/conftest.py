@@ -0,0 +1,93 @@
+import datetime
+import os
+
+import psycopg2
+import pytest
+
+from stkaddons import database, migrations
+from stkaddons.app import create_app
+from stkaddons.users import User
+
+
+@pytest.fixture(scope="session")
+def database_config() -> dict:
+    """Settings of a scratch PostgreSQL database with the current schema.
+
+    Tests using it are skipped unless STKADDONS_TEST_DB names a database
+    they may wipe. The server is chosen by the usual PG* variables.
+    """
+    name = os.environ.get("STKADDONS_TEST_DB")
+    if not name:
+        pytest.skip("STKADDONS_TEST_DB is not set")
+
+    config = {
+        "DB_NAME": name,
+        "DB_HOST": os.environ.get("PGHOST"),
+        "DB_PORT": os.environ.get("PGPORT"),
+        "DB_USER": os.environ.get("PGUSER"),
+        "DB_PASS": os.environ.get("PGPASSWORD"),
+    }
+    try:
+        conn = psycopg2.connect(**database.connect_kwargs(config))
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"PostgreSQL is not available: {e}")
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+        conn.commit()
+        migrations.migrate(conn)
+    finally:
+        conn.close()
+
+    return config
+
+
+@pytest.fixture
+def db(database_config):
+    """A connection to the scratch database, closed after the test"""
+    conn = psycopg2.connect(**database.connect_kwargs(database_config))
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def app_config() -> dict:
+    """Settings of the app fixture; override to change them"""
+    return {"MAIL_OUTBOX_THREAD": False, "SWEEPER_INTERVAL": 0}
+
+
+@pytest.fixture
+def app(app_config):
+    """An app that does not use the database"""
+    return create_app(app_config)
+
+
+@pytest.fixture
+def db_app(database_config, app_config):
+    """An app using the scratch database"""
+    return create_app({**app_config, **database_config})
+
+
+@pytest.fixture
+def make_user():
+    """Build a User as loaded from the database, without touching it"""
+
+    def make(id: int = 1, username: str = "player", **fields) -> User:
+        values = dict(
+            id=id,
+            username=username,
+            role_id=1,
+            password="scrypt:32768:8:1$salt$hash",
+            realname=None,
+            email=f"{username}@example.com",
+            date_login=None,
+            date_register=datetime.datetime(2024, 1, 1),
+            homepage=None,
+            activated=True,
+            achievements=[],
+        )
+        values.update(fields)
+        return User(**values)
+
+    return make
@@ -0,0 +1,77 @@
+"""A minimal SMTP server recording what it receives, for the mail tests"""
+
+import socketserver
+import threading
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def reply(self, line: str) -> None:
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self) -> None:
+        server: SMTPStandIn = self.server.stand_in
+        with server.lock:
+            server.connections += 1
+
+        self.reply("220 localhost stand-in")
+        sender, recipients = None, []
+
+        for raw in self.rfile:
+            command = raw.decode().rstrip("\r\n")
+            verb = command[:4].upper()
+
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 localhost")
+            elif verb == "MAIL":
+                sender, recipients = command.split(":", 1)[1].strip(), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipient = command.split(":", 1)[1].strip().strip("<>")
+                if recipient in server.reject:
+                    self.reply("550 No such user")
+                else:
+                    recipients.append(recipient)
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                for line in self.rfile:
+                    if line == b".\r\n":
+                        break
+                    lines.append(line)
+                with server.lock:
+                    server.messages.append((sender, recipients, b"".join(lines)))
+                self.reply("250 OK")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Not implemented")
+
+
+class SMTPStandIn:
+    """Accepts mail on 127.0.0.1 in a background thread.
+
+    Recipients listed in ``reject`` are refused with a 550.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages: list[tuple[str, list[str], bytes]] = []
+        self.connections = 0
+        self.reject: set[str] = set()
+
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.stand_in = self
+        self.port = self._server.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
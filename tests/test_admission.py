@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+from stkaddons import admission
+from stkaddons.admission import LocalTable, Limiter
+from stkaddons.app import create_app
+from stkaddons.errors import RateLimited
+from stkaddons.shm import SharedTable
+
+
+def admit(limiter: Limiter, name: str, **kwargs) -> bool:
+    try:
+        with limiter.admit(name, **kwargs):
+            return True
+    except RateLimited:
+        return False
+
+
+def test_ip_bucket():
+    limiter = Limiter(LocalTable, {"connect": {"ip": (2, 60.0)}})
+
+    assert admit(limiter, "connect", ip="10.0.0.1")
+    assert admit(limiter, "connect", ip="10.0.0.1")
+    assert not admit(limiter, "connect", ip="10.0.0.1")
+    assert admit(limiter, "connect", ip="10.0.0.2")
+    assert limiter.stats()["connect"] == {"admitted": 3, "rejected_ip": 1}
+
+
+def test_username_bucket_ignores_case():
+    limiter = Limiter(LocalTable, {"connect": {"username": (1, 60.0)}})
+
+    assert admit(limiter, "connect", username="Player")
+    assert not admit(limiter, "connect", username="player")
+
+
+def test_concurrency():
+    limiter = Limiter(LocalTable, {"register": {"concurrency": 1}})
+
+    with limiter.admit("register"):
+        assert not admit(limiter, "register")
+
+    assert admit(limiter, "register")
+
+
+def test_unknown_rule_is_not_limited():
+    limiter = Limiter(LocalTable, {})
+
+    assert all(admit(limiter, "anything", ip="10.0.0.1") for _ in range(100))
+
+
+def test_worker_room_is_bounded(tmp_path):
+    path = str(tmp_path / "limits.shm")
+    limiter = Limiter(
+        lambda: SharedTable(path, 16, 1 * admission._WORKER.size),
+        {"connect": {"concurrency": 8}},
+        max_workers=1,
+    )
+    # A live process other than this one holds the only room
+    limiter.table.update(
+        "connect:running",
+        lambda old: (admission._pack_workers({os.getppid(): 1}), 60.0),
+    )
+
+    with pytest.raises(RuntimeError, match="RATE_LIMIT_WORKERS=1"):
+        admit(limiter, "connect")
+
+
+def test_table_is_created_on_first_use(tmp_path):
+    path = tmp_path / "limits.shm"
+    app = create_app(
+        {
+            "MAIL_OUTBOX_THREAD": False,
+            "SWEEPER_INTERVAL": 0,
+            "RATE_LIMIT_PATH": str(path),
+            "RATE_LIMIT_SLOTS": 16,
+        }
+    )
+    assert not path.exists()
+
+    with app.app_context():
+        assert admit(admission.get_limiter(), "register", ip="10.0.0.1")
+
+    assert path.exists()
+
+
+def test_worker_count_is_checked_at_startup():
+    with pytest.raises(ValueError, match="RATE_LIMIT_WORKERS"):
+        create_app(
+            {
+                "MAIL_OUTBOX_THREAD": False,
+                "SWEEPER_INTERVAL": 0,
+                "RATE_LIMIT_WORKERS": 0,
+            }
+        )
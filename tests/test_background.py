@@ -0,0 +1,40 @@
+import threading
+import time
+
+from stkaddons.background import BackgroundThread, Flusher
+
+
+def test_started_once_per_process():
+    ran = threading.Semaphore(0)
+    starts = []
+    thread = BackgroundThread("test", ran.release, lambda: starts.append(1))
+
+    assert thread.ensure_started()
+    assert not thread.ensure_started()
+    assert ran.acquire(timeout=1)
+
+    # As seen by a forked child
+    thread._pid = -1
+    assert thread.ensure_started()
+    assert ran.acquire(timeout=1)
+    assert starts == [1, 1]
+
+
+def test_flusher_keeps_going_after_errors(caplog):
+    calls = []
+
+    def flush():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("database down")
+
+    flusher = Flusher("test-flush", flush, 0.01, "Unable to flush the test")
+    flusher.ensure_started()
+    deadline = time.monotonic() + 1
+    while len(calls) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # Park the thread for the rest of the run
+    flusher.interval = 3600
+
+    assert len(calls) >= 3
+    assert "Unable to flush the test" in caplog.text
@@ -0,0 +1,118 @@
+import datetime
+import gzip
+
+import pytest
+
+from stkaddons.api.catalogue import (
+    CHUNK_SIZE,
+    FOOTER,
+    HEADER,
+    Catalogue,
+    _CHECK_QUERY,
+    _QUERY,
+    stream,
+)
+
+NOW = datetime.datetime(2026, 1, 1, 12, 0)
+
+
+def addon(id: str, updated: datetime.datetime, name: str = None) -> tuple:
+    """A row of the catalogue query"""
+    return (
+        id, "kart", name or id, "someone", None, None, 1, f"{id}.zip", 1000, 0,
+        6, None, None, None, None, "CC-BY-SA", 0.0, NOW, updated,
+    )  # fmt: skip
+
+
+class FakeCursor:
+    """Answers the queries of Catalogue.refresh from a dict of rows"""
+
+    def __init__(self, rows: list[tuple]):
+        self.addons = {row[0]: row for row in rows}
+        self.result = []
+        self.queries = []
+
+    def execute(self, query: str, params: tuple = ()):
+        self.queries.append(query)
+        rows = list(self.addons.values())
+
+        if query == _CHECK_QUERY:
+            top = max((row[-1] for row in rows), default=None)
+            recent = sorted(
+                (row[0], row[-1])
+                for row in rows
+                if top is not None
+                and row[-1] >= top - datetime.timedelta(seconds=params[0])
+            )
+            self.result = [(len(rows), top, len(recent), hash(tuple(recent)))]
+        elif query.startswith(_QUERY):
+            self.result = [row for row in rows if not params or row[-1] >= params[0]]
+        elif query == "SELECT id FROM addons":
+            self.result = [(row[0],) for row in rows]
+        else:
+            raise AssertionError(f"Unexpected query {query}")
+
+    def fetchone(self):
+        return self.result[0]
+
+    def __iter__(self):
+        return iter(self.result)
+
+
+@pytest.fixture
+def feed(tmp_path):
+    return Catalogue(str(tmp_path), lookback=60.0)
+
+
+def document(feed: Catalogue) -> bytes:
+    with gzip.open(feed.snapshot.gzip_path) as f:
+        return f.read()
+
+
+def test_refresh_renders_only_changes(feed):
+    cur = FakeCursor([addon("a", NOW), addon("b", NOW - datetime.timedelta(hours=1))])
+
+    assert feed.refresh(cur)
+    assert feed.rendered == 2
+    assert b'name="a"' in document(feed)
+
+    assert not feed.refresh(cur)
+    assert feed.rendered == 2
+
+    cur.addons["b"] = addon("b", NOW + datetime.timedelta(seconds=1), "renamed")
+    assert feed.refresh(cur)
+    # Only the rows in the lookback window below the newest one are read
+    assert feed.rendered == 4
+    assert b'name="renamed"' in document(feed)
+
+
+def test_change_below_the_newest_row_is_found(feed):
+    cur = FakeCursor([addon("a", NOW), addon("b", NOW - datetime.timedelta(hours=1))])
+    feed.refresh(cur)
+
+    # Committed late: newer than what was read, older than the newest row
+    cur.addons["b"] = addon("b", NOW - datetime.timedelta(seconds=10), "late")
+
+    assert feed.refresh(cur)
+    assert b'name="late"' in document(feed)
+
+
+def test_deleted_addon_is_dropped(feed):
+    cur = FakeCursor([addon("a", NOW), addon("b", NOW - datetime.timedelta(hours=1))])
+    feed.refresh(cur)
+    etag = feed.snapshot.etag
+
+    del cur.addons["b"]
+
+    assert feed.refresh(cur)
+    assert b'id="b"' not in document(feed)
+    assert feed.snapshot.etag != etag
+
+
+def test_stream_chunks_the_document():
+    fragments = [b"x" * 1000] * 200
+    chunks = list(stream(fragments))
+
+    assert b"".join(chunks) == HEADER + b"".join(fragments) + FOOTER
+    assert all(len(c) < CHUNK_SIZE + 1000 for c in chunks)
+    assert len(chunks) > 2
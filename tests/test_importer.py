@@ -0,0 +1,62 @@
+from stkaddons.importer import validate_achievements, validate_users
+
+
+def legacy_user(**fields) -> dict:
+    row = {
+        "id": "12",
+        "username": "player",
+        "role": "1",
+        "password": "$2y$10$abcdefghijklmnopqrstuu5yZ4t0zGqkQv9W7d0T2zmYk1sL2yV8e",
+        "name": "A Player",
+        "email": "player@example.com",
+        "date_login": "0000-00-00 00:00:00",
+        "date_register": "2015-03-01 10:00:00",
+        "homepage": "",
+        "active": "1",
+    }
+    row.update(fields)
+    return row
+
+
+def test_valid_user_becomes_a_staging_row():
+    valid, rejected = validate_users([legacy_user()])
+
+    assert rejected == []
+    (values,) = valid
+    assert values[0] == "12"
+    assert values[1] == "player"
+    # Zero dates and empty strings become NULL
+    assert values[6] is None
+    assert values[8] is None
+    assert values[9] is True
+
+
+def test_invalid_users_are_rejected_with_a_reason():
+    rows = [
+        legacy_user(id="²"),
+        legacy_user(id=str(2**31)),
+        legacy_user(password=""),
+        legacy_user(username="no spaces"),
+        legacy_user(email="not an email"),
+    ]
+    valid, rejected = validate_users(rows)
+
+    assert valid == []
+    assert [reason for _, reason in rejected][:3] == [
+        "Invalid id",
+        "Invalid id",
+        "Missing password",
+    ]
+    assert [row for row, _ in rejected] == rows
+
+
+def test_achievements():
+    rows = [
+        {"userid": "12", "achievementid": " 3 "},
+        {"userid": "12", "achievementid": "x"},
+        {"userid": "", "achievementid": "3"},
+    ]
+    valid, rejected = validate_achievements(rows)
+
+    assert valid == [("12", "3")]
+    assert [row for row, _ in rejected] == rows[1:]
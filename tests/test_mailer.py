@@ -0,0 +1,107 @@
+import socket
+
+import pytest
+
+from smtp_stand_in import SMTPStandIn
+from stkaddons import mailer
+
+
+@pytest.fixture
+def smtp():
+    with SMTPStandIn() as server:
+        yield server
+
+
+@pytest.fixture
+def app_config(smtp):
+    return {
+        "MAIL_OUTBOX_THREAD": False,
+        "MAIL_SERVER": "127.0.0.1",
+        "MAIL_PORT": smtp.port,
+        "MAIL_DEFAULT_SENDER": "noreply@example.com",
+        "MAIL_OUTBOX_MAX_ATTEMPTS": 2,
+    }
+
+
+def _rows(*recipients):
+    return [
+        (id, recipient, f"Subject {id}", f"<p>Mail {id}</p>", 0)
+        for id, recipient in enumerate(recipients, 1)
+    ]
+
+
+def test_batch_is_sent_over_one_connection(app, smtp):
+    worker = app.extensions["stkaddons_mailer"]
+
+    sent, failed = worker._send_batch(_rows("a@example.com", "b@example.com"))
+
+    assert sent == [1, 2]
+    assert failed == []
+    assert smtp.connections == 1
+    assert [m[1] for m in smtp.messages] == [["a@example.com"], ["b@example.com"]]
+
+
+def test_refused_recipient_fails_alone(app, smtp):
+    smtp.reject.add("b@example.com")
+    worker = app.extensions["stkaddons_mailer"]
+
+    sent, failed = worker._send_batch(
+        _rows("a@example.com", "b@example.com", "c@example.com")
+    )
+
+    assert sent == [1, 3]
+    assert [id for id, _ in failed] == [2]
+
+
+def test_unreachable_server_fails_the_batch(app):
+    # A port nothing listens on
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    app.extensions["mail"].port = port
+    worker = app.extensions["stkaddons_mailer"]
+
+    sent, failed = worker._send_batch(_rows("a@example.com", "b@example.com"))
+
+    assert sent == []
+    assert [id for id, _ in failed] == [1, 2]
+
+
+def _enqueue(db, *recipients):
+    with db.cursor() as cur:
+        cur.execute("TRUNCATE mail_outbox")
+        for recipient in recipients:
+            mailer.enqueue(cur, recipient, "Hello", "<p>Hello</p>")
+    db.commit()
+
+
+def _outbox(db):
+    with db.cursor() as cur:
+        cur.execute("SELECT recipient, status, attempts FROM mail_outbox ORDER BY id")
+        return cur.fetchall()
+
+
+def test_drain_sends_the_outbox(db_app, db, smtp):
+    _enqueue(db, "a@example.com", "b@example.com")
+
+    assert db_app.extensions["stkaddons_mailer"].drain() == 2
+
+    assert _outbox(db) == [("a@example.com", "sent", 0), ("b@example.com", "sent", 0)]
+    assert len(smtp.messages) == 2
+
+
+def test_drain_retries_then_gives_up(db_app, db, smtp):
+    smtp.reject.add("b@example.com")
+    _enqueue(db, "a@example.com", "b@example.com")
+    worker = db_app.extensions["stkaddons_mailer"]
+
+    worker.drain()
+    assert _outbox(db)[1] == ("b@example.com", "pending", 1)
+
+    with db.cursor() as cur:
+        cur.execute("UPDATE mail_outbox SET next_attempt = now()")
+    db.commit()
+    worker.drain()
+
+    assert _outbox(db) == [("a@example.com", "sent", 0), ("b@example.com", "dead", 2)]
+    assert worker.stats() == {"sent": 1, "failed": 2, "dead": 1}
@@ -0,0 +1,26 @@
+import os
+import subprocess
+import sys
+
+
+def test_import_builds_no_app(tmp_path):
+    """Worker processes import modules of the package without an app"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import stkaddons.passwords, stkaddons; "
+            "assert 'app' not in vars(stkaddons)",
+        ],
+        cwd=tmp_path,
+        env={**os.environ, "PYTHONPATH": root},
+        check=True,
+    )
+
+
+def test_asgi_shares_the_package_app():
+    import stkaddons
+    from stkaddons import asgi
+
+    assert asgi.app.flask_app is stkaddons.app
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+import pytest
+
+from stkaddons.errors import ServerBusy
+from stkaddons.passwords import PasswordHasher
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher("scrypt", workers=1, queue_limit=2, timeout=0.2)
+    yield hasher
+    if hasher._executor is not None:
+        hasher._executor.shutdown(cancel_futures=True)
+
+
+def test_hash_and_verify():
+    # Without workers, as spawning one may take longer than a timeout
+    hasher = PasswordHasher("scrypt", workers=0)
+    pwhash = hasher.hash("secret password")
+
+    assert hasher.verify(pwhash, "secret password")
+    assert not hasher.verify(pwhash, "wrong password")
+    assert not hasher.needs_rehash(pwhash)
+
+
+def test_verify_in_a_worker_process():
+    hasher = PasswordHasher("pbkdf2:sha256:1", workers=1, timeout=60.0)
+    try:
+        pwhash = hasher.hash("secret password")
+
+        assert hasher.verify(pwhash, "secret password")
+        assert not hasher.verify(pwhash, "wrong password")
+        assert not hasher.verify("not a hash", "secret password")
+        assert not asyncio.run(hasher.verify_async("nope$x$y", "secret password"))
+    finally:
+        hasher._executor.shutdown()
+
+
+def test_timeout_raises_server_busy(hasher):
+    with pytest.raises(ServerBusy):
+        hasher._run("hash", time.sleep, 2)
+
+
+def test_async_timeout_raises_server_busy(hasher):
+    with pytest.raises(ServerBusy):
+        asyncio.run(hasher._run_async("hash", time.sleep, 2))
+
+
+def test_timed_out_job_keeps_its_slot(hasher):
+    with pytest.raises(ServerBusy):
+        hasher._run("hash", time.sleep, 1)
+
+    # One slot is still held by the sleeping job, the other one is free
+    hasher._acquire()
+    with pytest.raises(ServerBusy):
+        hasher._acquire()
+    hasher._slots.release()
+
+
+def test_needs_rehash_with_other_parameters(hasher):
+    assert hasher.needs_rehash("pbkdf2:sha256:600000$salt$hash")
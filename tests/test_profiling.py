@@ -0,0 +1,70 @@
+import json
+import os
+import time
+
+import pytest
+
+from stkaddons import profiling
+from stkaddons.profiling import Profiler
+
+
+@pytest.fixture
+def app_config(tmp_path) -> dict:
+    return {
+        "MAIL_OUTBOX_THREAD": False,
+        "SWEEPER_INTERVAL": 0,
+        "PROFILE_SECRET": "secret",
+        "PROFILE_DIR": str(tmp_path / "profiles"),
+        "PROFILE_KEEP": 1,
+    }
+
+
+def write_profile(directory, duration: float, age: float) -> str:
+    name = "{:012d}-{}-1-index".format(
+        round(duration * 1e6), int((time.time() - age) * 1000)
+    )
+    for suffix in (".json", ".prof"):
+        with open(os.path.join(directory, name + suffix), "w") as f:
+            json.dump({"duration": duration}, f)
+    return name
+
+
+def kept(directory) -> set[str]:
+    return {n[: -len(".json")] for n in os.listdir(directory) if n.endswith(".json")}
+
+
+def test_prune_keeps_the_slowest_recent_profiles(tmp_path):
+    profiler = Profiler(str(tmp_path), keep=2, window=60.0)
+    old = write_profile(tmp_path, 9.0, age=120.0)
+    slow = write_profile(tmp_path, 2.0, age=1.0)
+    slower = write_profile(tmp_path, 3.0, age=1.0)
+    write_profile(tmp_path, 1.0, age=1.0)
+
+    profiler._prune()
+
+    # The old profile is the slowest, but left the window
+    assert kept(tmp_path) == {slow, slower}
+    assert not os.path.exists(os.path.join(tmp_path, old + ".prof"))
+
+
+def test_prune_spares_the_protected_profile(tmp_path):
+    profiler = Profiler(str(tmp_path), keep=1, window=60.0)
+    write_profile(tmp_path, 2.0, age=1.0)
+    fast = write_profile(tmp_path, 1.0, age=1.0)
+
+    profiler._prune(fast)
+
+    assert fast in kept(tmp_path)
+
+
+def test_forced_profile_survives_its_request(app, app_config):
+    directory = app_config["PROFILE_DIR"]
+    os.makedirs(directory)
+    slow = write_profile(directory, 60.0, age=1.0)
+
+    header = profiling.sign("secret", int(time.time()) + 60)
+    app.test_client().get("/api/v2/version/", headers={"X-STK-Profile": header})
+
+    names = kept(directory)
+    assert slow in names
+    assert len(names) == 2
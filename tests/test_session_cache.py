@@ -0,0 +1,114 @@
+import time
+
+import pytest
+
+from stkaddons.client_session import ClientSession
+from stkaddons.session_cache import SessionCache, SharedSessionCache
+
+
+@pytest.fixture(params=["local", "shared"])
+def cache(request, tmp_path):
+    if request.param == "local":
+        return SessionCache(100, ttl=60.0)
+    return SharedSessionCache(str(tmp_path / "sessions.shm"), 256, ttl=60.0)
+
+
+def test_put_and_get(cache, make_user):
+    cache.put(ClientSession("token", make_user(7)))
+
+    session = cache.get(7, "token")
+    assert session.user.id == 7
+    assert cache.get(7, "other") is None
+    assert cache.get(8, "token") is None
+
+
+def test_invalidate_drops_the_session(cache, make_user):
+    session = ClientSession("token", make_user(7))
+    cache.put(session)
+    cache.put(ClientSession("other", make_user(7)))
+
+    cache.invalidate(7, session.token_hash)
+
+    assert cache.get(7, "token") is None
+    assert cache.get(7, "other") is not None
+
+
+def test_invalidate_user_drops_every_session(cache, make_user):
+    cache.put(ClientSession("token", make_user(7)))
+    cache.put(ClientSession("other", make_user(7)))
+
+    cache.invalidate_user(7)
+
+    assert cache.get(7, "token") is None
+    assert cache.get(7, "other") is None
+
+
+def test_read_before_invalidate_user_is_not_cached(cache, make_user):
+    # The session row is read, the user is invalidated, then the put runs
+    read_at = time.time()
+    cache.invalidate_user(7)
+    cache.put(ClientSession("token", make_user(7)), read_at)
+
+    assert cache.get(7, "token") is None
+
+
+def test_read_after_invalidate_user_is_cached(cache, make_user):
+    cache.invalidate_user(7)
+    time.sleep(0.001)
+    cache.put(ClientSession("token", make_user(7)), time.time())
+
+    assert cache.get(7, "token") is not None
+
+
+def test_entry_expires_ttl_after_the_read(cache, make_user):
+    # Markers of invalidations after the read expire no later than this
+    cache.put(ClientSession("old", make_user(7)), time.time() - 61.0)
+    cache.put(ClientSession("aging", make_user(7)), time.time() - 59.9)
+
+    assert cache.get(7, "old") is None
+    assert cache.get(7, "aging") is not None
+    time.sleep(0.2)
+    assert cache.get(7, "aging") is None
+
+
+def test_local_read_before_invalidate_is_not_cached(make_user):
+    cache = SessionCache(100, ttl=60.0)
+    session = ClientSession("token", make_user(7))
+
+    read_at = time.time()
+    cache.invalidate(7, session.token_hash)
+    cache.put(session, read_at)
+
+    assert cache.get(7, "token") is None
+
+
+def test_local_read_before_clear_is_not_cached(make_user):
+    cache = SessionCache(100, ttl=60.0)
+
+    read_at = time.time()
+    cache.clear()
+    cache.put(ClientSession("token", make_user(7)), read_at)
+
+    assert cache.get(7, "token") is None
+
+
+def test_local_evicts_least_recently_used(make_user):
+    cache = SessionCache(2, ttl=60.0)
+    for token in ("a", "b"):
+        cache.put(ClientSession(token, make_user(7)))
+
+    cache.get(7, "a")
+    cache.put(ClientSession("c", make_user(7)))
+
+    assert cache.get(7, "a") is not None
+    assert cache.get(7, "b") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_shared_cache_does_not_store_the_password(tmp_path, make_user):
+    path = tmp_path / "sessions.shm"
+    cache = SharedSessionCache(str(path), 256, ttl=60.0)
+    cache.put(ClientSession("token", make_user(7, password="scrypt:secret$x")))
+
+    assert b"secret" not in path.read_bytes()
+    assert cache.get(7, "token").user.password is None
@@ -0,0 +1,108 @@
+import re
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from stkaddons import sql_stats
+
+
+@pytest.fixture
+def app_config() -> dict:
+    return {
+        "MAIL_OUTBOX_THREAD": False,
+        "SWEEPER_INTERVAL": 0,
+        "PASSWORD_HASH_WORKERS": 0,
+        "RATE_LIMIT_BACKEND": "local",
+        "PASSWORD_HASH_METHOD": "pbkdf2:sha256:1",
+    }
+
+
+def test_failed_login_is_reported(db_app):
+    client = db_app.test_client()
+
+    with sql_stats.record_queries(db_app) as recorded:
+        response = client.post(
+            "/api/v2/user/connect/",
+            data={"username": "nobody", "password": "secret"},
+        )
+
+    assert b'success="no"' in response.data
+    assert len(recorded) == 1
+    assert recorded[0].count == 1
+
+
+@pytest.fixture
+def player(db) -> tuple[int, str]:
+    """A user in the scratch database, logged in as (userid, token)"""
+    with db.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO users (username, password, email, activated)
+            VALUES ('budget', %s, 'budget@example.com', true)
+            RETURNING id
+            """,
+            (generate_password_hash("secret", "pbkdf2:sha256:1"),),
+        )
+        userid = cur.fetchone()[0]
+    db.commit()
+
+    yield userid
+
+    with db.cursor() as cur:
+        cur.execute("DELETE FROM users WHERE id = %s", (userid,))
+    db.commit()
+
+
+def connect(client) -> dict:
+    response = client.post(
+        "/api/v2/user/connect/", data={"username": "budget", "password": "secret"}
+    )
+    token = re.search(rb'token="([^"]+)"', response.data).group(1).decode()
+    userid = re.search(rb'userid="(\d+)"', response.data).group(1).decode()
+    return {"userid": userid, "token": token}
+
+
+def test_connect_budget(db_app, player):
+    with sql_stats.query_budget(db_app, 2):
+        connect(db_app.test_client())
+
+
+@pytest.mark.parametrize(
+    "endpoint, data, budget",
+    [
+        ("/api/v2/user/saved-session/", {}, 1),
+        ("/api/v2/user/poll/", {}, 1),
+        ("/api/v2/user/achieving/", {"achievementid": "1,2"}, 3),
+        ("/api/v2/user/disconnect/", {}, 3),
+    ],
+)
+def test_session_endpoint_budget(db_app, player, endpoint, data, budget):
+    client = db_app.test_client()
+    credentials = connect(client)
+    # Start from a cold session cache
+    db_app.extensions["stkaddons_session_cache"].clear()
+
+    with sql_stats.query_budget(db_app, budget) as recorded:
+        response = client.post(endpoint, data={**credentials, **data})
+
+    assert b'success="yes"' in response.data
+    assert len(recorded) == 1
+
+
+def test_budget_exceeded(app):
+    stats = sql_stats.QueryStats(1.0)
+    stats.record("SELECT * FROM users WHERE id = 1", 0.001)
+    stats.record("SELECT * FROM users WHERE id = 2", 0.001)
+
+    with pytest.raises(AssertionError, match="2 statements, budget is 1"):
+        with sql_stats.query_budget(app, 1) as recorded:
+            recorded.append(stats)
+
+
+def test_repeats_are_normalized():
+    stats = sql_stats.QueryStats(1.0)
+    for i in range(3):
+        stats.record(f"SELECT  *\n FROM users WHERE username = 'u{i}'", 0.001)
+    stats.record("SELECT 1", 0.001)
+
+    assert stats.repeated(3) == [("SELECT * FROM users WHERE username = ?", 3)]
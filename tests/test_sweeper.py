@@ -0,0 +1,70 @@
+import pytest
+
+from stkaddons import sweeper, util
+
+
+@pytest.fixture
+def account(db):
+    """An unactivated user with an expired code, a fresh and an idle session"""
+    with db.cursor() as cur:
+        cur.execute("""
+            INSERT INTO users (username, password, email)
+            VALUES ('sweepme', '', 'sweepme@example.com')
+            RETURNING id
+            """)
+        userid = cur.fetchone()[0]
+        cur.execute(
+            """
+            INSERT INTO sessions (id, token_hash, last_activity) VALUES
+            (%(id)s, %(idle)s, now() - interval '2 days'),
+            (%(id)s, %(fresh)s, now());
+            INSERT INTO verification (id, code, created)
+            VALUES (%(id)s, 'expired-code', now() - interval '30 days')
+            """,
+            {
+                "id": userid,
+                "idle": util.hash_token("idle"),
+                "fresh": util.hash_token("fresh"),
+            },
+        )
+    db.commit()
+
+    yield userid
+
+    with db.cursor() as cur:
+        cur.execute("DELETE FROM users WHERE id = %s", (userid,))
+    db.commit()
+
+
+def test_sweep(db, account):
+    result = sweeper.sweep(db, 24 * 3600, 24 * 3600, batch_size=1)
+
+    assert result["sessions"] == 1
+    assert result["codes"] == 1
+
+    with db.cursor() as cur:
+        cur.execute("SELECT token_hash FROM sessions WHERE id = %s", (account,))
+        assert [bytes(row[0]) for row in cur] == [util.hash_token("fresh")]
+        # Only the code expires, the account is left alone
+        cur.execute("SELECT count(*) FROM users WHERE id = %s", (account,))
+        assert cur.fetchone()[0] == 1
+
+
+def test_expired_code_is_refused(db_app, account):
+    client = db_app.test_client()
+    response = client.get("/confirm_account?code=expired-code")
+
+    assert response.status_code == 400
+
+
+def test_fresh_code_activates(db_app, db, account):
+    with db.cursor() as cur:
+        cur.execute("UPDATE verification SET created = now() WHERE id = %s", (account,))
+    db.commit()
+
+    response = db_app.test_client().get("/confirm_account?code=expired-code")
+
+    assert response.status_code == 200
+    with db.cursor() as cur:
+        cur.execute("SELECT activated FROM users WHERE id = %s", (account,))
+        assert cur.fetchone()[0]
@@ -0,0 +1,16 @@
+import pytest
+
+from stkaddons import users
+
+
+def test_unknown_role_falls_back_to_default(db_app, make_user):
+    with db_app.app_context():
+        assert make_user(role_id=999).role.id == users.DEFAULT_ROLE_ID
+
+
+def test_missing_default_role(db_app, monkeypatch):
+    monkeypatch.setattr(users, "DEFAULT_ROLE_ID", 999)
+
+    with db_app.app_context():
+        with pytest.raises(RuntimeError, match="no default role"):
+            users.reload_roles()
@@ -0,0 +1,26 @@
+import xml.etree.ElementTree as et
+
+import pytest
+
+from stkaddons import xml_response
+
+
+@pytest.mark.parametrize(
+    "attrs",
+    [
+        {"success": "yes", "info": ""},
+        {"info": 'a <b> & "c"\r\n\td'},
+        {"realname": "Jürgen 日本"},
+    ],
+)
+def test_element_matches_elementtree(attrs):
+    assert xml_response.element("connect", attrs) == et.tostring(
+        et.Element("connect", attrs)
+    )
+
+
+def test_constant_is_cached():
+    attrs = (("success", "yes"), ("info", ""))
+
+    assert xml_response.constant("poll", attrs) is xml_response.constant("poll", attrs)
+    assert xml_response.constant("poll", attrs) == b'<poll success="yes" info="" />'